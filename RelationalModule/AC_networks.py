@@ -1,3 +1,5 @@
+import copy
+import weakref
 import numpy as np
 import torch
 import torch.nn as nn
@@ -6,6 +8,61 @@ import torch.nn.functional as F
 from RelationalModule import RelationalNetworks as rnet
 from RelationalModule import ControlNetworks as cnet
 
+### Twin networks ###
+
+# stateless (meta) copies of the architectures evaluated by twin_forward, one per first network
+META_COPIES = weakref.WeakKeyDictionary()
+
+def twin_forward(net1, net2, state, vectorize=None):
+    """
+    Evaluates two networks with the same architecture (e.g. the two critics of a twin critic)
+    on the same input. If vectorized, their parameters are stacked along a new leading dimension
+    of size 2 and the forward of a stateless copy of net1 is vectorized over it (torch.func.vmap 
+    of torch.func.functional_call), instead of running net1 and net2 one after the other.
+    
+    Notes
+    -----
+    * Stacking is differentiable, so gradients flow to the parameters of net1 and net2,
+      which stay ordinary submodules of the critic (state_dict keys, optimizers and target 
+      networks are unaffected).
+    * The parameters and buffers are stacked again at every call (one copy per tensor), 
+      so that they always match the current weights. The vectorized call can only pay 
+      off on the gpu, when a single network is too small to keep it busy; on the cpu the
+      stacking and the overhead of vmap and functional_call make it slower than the two 
+      forwards for the networks of this module, so by default the two networks are 
+      vectorized only for cuda inputs.
+    * The critics read their vectorize attribute with getattr, since the twin critics of
+      the agents pickled before its introduction (e.g. in Results) don't have it.
+      
+    Parameters
+    ----------
+    net1, net2: nn.Module
+        Networks with the same architecture
+    state: tensor
+        Input of both networks
+    vectorize: bool (default None)
+        If True the two networks are evaluated with a single vectorized call, if False one 
+        after the other. If None, they are vectorized only for cuda inputs
+        
+    Returns
+    -------
+    v1, v2: outputs of net1 and net2
+    """
+    if vectorize is None:
+        vectorize = state.is_cuda
+    if not vectorize:
+        return net1(state), net2(state)
+    
+    if net1 not in META_COPIES:
+        META_COPIES[net1] = copy.deepcopy(net1).to('meta')
+    base = META_COPIES[net1]
+    params = {k:torch.stack((p1, p2)) for (k, p1), p2 in zip(net1.named_parameters(), net2.parameters())}
+    buffers = {k:torch.stack((b1, b2)) for (k, b1), b2 in zip(net1.named_buffers(), net2.buffers())}
+    base.train(net1.training)
+    call = lambda p, b: torch.func.functional_call(base, (p, b), (state,))
+    v = torch.func.vmap(call, randomness='different')(params, buffers)
+    return v[0], v[1]
+
 ### Gated version ###
 
 class GatedBoxWorldActor(nn.Module):
@@ -77,14 +134,16 @@ class GatedBoxWorldCritic(nn.Module):
     Implements a generic critic for BoxWorld environment, 
     that can have 2 independent networks is twin=True. 
     """
-    def __init__(self, twin=True, target=False, **box_net_args):
+    def __init__(self, twin=True, target=False, vectorize=None, **box_net_args):
         """
         Parameters
         ----------
         twin: bool
-            If True uses 2 critics
+            If True uses 2 critics, evaluated together by twin_forward
         target: bool
             If True, returns the minimum between the two critic's predictions
+        vectorize: bool (default None)
+            Evaluation of the twin critics (see twin_forward)
         **box_net_args: dict (optional)
             Dictionary of {'key':value} pairs valid for BoxWorldNet.
             Valid keys:
@@ -112,6 +171,7 @@ class GatedBoxWorldCritic(nn.Module):
         
         self.twin = twin
         self.target = target
+        self.vectorize = vectorize
         
         if twin:
             self.net1 = GatedBoxWorldBasicCritic(**box_net_args)
@@ -121,8 +181,7 @@ class GatedBoxWorldCritic(nn.Module):
         
     def forward(self, state):
         if self.twin:
-            v1 = self.net1(state)
-            v2 = self.net2(state)
+            v1, v2 = twin_forward(self.net1, self.net2, state, getattr(self, 'vectorize', None))
             if self.target:
                 v = torch.min(v1, v2) 
             else:
@@ -178,12 +237,13 @@ class MultiplicativeCritic(nn.Module):
     Implements a generic critic for BoxWorld environment, 
     that can have 2 independent networks is twin=True. 
     """
-    def __init__(self, linear_size, twin=True, target=False, **net_args):
+    def __init__(self, linear_size, twin=True, target=False, vectorize=None, **net_args):
 
         super(MultiplicativeCritic, self).__init__()
         
         self.twin = twin
         self.target = target
+        self.vectorize = vectorize
         
         if twin:
             self.net1 = MultiplicativeBasicCritic(linear_size, **net_args)
@@ -193,8 +253,7 @@ class MultiplicativeCritic(nn.Module):
         
     def forward(self, state):
         if self.twin:
-            v1 = self.net1(state)
-            v2 = self.net2(state)
+            v1, v2 = twin_forward(self.net1, self.net2, state, getattr(self, 'vectorize', None))
             if self.target:
                 v = torch.min(v1, v2) 
             else:
@@ -275,14 +334,16 @@ class ControlCritic(nn.Module):
     Implements a generic critic for BoxWorld environment, 
     that can have 2 independent networks is twin=True. 
     """
-    def __init__(self, twin=True, target=False, **control_net_args):
+    def __init__(self, twin=True, target=False, vectorize=None, **control_net_args):
         """
         Parameters
         ----------
         twin: bool
-            If True uses 2 critics
+            If True uses 2 critics, evaluated together by twin_forward
         target: bool
             If True, returns the minimum between the two critic's predictions
+        vectorize: bool (default None)
+            Evaluation of the twin critics (see twin_forward)
         **control_net_args: dict (optional)
             Dictionary of {'key':value} pairs valid for BoxWorldNet.
             Valid keys:
@@ -310,6 +371,7 @@ class ControlCritic(nn.Module):
         
         self.twin = twin
         self.target = target
+        self.vectorize = vectorize
         
         if twin:
             self.net1 = ControlBasicCritic(**control_net_args)
@@ -319,8 +381,7 @@ class ControlCritic(nn.Module):
         
     def forward(self, state):
         if self.twin:
-            v1 = self.net1(state)
-            v2 = self.net2(state)
+            v1, v2 = twin_forward(self.net1, self.net2, state, getattr(self, 'vectorize', None))
             if self.target:
                 v = torch.min(v1, v2) 
             else:
@@ -401,14 +462,16 @@ class OheCritic(nn.Module):
     Implements a generic critic for BoxWorld environment, 
     that can have 2 independent networks is twin=True. 
     """
-    def __init__(self, map_size, twin=True, target=False, **control_net_args):
+    def __init__(self, map_size, twin=True, target=False, vectorize=None, **control_net_args):
         """
         Parameters
         ----------
         twin: bool
-            If True uses 2 critics
+            If True uses 2 critics, evaluated together by twin_forward
         target: bool
             If True, returns the minimum between the two critic's predictions
+        vectorize: bool (default None)
+            Evaluation of the twin critics (see twin_forward)
         **control_net_args: dict (optional)
             Dictionary of {'key':value} pairs valid for BoxWorldNet.
             Valid keys:
@@ -436,6 +499,7 @@ class OheCritic(nn.Module):
         
         self.twin = twin
         self.target = target
+        self.vectorize = vectorize
         
         if twin:
             self.net1 = OheBasicCritic(map_size, **control_net_args)
@@ -445,8 +509,7 @@ class OheCritic(nn.Module):
         
     def forward(self, state):
         if self.twin:
-            v1 = self.net1(state)
-            v2 = self.net2(state)
+            v1, v2 = twin_forward(self.net1, self.net2, state, getattr(self, 'vectorize', None))
             if self.target:
                 v = torch.min(v1, v2) 
             else:
@@ -527,14 +590,16 @@ class BoxWorldCritic(nn.Module):
     Implements a generic critic for BoxWorld environment, 
     that can have 2 independent networks is twin=True. 
     """
-    def __init__(self, twin=True, target=False, **box_net_args):
+    def __init__(self, twin=True, target=False, vectorize=None, **box_net_args):
         """
         Parameters
         ----------
         twin: bool
-            If True uses 2 critics
+            If True uses 2 critics, evaluated together by twin_forward
         target: bool
             If True, returns the minimum between the two critic's predictions
+        vectorize: bool (default None)
+            Evaluation of the twin critics (see twin_forward)
         **box_net_args: dict (optional)
             Dictionary of {'key':value} pairs valid for BoxWorldNet.
             Valid keys:
@@ -562,6 +627,7 @@ class BoxWorldCritic(nn.Module):
         
         self.twin = twin
         self.target = target
+        self.vectorize = vectorize
         
         if twin:
             self.net1 = BoxWorldBasicCritic(**box_net_args)
@@ -571,8 +637,7 @@ class BoxWorldCritic(nn.Module):
         
     def forward(self, state):
         if self.twin:
-            v1 = self.net1(state)
-            v2 = self.net2(state)
+            v1, v2 = twin_forward(self.net1, self.net2, state, getattr(self, 'vectorize', None))
             if self.target:
                 v = torch.min(v1, v2) 
             else:
@@ -581,12 +646,56 @@ class BoxWorldCritic(nn.Module):
             v = self.net(state)
             
         return v
+
+### Shared trunk ###
+
+class SharedActorCritic(nn.Module):
+    """
+    Actor and critic heads on top of a single shared trunk (e.g. BoxWorldNet), so that
+    the relational encoder is run once for both policy and state values.
+    
+    Called as an actor (forward(state)) returns only the log-probabilities, so it can be
+    used wherever an actor network is expected; value(state) behaves as the corresponding
+    critic (e.g. BoxWorldCritic) and forward(state, values=True) returns both.
+    """
+    def __init__(self, trunk, action_space, twin=False, target=False):
+        """
+        Parameters
+        ----------
+        trunk: nn.Module
+            Network mapping a batch of states to features of shape (batch_size, trunk.n_features)
+        action_space: int
+            Number of (discrete) possible actions to take
+        twin: bool
+            If True uses 2 critic heads
+        target: bool
+            If True, value returns the minimum between the two critic heads' predictions
+        """
+        super(SharedActorCritic, self).__init__()
         
+        self.twin = twin
+        self.target = target
         
+        self.trunk = trunk
+        self.actor_head = nn.Linear(trunk.n_features, action_space)
+        self.critic_heads = nn.ModuleList([nn.Linear(trunk.n_features, 1) for _ in range(2 if twin else 1)])
         
+    def get_values(self, out):
+        if self.twin:
+            v1, v2 = [head(out) for head in self.critic_heads]
+            if self.target:
+                return torch.min(v1, v2)
+            else:
+                return v1, v2
+        else:
+            return self.critic_heads[0](out)
         
-        
-        
-        
-        
+    def value(self, state):
+        return self.get_values(self.trunk(state))
     
+    def forward(self, state, values=False):
+        out = self.trunk(state)
+        log_probs = F.log_softmax(self.actor_head(out), dim=1)
+        if values:
+            return log_probs, self.get_values(out)
+        return log_probs
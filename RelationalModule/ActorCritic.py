@@ -4,35 +4,69 @@ import torch.nn as nn
 import torch.nn.functional as F 
 from torch.distributions import Categorical
 
-from RelationalModule.AC_networks import BoxWorldActor, BoxWorldCritic #custom module
+from RelationalModule.AC_networks import BoxWorldActor, BoxWorldCritic, SharedActorCritic #custom module
+from RelationalModule import RelationalNetworks as rnet
 from RelationalModule.RAdam import RAdam
+from RelationalModule.packing import PackedTrajectories
+from RelationalModule.targets import TargetNetwork
+from RelationalModule.flat import flatten
 
 debug = False
 
-class BoxWorldA2C():
+class A2C():
     """
-    Advantage Actor-Critic RL agent for BoxWorld environment described in the paper
-    Relational Deep Reinforcement Learning.
+    Advantage Actor-Critic RL agent, generic in the actor and critic networks.
+    All the agents of the RelationalModule (BoxWorldA2C, OheA2C, ControlA2C, CoordA2C, 
+    MultiplicativeA2C and GatedBoxWorldA2C) are presets of this class that only choose
+    the networks and some of the options below.
     
     Notes
     -----
-    * Always uses 2 separate networks for the critic,one that learns from new experience 
+    * Uses 2 separate networks for the critic,one that learns from new experience 
       (student/critic) and the other one (critic_target/teacher)that is more conservative 
       and whose weights are updated through an exponential moving average of the weights 
       of the critic, i.e.
           target.params = (1-tau)*target.params + tau* critic.params
+      or periodically copied from the critic (see targets.TargetNetwork). With tau=1 (default)
+      the critic_target would be a copy of the critic, so the critic itself is used instead
+      (critic_trg is critic) and the critic is run once on all the states of an update, 
+      gathering from its predictions both the values of the old states and the targets.
     * In the case of Monte Carlo estimation the critic_target is never used
     * Possible to use twin networks for the critic and the critic target for improved 
       stability. Critic target is used for updates of both the actor and the critic and
       its output is the minimum between the predictions of its two internal networks.
-      
+    * Single episodes (update_TD) and batches of episodes (update_batch) share the same
+      implementation: n-step targets are computed with packing.PackedTrajectories and all
+      the transitions are used in a single forward/backward pass of each network.
+    * With shared_fn, actor and critic are the same network (AC_networks.SharedActorCritic),
+      i.e. two heads on a single trunk, trained with the sum of the critic and actor losses 
+      by a single optimizer that keeps the learning rates of the heads (actor_lr, critic_lr) 
+      and uses lr for the trunk. The advantages are estimated from the values of the same 
+      forward pass and the critic target's ones, so each update runs the trunk once on the
+      old states (with gradient) and once on the new ones (critic target, without gradient),
+      or just once on all the states with a shared critic target, instead of up to 5 times 
+      per network (actor, critic and critic target). 
+      update_every and use_target are ignored and only TD learning is supported.
+    * Agents pickled before the presets were unified lack some of the attributes set in
+      __init__: __setstate__ fills them in with LEGACY_DEFAULTS, the values of the preset.
     """ 
     
-    def __init__(self, action_space, lr, gamma, TD=True, twin=False, tau = 1., 
-                 H=1e-2, n_steps = 1, device='cpu', actor_lr=None, critic_lr=None, radam=False, **box_net_args):
+    LEGACY_DEFAULTS = dict(state_dtype=torch.float32, mask_zero_probs=True, use_target=False, update_every=1,
+                           n_updates=0, shared=False, flat=False)
+    
+    def __init__(self, actor_fn, critic_fn, action_space, lr, gamma, TD=True, twin=False, tau = 1., 
+                 H=1e-2, n_steps = 1, device='cpu', actor_lr=None, critic_lr=None, radam=False, 
+                 weight_decay=0., state_dtype=torch.float32, mask_zero_probs=True, use_target=False, 
+                 update_every=1, shared_fn=None, target_mode='soft', target_period=1, 
+                 flat=False):
         """
         Parameters
         ----------
+        actor_fn: callable
+            actor_fn() returns the actor network, that maps a batch of states to the 
+            log-probabilities of the actions, shape (batch_size, action_space)
+        critic_fn: callable
+            critic_fn(twin, target) returns a critic network (see e.g. BoxWorldCritic)
         action_space: int
             Number of (discrete) possible actions to take
         lr: float in [0,1]
@@ -56,29 +90,35 @@ class BoxWorldA2C():
             Number of steps considered in TD update
         device: str in {'cpu','cuda'}
             Select if training agent with cpu or gpu. 
-            FIXME: At the moment is gpu is present, it MUST use the gpu.
-        **box_net_args: dict (optional)
-            Dictionary of {'key':value} pairs valid for BoxWorldNet.
-            Valid keys:
-                in_channels: int (default 3)
-                    Number of channels of the input image (e.g. 3 for RGB)
-                n_kernels: int (default 24)
-                    Number of features extracted for each pixel
-                vocab_size: int (default 116)
-                    Range of integer values of the raw pixels
-                n_dim: int (default 3)
-                    Embedding dimension for each pixel channel (1 channel for greyscale, 
-                    3 for RGB)
-                n_features: int (default 256)
-                    Number of linearly projected features after positional encoding.
-                    This is the number of features used during the Multi-Headed Attention
-                    (MHA) blocks
-                n_heads: int (default 4)
-                    Number of heades in each MHA block
-                n_attn_modules: int (default 2)
-                    Number of MHA blocks
-                n_linears: int (default 4)
-                    Number of fully-connected layers after the FeaturewiseMaxPool layer
+        actor_lr, critic_lr: float (default None)
+            Learning rates of the actor and of the critic, if different from lr
+        radam: bool (default False)
+            If True uses RAdam instead of Adam as optimizer
+        weight_decay: float (default 0.)
+            Weight decay of both optimizers
+        state_dtype: torch.dtype (default torch.float32)
+            Type of the states fed to the networks (e.g. torch.long for embeddings)
+        mask_zero_probs: bool (default True)
+            If True, zero probabilities are replaced by 1e-5 in the entropy term
+        use_target: bool (default False)
+            If True, the critic target (instead of the critic) estimates the advantages 
+            used in the actor's update
+        update_every: int (default 1)
+            The actor is updated once every update_every updates of the critic
+        shared_fn: callable (default None)
+            If not None, shared_fn(twin, target) returns a network with shared trunk (see 
+            AC_networks.SharedActorCritic) used both as actor and critic, and actor_fn and 
+            critic_fn are ignored
+        target_mode: str in {'soft','hard','shared'} (default 'soft')
+            How critic_target follows the critic (see targets.TargetNetwork): exponential moving
+            average with factor tau, copy every target_period updates or no separate network. 
+            A soft target with tau=1 is shared.
+        target_period: int (default 1)
+            Number of updates between two copies of the critic in the critic_target ('hard' mode)
+        flat: bool (default False)
+            If True, the parameters and gradients of each network are backed by a single flat
+            buffer (see flat.FlatParameters), that the optimizers and the critic target update
+            as a whole
         """
         
         self.gamma = gamma
@@ -90,37 +130,70 @@ class BoxWorldA2C():
         self.tau = tau
         self.H = H
         self.n_steps = n_steps
+        self.state_dtype = state_dtype
+        self.mask_zero_probs = mask_zero_probs
+        self.use_target = use_target
+        self.update_every = update_every
+        self.n_updates = 0
+        self.shared = shared_fn is not None
+        self.flat = flat
+        self.device = device 
         
-        self.actor = BoxWorldActor(action_space, **box_net_args)
-        self.critic = BoxWorldCritic(twin, **box_net_args)
+        if self.shared:
+            assert TD, "Shared actor-critic networks support only TD learning"
+            self.actor = shared_fn(twin, target=False)
+            self.critic = self.actor
+        else:
+            self.actor = actor_fn()
+            self.critic = critic_fn(twin, target=False)
+        # networks are moved to the device before being flattened
+        self.actor.to(self.device) 
+        self.critic.to(self.device)
+        
+        if self.flat:
+            if self.shared:
+                # one group per learning rate
+                names = [name for name, _ in self.actor.named_parameters()]
+                flatten(self.actor, [[n for n in names if n.startswith(module+'.')] 
+                                     for module in ['trunk', 'actor_head', 'critic_heads']])
+            else:
+                flatten(self.actor)
+                flatten(self.critic)
         
         if self.TD:
-            self.critic_trg = BoxWorldCritic(twin, target=True, **box_net_args)
-
-            # Init critic target identical to critic
-            for trg_params, params in zip(self.critic_trg.parameters(), self.critic.parameters()):
-                trg_params.data.copy_(params.data)
+            if self.shared:
+                target_fn = lambda: shared_fn(twin, target=True).to(self.device)
+            else:
+                target_fn = lambda: critic_fn(twin, target=True).to(self.device)
+            self.target = TargetNetwork(self.critic, target_fn, target_mode, tau, target_period)
+            self.critic_trg = self.target.network
             
         if radam:
             self.optimizer = RAdam
         else:
             self.optimizer = torch.optim.Adam
 
-        if actor_lr is not None:
-            self.actor_optim = self.optimizer(self.actor.parameters(), lr=actor_lr)
-        else:
-            self.actor_optim = self.optimizer(self.actor.parameters(), lr=lr)
-        
-        if critic_lr is not None:
-            self.critic_optim = self.optimizer(self.critic.parameters(), lr=critic_lr)
+        if actor_lr is None:
+            actor_lr = lr
+        if critic_lr is None:
+            critic_lr = lr
+        if self.shared:
+            # single optimizer, with the learning rates of the heads
+            if self.flat:
+                trunk, actor_head, critic_heads = [[p] for p in self.actor.flat.params]
+            else:
+                trunk, actor_head, critic_heads = [self.actor.trunk.parameters(), self.actor.actor_head.parameters(),
+                                                   self.actor.critic_heads.parameters()]
+            param_groups = [dict(params=trunk, lr=lr),
+                            dict(params=actor_head, lr=actor_lr),
+                            dict(params=critic_heads, lr=critic_lr)]
+            self.actor_optim = self.optimizer(param_groups, lr=lr, weight_decay=weight_decay)
+            self.critic_optim = self.actor_optim
         else:
-            self.critic_optim = self.optimizer(self.critic.parameters(), lr=lr)
-        
-        self.device = device 
-        self.actor.to(self.device) 
-        self.critic.to(self.device)
-        if self.TD:
-            self.critic_trg.to(self.device)
+            actor_params = self.actor.flat.params if self.flat else self.actor.parameters()
+            critic_params = self.critic.flat.params if self.flat else self.critic.parameters()
+            self.actor_optim = self.optimizer(actor_params, lr=actor_lr, weight_decay=weight_decay)
+            self.critic_optim = self.optimizer(critic_params, lr=critic_lr, weight_decay=weight_decay)
         
         if debug:
             print("="*10 +" A2C HyperParameters "+"="*10)
@@ -142,6 +215,21 @@ class BoxWorldA2C():
             else:
                 print("Not used")
         
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, value in self.LEGACY_DEFAULTS.items():
+            if name not in state:
+                setattr(self, name, value)
+        if self.TD and 'target' not in state:
+            # the old critic target was a separate network averaged with tau after every update:
+            # its weights are restored after the TargetNetwork copies the critic's ones
+            trg_state = {k:v.clone() for k, v in self.critic_trg.state_dict().items()}
+            self.target = TargetNetwork(self.critic, lambda: self.critic_trg, 'soft', self.tau)
+            if self.target.shared:
+                self.critic_trg = self.critic
+            else:
+                self.critic_trg.load_state_dict(trg_state)
+        
     def get_action(self, state, return_log=False):
         log_probs = self.forward(state)
         dist = torch.exp(log_probs)
@@ -152,6 +240,34 @@ class BoxWorldA2C():
         else:
             return action
     
+    def act(self, state):
+        """
+        Samples an action without recording the computational graph. Log-probabilities and
+        distributions are then recomputed in a single forward by update_TD (see evaluate_actions).
+        """
+        with torch.inference_mode():
+            log_probs = self.forward(state)
+        return Categorical(logits=log_probs).sample().item()
+    
+    def evaluate_actions(self, states, actions):
+        """
+        Computes with a single forward of the actor the log-probabilities of the actions taken 
+        in states and the distributions over all the actions.
+        
+        Returns
+        -------
+        log_probs: tensor of shape (episode_len,)
+        distributions: tensor of shape (episode_len, n_actions)
+        """
+        log_probs = self.forward(states)
+        distributions = torch.exp(log_probs)
+        actions = torch.as_tensor(actions, device=self.device).long()
+        log_probs = log_probs.gather(1, actions.view(-1,1)).view(-1)
+        return log_probs, distributions
+    
+    def to_tensor(self, state):
+        return torch.as_tensor(state, device=self.device).to(self.state_dtype)
+    
     def forward(self, state):
         """
         Makes a tensor out of a numpy array state and then forward
@@ -159,141 +275,234 @@ class BoxWorldA2C():
         
         Parameters
         ----------
-        state: array of int
-            Shape (episode_len, in_channels, lin_size, lin_size)
-            Or    (in_channels, lin_size, lin_size)
+        state: array
+            Shape (episode_len, *state_shape) or state_shape
         """
-        state = torch.from_numpy(state).float().to(self.device)
+        state = self.to_tensor(state)
         log_probs = self.actor(state)
         return log_probs
     
-    def update(self, *args):
+    def update(self, *args, **kwargs):
         if self.TD:
-            return self.update_TD(*args)
+            return self.update_TD(*args, **kwargs)
         else:
-            return self.update_MC(*args)
+            return self.update_MC(*args, **kwargs)
+    
+    def update_TD(self, rewards, log_probs, distributions, states, done, bootstrap=None, actions=None):   
+        """
+        If log_probs is None (acting with act), log_probs and distributions are recomputed 
+        from the states and the actions taken.
+        """
+        as_batch = lambda x: None if x is None else [x]
+        return self.update_batch([rewards], as_batch(log_probs), as_batch(distributions), [states], [done], 
+                                 as_batch(bootstrap), as_batch(actions))
     
-    def update_TD(self, rewards, log_probs, distributions, states, done, bootstrap=None):   
+    def update_batch(self, rewards, log_probs, distributions, states, done, bootstrap=None, actions=None, 
+                     bucket_width=None):
+        """
+        Same as update_TD, but for a batch of episodes: every argument is a list with one element
+        per episode. The episodes are packed (see packing.PackedTrajectories, bucket_width included),
+        the n-step targets are computed without crossing the end of any episode, and all the 
+        transitions are used in a single forward/backward pass of each network.
+        """
+        self.n_updates += 1
         
-        ### Compute n-steps rewards, states, discount factors and done mask ###
+        ### Pack the episodes and compute n-steps rewards, states, discount factors and done mask ###
         
-        n_step_rewards = self.compute_n_step_rewards(rewards)
+        packed = PackedTrajectories(rewards, states, done, bootstrap, bucket_width, self.device)
+        n_step_rewards, Gamma_V, done = packed.n_step_targets(self.gamma, self.n_steps)
         if debug:
-            print("n_step_rewards.shape: ", n_step_rewards.shape)
-            print("rewards.shape: ", rewards.shape)
             print("n_step_rewards: ", n_step_rewards)
-            print("rewards: ", rewards)
-            print("bootstrap: ", bootstrap)
-                
-        if bootstrap is not None:
-            done[bootstrap] = False 
-        if debug:
-            print("done.shape: (before n_steps)", done.shape)
-            print("done: (before n_steps)", done)
-        
-        old_states = torch.tensor(states[:-1]).float().to(self.device)
-
-        new_states, Gamma_V, done = self.compute_n_step_states(states, done)
-        new_states = torch.tensor(new_states).float().to(self.device)
-
-        if debug:
-            print("done.shape: (after n_steps)", done.shape)
-            print("Gamma_V.shape: ", Gamma_V.shape)
-            print("done: (after n_steps)", done)
             print("Gamma_V: ", Gamma_V)
-            print("old_states.shape: ", old_states.shape)
-            print("new_states.shape: ", new_states.shape)
-            
+            print("done: (after n_steps)", done)
+        
         ### Wrap variables into tensors ###
         
+        # critic and actor are evaluated on all the packed states, from which old and new ones are gathered
+        states = packed.states.to(self.state_dtype)
+        old_idx = torch.as_tensor(packed.old_idx, device=self.device)
+        new_idx = torch.as_tensor(packed.new_idx, device=self.device)
         done = torch.LongTensor(done.astype(int)).to(self.device)
-        if debug: print("log_probs: ", log_probs)
-        log_probs = torch.stack(log_probs).to(self.device)
-        if debug: print("log_probs: ", log_probs)
-        distributions = torch.stack(distributions, axis=0).to(self.device)
-        mask = (distributions == 0).nonzero()
-        distributions[mask[:,0], mask[:,1]] = 1e-5
-        
-        if debug: print("distributions: ", distributions)
+        if log_probs is not None:
+            log_probs = packed.gather_steps(log_probs).to(self.device)
+            distributions = self.mask_probs(packed.gather_steps(distributions).to(self.device))
+        else:
+            actions = packed.gather_steps(actions)
+            if not self.shared:
+                log_probs, distributions = self.evaluate_actions(states[old_idx], actions)
+                distributions = self.mask_probs(distributions)
         n_step_rewards = torch.tensor(n_step_rewards).float().to(self.device)
         Gamma_V = torch.tensor(Gamma_V).float().to(self.device)
         
+        if self.shared:
+            return self.update_shared_TD(n_step_rewards, log_probs, distributions, actions, states, 
+                                         old_idx, new_idx, done, Gamma_V)
+        
         ### Update critic and then actor ###
-        critic_loss = self.update_critic_TD(n_step_rewards, new_states, old_states, done, Gamma_V)
-        actor_loss, entropy = self.update_actor_TD(n_step_rewards, log_probs, distributions, new_states, old_states, done, Gamma_V)
+        critic_loss = self.update_critic_TD(n_step_rewards, states, old_idx, new_idx, done, Gamma_V)
+        if self.n_updates % self.update_every == 0:
+            actor_loss, entropy = self.update_actor_TD(n_step_rewards, log_probs, distributions, 
+                                                       states, old_idx, new_idx, done, Gamma_V)
+        else:
+            actor_loss = 0
+            entropy = 0
         
         return critic_loss, actor_loss, entropy
     
-    def update_critic_TD(self, n_step_rewards, new_states, old_states, done, Gamma_V):
-        
+    def zero_grad(self, optimizer):
+        # flat gradients are zeroed in place, since the gradients of the parameters are views of them
+        optimizer.zero_grad(set_to_none=not self.flat)
+    
+    def mask_probs(self, distributions):
+        if self.mask_zero_probs:
+            # out of place, since distributions can be part of the graph
+            distributions = torch.where(distributions == 0, torch.full_like(distributions, 1e-5), distributions)
+        return distributions
+    
+    def update_target(self):
+        """
+        Updates critic_target (see targets.TargetNetwork)
+        """
+        self.target.update(self.n_updates)
+    
+    def split_values(self, V, old_idx, new_idx):
+        """
+        Gathers from the critic's predictions V for all the packed states (a tuple of two for 
+        twin critics) the ones of the old states and the target values of the new states, 
+        i.e. the detached minimum of the two predictions for twin critics.
+        """
+        if self.twin:
+            V1, V2 = V[0].squeeze(-1), V[1].squeeze(-1)
+            V_new = torch.min(V1[new_idx], V2[new_idx]).detach()
+            return (V1[old_idx], V2[old_idx]), V_new
+        V = V.squeeze(-1)
+        return V[old_idx], V[new_idx].detach()
+    
+    def update_critic_TD(self, n_step_rewards, states, old_idx, new_idx, done, Gamma_V):
+        """
+        states are all the packed states, old_idx and new_idx the indexes of the old and
+        new (n-step target) states. With a shared target the critic is run once on states,
+        since the n-step target of a state is the old state of a later transition, except 
+        for the last states of the episodes.
+        """
         # Compute loss 
         if debug: print("Updating critic...")
-        with torch.no_grad():
-            V_trg = self.critic_trg(new_states).squeeze()
-            if debug:
-                print("V_trg.shape (after critic): ", V_trg.shape)
-            V_trg = (1-done)*Gamma_V*V_trg + n_step_rewards
-            if debug:
-                print("V_trg.shape (after sum): ", V_trg.shape)
-            V_trg = V_trg.squeeze()
-            if debug:
-                print("V_trg.shape (after squeeze): ", V_trg.shape)
-                print("V_trg.shape (after squeeze): ", V_trg)
+        if self.target.shared:
+            V, V_trg = self.split_values(self.critic(states), old_idx, new_idx)
+        else:
+            with torch.no_grad():
+                V_trg = self.critic_trg(states[new_idx]).squeeze(-1)
+            V = self.critic(states[old_idx])
+        V_trg = (1-done)*Gamma_V*V_trg + n_step_rewards
+        if debug:
+            print("V_trg.shape: ", V_trg.shape)
             
         if self.twin:
-            V1, V2 = self.critic(old_states)
-            if debug:
-                print("V1.shape: ", V1.squeeze().shape)
-                print("V1: ", V1)
-            loss1 = 0.5*F.mse_loss(V1.squeeze(), V_trg)
-            loss2 = 0.5*F.mse_loss(V2.squeeze(), V_trg)
+            V1, V2 = V
+            loss1 = 0.5*F.mse_loss(V1.view(-1), V_trg)
+            loss2 = 0.5*F.mse_loss(V2.view(-1), V_trg)
             loss = loss1 + loss2
         else:
-            V = self.critic(old_states).squeeze()
+            V = V.view(-1)
             if debug: 
                 print("V.shape: ",  V.shape)
-                print("V: ",  V)
             loss = F.mse_loss(V, V_trg)
         
         # Backpropagate and update
         
-        self.critic_optim.zero_grad()
+        self.zero_grad(self.critic_optim)
         loss.backward()
         self.critic_optim.step()
         
-        # Update critic_target: (1-tau)*old + tau*new
-        
-        for trg_params, params in zip(self.critic_trg.parameters(), self.critic.parameters()):
-                trg_params.data.copy_((1.-self.tau)*trg_params.data + self.tau*params.data)
+        self.update_target()
         
         return loss.item()
     
-    def update_actor_TD(self, n_step_rewards, log_probs, distributions, new_states, old_states, done, Gamma_V):
+    def update_shared_TD(self, n_step_rewards, log_probs, distributions, actions, states, old_idx, new_idx, 
+                         done, Gamma_V):
+        """
+        Updates the shared network with the sum of the critic and actor losses. If log_probs is
+        None, they are computed from the actions in the same forward of the critic's predictions
+        (on all the states with a shared target, otherwise on the old states only).
+        """
+        if self.target.shared:
+            if log_probs is None:
+                log_probs, V = self.actor(states, values=True)
+                log_probs = log_probs[old_idx]
+            else:
+                V = self.critic.value(states)
+            V, V_trg = self.split_values(V, old_idx, new_idx)
+        else:
+            old_states = states[old_idx]
+            if log_probs is None:
+                log_probs, V = self.actor(old_states, values=True)
+            else:
+                V = self.critic.value(old_states)
+            with torch.no_grad():
+                V_trg = self.critic_trg.value(states[new_idx]).squeeze(-1)
+        if actions is not None:
+            distributions = self.mask_probs(torch.exp(log_probs))
+            actions = torch.as_tensor(actions, device=self.device).long()
+            log_probs = log_probs.gather(1, actions.view(-1,1)).view(-1)
+        V_trg = (1-done)*Gamma_V*V_trg + n_step_rewards
+        
+        # Critic loss
+        if self.twin:
+            V1, V2 = V[0].view(-1), V[1].view(-1)
+            critic_loss = 0.5*F.mse_loss(V1, V_trg) + 0.5*F.mse_loss(V2, V_trg)
+            V_pred = torch.min(V1, V2).detach()
+        else:
+            V = V.view(-1)
+            critic_loss = F.mse_loss(V, V_trg)
+            V_pred = V.detach()
+        
+        # Actor loss, with negative entropy (no - in front)
+        A = V_trg - V_pred
+        policy_grad = torch.mean(- log_probs*A)
+        entropy = self.H*torch.mean(distributions*torch.log(distributions))
+        
+        loss = critic_loss + policy_grad + entropy
+        if debug: print("Shared loss: ", loss)
+        
+        # Backpropagate and update
+        
+        self.zero_grad(self.actor_optim)
+        loss.backward()
+        self.actor_optim.step()
+        
+        self.update_target()
+        
+        return critic_loss.item(), policy_grad.item(), entropy.item()
+    
+    def get_values(self, states, target=False):
+        """
+        State values predicted by the critic (or by the critic target), using the minimum
+        of the two predictions for twin critics.
+        """
+        if target and not self.target.shared:
+            critic = self.critic_trg.value if self.shared else self.critic_trg
+            return critic(states).squeeze(-1)
+        critic = self.critic.value if self.shared else self.critic
+        if self.twin:
+            V1, V2 = critic(states)
+            return torch.min(V1.squeeze(-1), V2.squeeze(-1))
+        return critic(states).squeeze(-1)
+    
+    def update_actor_TD(self, n_step_rewards, log_probs, distributions, states, old_idx, new_idx, done, Gamma_V):
         
         # Compute gradient 
         if debug: print("Updating actor...")
         with torch.no_grad():
-            if self.twin:
-                V1, V2 = self.critic(old_states)
-                V_pred = torch.min(V1.squeeze(), V2.squeeze())
-                V1_new, V2_new = self.critic(new_states)
-                V_new = torch.min(V1_new.squeeze(), V2_new.squeeze())
-                V_trg = (1-done)*Gamma_V*V_new + n_step_rewards
-            else:
-                V_pred = self.critic(old_states).squeeze()
-                V_trg = (1-done)*Gamma_V*self.critic(new_states).squeeze()  + n_step_rewards
+            # old and new states in a single critic call
+            V = self.get_values(states, self.use_target)
+            V_pred, V_new = V[old_idx], V[new_idx]
+            V_trg = (1-done)*Gamma_V*V_new + n_step_rewards
         
         A = V_trg - V_pred
         policy_gradient = - log_probs*A
         if debug:
-            print("V_trg.shape: ",V_trg.shape)
-            print("V_trg: ", V_trg)
-            print("V_pred.shape: ",V_pred.shape)
-            print("V_pred: ", V_pred)
             print("A.shape: ", A.shape)
-            print("A: ", A)
             print("policy_gradient.shape: ", policy_gradient.shape)
-            print("policy_gradient: ", policy_gradient)
         policy_grad = torch.mean(policy_gradient)
         if debug: print("policy_grad: ", policy_grad)
             
@@ -306,90 +515,23 @@ class BoxWorldA2C():
         
         # Backpropagate and update
     
-        self.actor_optim.zero_grad()
+        self.zero_grad(self.actor_optim)
         loss.backward()
         self.actor_optim.step()
         
         return policy_grad.item(), entropy.item()
     
-    def compute_n_step_rewards(self, rewards):
-        """
-        Computes n-steps discounted reward padding with zeros the last elements of the trajectory.
-        This means that the rewards considered are AT MOST n, but can be less for the last n-1 elements.
-        """
-        T = len(rewards)
-        
-        # concatenate n_steps zeros to the rewards -> they do not change the cumsum
-        r = np.concatenate((rewards,[0 for _ in range(self.n_steps)])) 
-        
-        Gamma = np.array([self.gamma**i for i in range(r.shape[0])])
-        
-        # reverse everything to use cumsum in right order, then reverse again
-        Gt = np.cumsum(r[::-1]*Gamma[::-1])[::-1]
-        
-        G_nstep = Gt[:T] - Gt[self.n_steps:] # compute n-steps discounted return
-        
-        Gamma = Gamma[:T]
-        
-        assert len(G_nstep) == T, "Something went wrong computing n-steps reward"
-        
-        n_steps_r = G_nstep / Gamma
-        
-        return n_steps_r
-    
-    def compute_n_step_states(self, states, done):
-        """
-        Computes n-steps target states (to be used by the critic as target values together with the
-        n-steps discounted reward). For last n-1 elements the target state is the last one available.
-        Adjusts also the `done` mask used for disabling the bootstrapping in the case of terminal states
-        and returns Gamma_V, that are the discount factors for the target state-values, since they are 
-        n-steps away (except for the last n-1 states, whose discount is adjusted accordingly).
-        
-        Return
-        ------
-        new_states, Gamma_V, done: arrays with first dimension = len(states)-1
-        """
-        
-        # Compute indexes for (at most) n-step away states 
-        
-        n_step_idx = np.arange(len(states)-1) + self.n_steps
-        diff = n_step_idx - len(states) + 1
-        mask = (diff > 0)
-        n_step_idx[mask] = len(states) - 1
-        
-        # Compute new states
-        
-        new_states = states[n_step_idx]
-        
-        # Compute discount factors
-        
-        pw = np.array([self.n_steps for _ in range(len(new_states))])
-        pw[mask] = self.n_steps - diff[mask]
-        Gamma_V = self.gamma**pw
-        
-        # Adjust done mask
+    def update_MC(self, rewards, log_probs, distributions, states, done, bootstrap=None, actions=None):   
         
-        mask = (diff >= 0)
-        done[mask] = done[-1]
-        
-        return new_states, Gamma_V, done
-    
-    def update_MC(self, rewards, log_probs, states, done, bootstrap=None):   
-        print("states: ", states.shape)
         ### Compute MC discounted returns ###
         
         if bootstrap is not None:
             
             if bootstrap[-1] == True:
             
-                last_state = torch.tensor(states[-1].astype(int)).to(self.device).unsqueeze(0)
-                print("last_state: ", last_state.shape)
-                
-                if self.twin:
-                    V1, V2 = self.critic(last_state)
-                    V_bootstrap = torch.min(V1, V2).cpu().detach().numpy().reshape(1,)
-                else:
-                    V_bootstrap = self.critic(last_state).cpu().detach().numpy().reshape(1,)
+                last_state = self.to_tensor(states[-1]).unsqueeze(0)
+                with torch.no_grad():
+                    V_bootstrap = self.get_values(last_state).cpu().numpy().reshape(1,)
  
                 rewards = np.concatenate((rewards, V_bootstrap))
                 
@@ -407,10 +549,11 @@ class BoxWorldA2C():
         
         dr = torch.tensor(discounted_rewards).float().to(self.device) 
         
-        old_states = torch.tensor(states[:-1].astype(int)).to(self.device)
-        new_states = torch.tensor(states[1:].astype(int)).to(self.device)
-        done = torch.LongTensor(done.astype(int)).to(self.device)
-        log_probs = torch.stack(log_probs).to(self.device)
+        old_states = self.to_tensor(states[:-1])
+        if log_probs is None:
+            log_probs, _ = self.evaluate_actions(old_states, actions)
+        else:
+            log_probs = torch.stack(log_probs).to(self.device)
         
         ### Update critic and then actor ###
         
@@ -423,17 +566,12 @@ class BoxWorldA2C():
 
         # Compute loss
         
-        if self.twin:
-            V1, V2 = self.critic(old_states)
-            V_pred = torch.min(V1.squeeze(), V2.squeeze())
-        else:
-            V_pred = self.critic(old_states).squeeze()
-            
+        V_pred = self.get_values(old_states)
         loss = F.mse_loss(V_pred, dr)
         
         # Backpropagate and update
         
-        self.critic_optim.zero_grad()
+        self.zero_grad(self.critic_optim)
         loss.backward()
         self.critic_optim.step()
         
@@ -443,11 +581,8 @@ class BoxWorldA2C():
         
         # Compute gradient 
         
-        if self.twin:
-            V1, V2 = self.critic(old_states)
-            V_pred = torch.min(V1.squeeze(), V2.squeeze())
-        else:
-            V_pred = self.critic(old_states).squeeze()
+        with torch.no_grad():
+            V_pred = self.get_values(old_states)
             
         A = dr - V_pred
         policy_gradient = - log_probs*A
@@ -455,10 +590,62 @@ class BoxWorldA2C():
  
         # Backpropagate and update
     
-        self.actor_optim.zero_grad()
+        self.zero_grad(self.actor_optim)
         policy_grad.backward()
         self.actor_optim.step()
         
         return policy_grad.item()
 
+class BoxWorldA2C(A2C):
+    """
+    Advantage Actor-Critic RL agent for BoxWorld environment described in the paper
+    Relational Deep Reinforcement Learning.
     
+    Preset of A2C with BoxWorldActor and BoxWorldCritic networks.
+    """ 
+    
+    def __init__(self, action_space, lr, gamma, TD=True, twin=False, tau = 1., 
+                 H=1e-2, n_steps = 1, device='cpu', actor_lr=None, critic_lr=None, radam=False, shared=False, 
+                 target_mode='soft', target_period=1, flat=False, vectorize_twin=None, **box_net_args):
+        """
+        Parameters
+        ----------
+        action_space, lr, gamma, TD, twin, tau, H, n_steps, device, actor_lr, critic_lr, radam:
+            See A2C
+        shared: bool (default False)
+            If True, actor and critic share the same BoxWorldNet trunk (see A2C, shared_fn)
+        target_mode, target_period, flat:
+            See A2C
+        vectorize_twin: bool (default None)
+            Passed as vectorize to the twin critics (see AC_networks.twin_forward)
+        **box_net_args: dict (optional)
+            Dictionary of {'key':value} pairs valid for BoxWorldNet.
+            Valid keys:
+                in_channels: int (default 3)
+                    Number of channels of the input image (e.g. 3 for RGB)
+                n_kernels: int (default 24)
+                    Number of features extracted for each pixel
+                vocab_size: int (default 116)
+                    Range of integer values of the raw pixels
+                n_dim: int (default 3)
+                    Embedding dimension for each pixel channel (1 channel for greyscale, 
+                    3 for RGB)
+                n_features: int (default 256)
+                    Number of linearly projected features after positional encoding.
+                    This is the number of features used during the Multi-Headed Attention
+                    (MHA) blocks
+                n_heads: int (default 4)
+                    Number of heades in each MHA block
+                n_attn_modules: int (default 2)
+                    Number of MHA blocks
+                n_linears: int (default 4)
+                    Number of fully-connected layers after the FeaturewiseMaxPool layer
+        """
+        if shared:
+            shared_fn = lambda twin, target: SharedActorCritic(rnet.BoxWorldNet(**box_net_args), action_space, twin, target)
+        else:
+            shared_fn = None
+        super().__init__(lambda: BoxWorldActor(action_space, **box_net_args),
+                         lambda twin, target: BoxWorldCritic(twin, target=target, vectorize=vectorize_twin, **box_net_args),
+                         action_space, lr, gamma, TD, twin, tau, H, n_steps, device, actor_lr, critic_lr, radam,
+                         shared_fn=shared_fn, target_mode=target_mode, target_period=target_period, flat=flat)
@@ -2,6 +2,8 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F 
+
+from RelationalModule.AC_networks import twin_forward
     
 class Actor(nn.Module):
     """
@@ -92,11 +94,13 @@ class BasicCritic(nn.Module):
     
 class Critic(nn.Module):
     """Implements a generic critic, that can have 2 independent networks is twin=True. """
-    def __init__(self, observation_space, discrete=False, project_dim=4, twin=False, target=False, hiddens=[64,32]):
+    def __init__(self, observation_space, discrete=False, project_dim=4, twin=False, target=False, hiddens=[64,32],
+                 vectorize=None):
         super(Critic, self).__init__()
         
         self.twin = twin
         self.target = target
+        self.vectorize = vectorize
         
         if twin:
             self.net1 = BasicCritic(observation_space, discrete, project_dim, hiddens)
@@ -106,8 +110,7 @@ class Critic(nn.Module):
         
     def forward(self, state):
         if self.twin:
-            v1 = self.net1(state)
-            v2 = self.net2(state)
+            v1, v2 = twin_forward(self.net1, self.net2, state, getattr(self, 'vectorize', None))
             if self.target:
                 v = torch.min(v1, v2) # one could also try with the mean, for a less unbiased estimate
             else:
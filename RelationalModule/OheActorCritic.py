@@ -1,463 +1,43 @@
-import numpy as np
-import torch
-import torch.nn as nn
-import torch.nn.functional as F 
-from torch.distributions import Categorical
+from RelationalModule.AC_networks import OheActor, OheCritic, SharedActorCritic #custom module
+from RelationalModule import ControlNetworks as cnet
+from RelationalModule.ActorCritic import A2C
 
-from RelationalModule.AC_networks import OheActor, OheCritic #custom module
-from RelationalModule.RAdam import RAdam
-
-debug = False
-
-class OheA2C():
+class OheA2C(A2C):
     """
-    Advantage Actor-Critic RL agent for BoxWorld environment described in the paper
-    Relational Deep Reinforcement Learning.
+    Advantage Actor-Critic RL agent for the Sandbox environment with one-hot encoded states.
     
-    Notes
-    -----
-    * GPU implementation is still work in progress.
-    * Always uses 2 separate networks for the critic,one that learns from new experience 
-      (student/critic) and the other one (critic_target/teacher)that is more conservative 
-      and whose weights are updated through an exponential moving average of the weights 
-      of the critic, i.e.
-          target.params = (1-tau)*target.params + tau* critic.params
-    * In the case of Monte Carlo estimation the critic_target is never used
-    * Possible to use twin networks for the critic and the critic target for improved 
-      stability. Critic target is used for updates of both the actor and the critic and
-      its output is the minimum between the predictions of its two internal networks.
-      
+    Preset of A2C with OheActor and OheCritic networks. Zero probabilities are not masked
+    in the entropy term.
     """ 
     
-    def __init__(self, action_space, map_size, lr, gamma, TD=True, twin=False, tau = 1., 
-                 H=1e-2, n_steps = 1, device='cpu', actor_lr=None, critic_lr=None, radam=False, **control_net_args):
-        """
-        Parameters
-        ----------
-        action_space: int
-            Number of (discrete) possible actions to take
-        lr: float in [0,1]
-            Learning rate
-        gamma: float in [0,1]
-            Discount factor
-        TD: bool (default=True)
-            If True, uses Temporal Difference for the critic's estimates
-            Otherwise uses Monte Carlo estimation
-        twin: bool (default=False)
-            Enables twin networks both for critic and critic_target
-        tau: float in [0,1] (default = 1.)
-            Regulates how fast the critic_target gets updates, i.e. what percentage of the weights
-            inherits from the critic. If tau=1., critic and critic_target are identical 
-            at every step, if tau=0. critic_target is unchangable. 
-            As a default this feature is disabled setting tau = 1, but if one wants to use it a good
-            empirical value is 0.005.
-        H: float (default 1e-2)
-            Entropy multiplicative factor in actor's loss
-        n_steps: int (default=1)
-            Number of steps considered in TD update
-        device: str in {'cpu','cuda'}
-            Implemented, but GPU slower than CPU because it's difficult to optimize a RL agent without
-            a replay buffer, that can be used only in off-policy algorithms.
-        **box_net_args: dict (optional)
-            Dictionary of {'key':value} pairs valid for BoxWorldNet.
-            Valid keys:
-                in_channels: int (default 3)
-                    Number of channels of the input image (e.g. 3 for RGB)
-                n_kernels: int (default 24)
-                    Number of features extracted for each pixel
-                vocab_size: int (default 116)
-                    Range of integer values of the raw pixels
-                n_dim: int (default 3)
-                    Embedding dimension for each pixel channel (1 channel for greyscale, 
-                    3 for RGB)
-                n_features: int (default 256)
-                    Number of linearly projected features after positional encoding.
-                    This is the number of features used during the Multi-Headed Attention
-                    (MHA) blocks
-                n_heads: int (default 4)
-                    Number of heades in each MHA block
-                n_attn_modules: int (default 2)
-                    Number of MHA blocks
-                n_linears: int (default 4)
-                    Number of fully-connected layers after the FeaturewiseMaxPool layer
-        """
-        
-        self.gamma = gamma
-        self.lr = lr
-        
-        self.n_actions = action_space
-        self.TD = TD
-        self.twin = twin 
-        self.tau = tau
-        self.n_steps = n_steps
-        self.H = H
-        
-        self.actor = OheActor(action_space, map_size, **control_net_args)
-        self.critic = OheCritic(map_size, twin, **control_net_args)
-        
-        if self.TD:
-            self.critic_trg = OheCritic(map_size, twin, target=True, **control_net_args)
-
-            # Init critic target identical to critic
-            for trg_params, params in zip(self.critic_trg.parameters(), self.critic.parameters()):
-                trg_params.data.copy_(params.data)
-            
-        if radam:
-            self.optimizer = RAdam
-        else:
-            self.optimizer = torch.optim.Adam
-
-
-        if actor_lr is not None:
-            self.actor_optim = self.optimizer(self.actor.parameters(), lr=actor_lr)
-        else:
-            self.actor_optim = self.optimizer(self.actor.parameters(), lr=lr)
-        
-        if critic_lr is not None:
-            self.critic_optim = self.optimizer(self.critic.parameters(), lr=critic_lr)
-        else:
-            self.critic_optim = self.optimizer(self.critic.parameters(), lr=lr)
-        
-        self.device = device 
-        self.actor.to(self.device) 
-        self.critic.to(self.device)
-        if self.TD:
-            self.critic_trg.to(self.device)
-        
-        if debug:
-            print("="*10 +" A2C HyperParameters "+"="*10)
-            print("Discount factor: ", self.gamma)
-            print("Learning rate: ", self.lr)
-            print("Action space: ", self.n_actions)
-            print("Temporal Difference learning: ", self.TD)
-            print("Twin networks: ", self.twin)
-            print("Update critic target factor: ", self.tau)
-            if self.TD:
-                print("n_steps for TD: ", self.n_steps)
-            print("Device used: ", self.device)
-            print("\n\n"+"="*10 +" A2C Architecture "+"="*10)
-            print("Actor architecture: \n", self.actor)
-            print("Critic architecture: \n",self.critic)
-            print("Critic target architecture: ")
-            if self.TD:
-                print(self.critic_trg)
-            else:
-                print("Not used")
-        
-    def get_action(self, state, return_log=False):
-        log_probs = self.forward(state)
-        dist = torch.exp(log_probs)
-        probs = Categorical(dist)
-        action =  probs.sample().item()
-        if return_log:
-            return action, log_probs.view(-1)[action], dist
-        else:
-            return action
+    LEGACY_DEFAULTS = dict(A2C.LEGACY_DEFAULTS, mask_zero_probs=False)
     
-    def forward(self, state):
+    def __init__(self, action_space, map_size, lr, gamma, TD=True, twin=False, tau = 1., 
+                 H=1e-2, n_steps = 1, device='cpu', actor_lr=None, critic_lr=None, radam=False, shared=False,
+                 target_mode='soft', target_period=1, flat=False, vectorize_twin=None, **control_net_args):
         """
-        Makes a tensor out of a numpy array state and then forward
-        it with the actor network.
-        
         Parameters
         ----------
-        state: array of int
-            Shape (episode_len, in_channels, lin_size, lin_size)
-            Or    (in_channels, lin_size, lin_size)
-        """
-        state = torch.from_numpy(state).float().to(self.device)
-        log_probs = self.actor(state)
-        return log_probs
-    
-    def update(self, *args):
-        if self.TD:
-            return self.update_TD(*args)
-        else:
-            return self.update_MC(*args)
-    
-    def update_TD(self, rewards, log_probs, distributions, states, done, bootstrap=None):   
-        
-        ### Compute n-steps rewards, states, discount factors and done mask ###
-        
-        n_step_rewards = self.compute_n_step_rewards(rewards)
-        if debug:
-            print("n_step_rewards.shape: ", n_step_rewards.shape)
-            print("rewards.shape: ", rewards.shape)
-            print("n_step_rewards: ", n_step_rewards)
-            print("rewards: ", rewards)
-            print("bootstrap: ", bootstrap)
-                
-        if bootstrap is not None:
-            done[bootstrap] = False 
-        if debug:
-            print("done.shape: (before n_steps)", done.shape)
-            print("done: (before n_steps)", done)
-        
-        old_states = torch.tensor(states[:-1]).float().to(self.device)
-
-        new_states, Gamma_V, done = self.compute_n_step_states(states, done)
-        new_states = torch.tensor(new_states).float().to(self.device)
-
-        if debug:
-            print("done.shape: (after n_steps)", done.shape)
-            print("Gamma_V.shape: ", Gamma_V.shape)
-            print("done: (after n_steps)", done)
-            print("Gamma_V: ", Gamma_V)
-            print("old_states.shape: ", old_states.shape)
-            print("new_states.shape: ", new_states.shape)
-            
-        ### Wrap variables into tensors ###
-        
-        done = torch.LongTensor(done.astype(int)).to(self.device)
-        if debug: print("log_probs: ", log_probs)
-        log_probs = torch.stack(log_probs).to(self.device)
-        if debug: print("log_probs: ", log_probs)
-        distributions = torch.stack(distributions, axis=0).to(self.device)
-        if debug: print("distributions: ", distributions)
-        n_step_rewards = torch.tensor(n_step_rewards).float().to(self.device)
-        Gamma_V = torch.tensor(Gamma_V).float().to(self.device)
-        
-        ### Update critic and then actor ###
-        critic_loss = self.update_critic_TD(n_step_rewards, new_states, old_states, done, Gamma_V)
-        actor_loss, entropy = self.update_actor_TD(n_step_rewards, log_probs, distributions, new_states, old_states, done, Gamma_V)
-        
-        return critic_loss, actor_loss, entropy
-    
-    def update_critic_TD(self, n_step_rewards, new_states, old_states, done, Gamma_V):
-        
-        # Compute loss 
-        if debug: print("Updating critic...")
-        with torch.no_grad():
-            V_trg = self.critic_trg(new_states).squeeze()
-            if debug:
-                print("V_trg.shape (after critic): ", V_trg.shape)
-            V_trg = (1-done)*Gamma_V*V_trg + n_step_rewards
-            if debug:
-                print("V_trg.shape (after sum): ", V_trg.shape)
-            V_trg = V_trg.squeeze()
-            if debug:
-                print("V_trg.shape (after squeeze): ", V_trg.shape)
-                print("V_trg.shape (after squeeze): ", V_trg)
-            
-        if self.twin:
-            V1, V2 = self.critic(old_states)
-            if debug:
-                print("V1.shape: ", V1.squeeze().shape)
-                print("V1: ", V1)
-            loss1 = 0.5*F.mse_loss(V1.squeeze(), V_trg)
-            loss2 = 0.5*F.mse_loss(V2.squeeze(), V_trg)
-            loss = loss1 + loss2
-        else:
-            V = self.critic(old_states).squeeze()
-            if debug: 
-                print("V.shape: ",  V.shape)
-                print("V: ",  V)
-            loss = F.mse_loss(V, V_trg)
-        
-        # Backpropagate and update
-        
-        self.critic_optim.zero_grad()
-        loss.backward()
-        self.critic_optim.step()
-        
-        # Update critic_target: (1-tau)*old + tau*new
-        
-        for trg_params, params in zip(self.critic_trg.parameters(), self.critic.parameters()):
-                trg_params.data.copy_((1.-self.tau)*trg_params.data + self.tau*params.data)
-        
-        return loss.item()
-    
-    def update_actor_TD(self, n_step_rewards, log_probs, distributions, new_states, old_states, done, Gamma_V):
-        
-        # Compute gradient 
-        if debug: print("Updating actor...")
-        with torch.no_grad():
-            if self.twin:
-                V1, V2 = self.critic(old_states)
-                V_pred = torch.min(V1.squeeze(), V2.squeeze())
-                V1_new, V2_new = self.critic(new_states)
-                V_new = torch.min(V1_new.squeeze(), V2_new.squeeze())
-                V_trg = (1-done)*Gamma_V*V_new + n_step_rewards
-            else:
-                V_pred = self.critic(old_states).squeeze()
-                V_trg = (1-done)*Gamma_V*self.critic(new_states).squeeze()  + n_step_rewards
-        
-        A = V_trg - V_pred
-        policy_gradient = - log_probs*A
-        if debug:
-            print("V_trg.shape: ",V_trg.shape)
-            print("V_trg: ", V_trg)
-            print("V_pred.shape: ",V_pred.shape)
-            print("V_pred: ", V_pred)
-            print("A.shape: ", A.shape)
-            print("A: ", A)
-            print("policy_gradient.shape: ", policy_gradient.shape)
-            print("policy_gradient: ", policy_gradient)
-        policy_grad = torch.mean(policy_gradient)
-        if debug: print("policy_grad: ", policy_grad)
-            
-        # Compute negative entropy (no - in front)
-        entropy = self.H*torch.mean(distributions*torch.log(distributions))
-        if debug: print("Negative entropy: ", entropy)
-        
-        loss = policy_grad + entropy
-        if debug: print("Actor loss: ", loss)
-        
-        # Backpropagate and update
-    
-        self.actor_optim.zero_grad()
-        loss.backward()
-        self.actor_optim.step()
-        
-        return policy_grad.item(), entropy.item()
-    
-    def compute_n_step_rewards(self, rewards):
-        """
-        Computes n-steps discounted reward padding with zeros the last elements of the trajectory.
-        This means that the rewards considered are AT MOST n, but can be less for the last n-1 elements.
-        """
-        T = len(rewards)
-        
-        # concatenate n_steps zeros to the rewards -> they do not change the cumsum
-        r = np.concatenate((rewards,[0 for _ in range(self.n_steps)])) 
-        
-        Gamma = np.array([self.gamma**i for i in range(r.shape[0])])
-        
-        # reverse everything to use cumsum in right order, then reverse again
-        Gt = np.cumsum(r[::-1]*Gamma[::-1])[::-1]
-        
-        G_nstep = Gt[:T] - Gt[self.n_steps:] # compute n-steps discounted return
-        
-        Gamma = Gamma[:T]
-        
-        assert len(G_nstep) == T, "Something went wrong computing n-steps reward"
-        
-        n_steps_r = G_nstep / Gamma
-        
-        return n_steps_r
-    
-    def compute_n_step_states(self, states, done):
-        """
-        Computes n-steps target states (to be used by the critic as target values together with the
-        n-steps discounted reward). For last n-1 elements the target state is the last one available.
-        Adjusts also the `done` mask used for disabling the bootstrapping in the case of terminal states
-        and returns Gamma_V, that are the discount factors for the target state-values, since they are 
-        n-steps away (except for the last n-1 states, whose discount is adjusted accordingly).
-        
-        Return
-        ------
-        new_states, Gamma_V, done: arrays with first dimension = len(states)-1
-        """
-        
-        # Compute indexes for (at most) n-step away states 
-        
-        n_step_idx = np.arange(len(states)-1) + self.n_steps
-        diff = n_step_idx - len(states) + 1
-        mask = (diff > 0)
-        n_step_idx[mask] = len(states) - 1
-        
-        # Compute new states
-        
-        new_states = states[n_step_idx]
-        
-        # Compute discount factors
-        
-        pw = np.array([self.n_steps for _ in range(len(new_states))])
-        pw[mask] = self.n_steps - diff[mask]
-        Gamma_V = self.gamma**pw
-        
-        # Adjust done mask
-        
-        mask = (diff >= 0)
-        done[mask] = done[-1]
-        
-        return new_states, Gamma_V, done
-    
-    def update_MC(self, rewards, log_probs, states, done, bootstrap=None):   
-        print("states: ", states.shape)
-        ### Compute MC discounted returns ###
-        
-        if bootstrap is not None:
-            
-            if bootstrap[-1] == True:
-            
-                last_state = torch.tensor(states[-1].astype(int)).to(self.device).unsqueeze(0)
-                print("last_state: ", last_state.shape)
-                
-                if self.twin:
-                    V1, V2 = self.critic(last_state)
-                    V_bootstrap = torch.min(V1, V2).cpu().detach().numpy().reshape(1,)
-                else:
-                    V_bootstrap = self.critic(last_state).cpu().detach().numpy().reshape(1,)
- 
-                rewards = np.concatenate((rewards, V_bootstrap))
-                
-        Gamma = np.array([self.gamma**i for i in range(rewards.shape[0])])
-        # reverse everything to use cumsum in right order, then reverse again
-        Gt = np.cumsum(rewards[::-1]*Gamma[::-1])[::-1]
-        # Rescale so that present reward is never discounted
-        discounted_rewards =  Gt/Gamma
-        
-        if bootstrap is not None:
-            if bootstrap[-1] == True:
-                discounted_rewards = discounted_rewards[:-1] # drop last
-
-        ### Wrap variables into tensors ###
-        
-        dr = torch.tensor(discounted_rewards).float().to(self.device) 
-        
-        old_states = torch.tensor(states[:-1].astype(int)).to(self.device)
-        new_states = torch.tensor(states[1:].astype(int)).to(self.device)
-        done = torch.LongTensor(done.astype(int)).to(self.device)
-        log_probs = torch.stack(log_probs).to(self.device)
-        
-        ### Update critic and then actor ###
-        
-        critic_loss = self.update_critic_MC(dr, old_states)
-        actor_loss = self.update_actor_MC(dr, log_probs, old_states)
-        
-        return critic_loss, actor_loss
-    
-    def update_critic_MC(self, dr, old_states):
-
-        # Compute loss
-        
-        if self.twin:
-            V1, V2 = self.critic(old_states)
-            V_pred = torch.min(V1.squeeze(), V2.squeeze())
-        else:
-            V_pred = self.critic(old_states).squeeze()
-            
-        loss = F.mse_loss(V_pred, dr)
-        
-        # Backpropagate and update
-        
-        self.critic_optim.zero_grad()
-        loss.backward()
-        self.critic_optim.step()
-        
-        return loss.item()
-    
-    def update_actor_MC(self, dr, log_probs, old_states):
-        
-        # Compute gradient 
-        
-        if self.twin:
-            V1, V2 = self.critic(old_states)
-            V_pred = torch.min(V1.squeeze(), V2.squeeze())
-        else:
-            V_pred = self.critic(old_states).squeeze()
-            
-        A = dr - V_pred
-        policy_gradient = - log_probs*A
-        policy_grad = torch.sum(policy_gradient)
- 
-        # Backpropagate and update
-    
-        self.actor_optim.zero_grad()
-        policy_grad.backward()
-        self.actor_optim.step()
-        
-        return policy_grad.item()
-
-    
+        map_size: int
+            Linear size of the (square) map
+        action_space, lr, gamma, TD, twin, tau, H, n_steps, device, actor_lr, critic_lr, radam:
+            See A2C
+        shared: bool (default False)
+            If True, actor and critic share the same OheNet trunk (see A2C, shared_fn)
+        target_mode, target_period, flat:
+            See A2C
+        vectorize_twin: bool (default None)
+            Passed as vectorize to the twin critics (see AC_networks.twin_forward)
+        **control_net_args: dict (optional)
+            Arguments of OheActor and OheCritic
+        """
+        if shared:
+            shared_fn = lambda twin, target: SharedActorCritic(cnet.OheNet(map_size, **control_net_args), action_space, twin, target)
+        else:
+            shared_fn = None
+        super().__init__(lambda: OheActor(action_space, map_size, **control_net_args),
+                         lambda twin, target: OheCritic(map_size, twin, target=target, 
+                                                        vectorize=vectorize_twin, **control_net_args),
+                         action_space, lr, gamma, TD, twin, tau, H, n_steps, device, actor_lr, critic_lr, radam,
+                         mask_zero_probs=False, shared_fn=shared_fn, target_mode=target_mode, 
+                         target_period=target_period, flat=flat)
@@ -0,0 +1,122 @@
+import copy
+import torch
+import torch.nn as nn
+
+class FlatParameters():
+    """
+    Parameters and gradients of a network backed by two flat contiguous buffers.
+
+    Notes
+    -----
+    * Every parameter of the network becomes a view of data and its gradient a view of grad,
+      so that operations on all the parameters (target averaging, snapshots, copies to other
+      networks or processes) are a single vector operation or memcpy on data.
+    * The parameters are laid out group after group (e.g. trunk and heads of a shared network,
+      that have different learning rates). The optimizer works on params, one leaf tensor per
+      group, that is the slice of data of the group and has the slice of grad as gradient:
+      element-wise optimizers (Adam, RAdam) then update a whole group in one step, with the
+      same result as on the single parameters.
+    * Gradients must be zeroed in place (zero_grad(set_to_none=False)), since gradients set to
+      None would not be views of grad anymore.
+    * Networks must be moved to their device before being flattened. Deep copies of flat
+      networks aren't flat (see copy_network).
+    """
+    def __init__(self, module, groups=None, grad=True):
+        """
+        Parameters
+        ----------
+        module: nn.Module
+            Network to flatten
+        groups: list of lists of str (default None)
+            Names of the parameters (as in module.named_parameters()) of every group.
+            If None all the parameters are in a single group
+        grad: bool (default True)
+            If False no gradient buffer is allocated (e.g. for target networks)
+        """
+        named_params = dict(module.named_parameters())
+        if groups is None:
+            groups = [list(named_params)]
+        assert sorted(sum(groups, [])) == sorted(named_params), "Every parameter must be in exactly one group"
+        assert len({(p.dtype, p.device) for p in named_params.values()}) == 1, "Parameters must have the same dtype and device"
+        self.groups = groups
+
+        p0 = next(iter(named_params.values()))
+        numel = sum(p.numel() for p in named_params.values())
+        self.data = torch.empty(numel, dtype=p0.dtype, device=p0.device)
+        self.grad = torch.zeros_like(self.data) if grad else None
+
+        self.params = []
+        offset = 0
+        for group in groups:
+            start = offset
+            for name in group:
+                p = named_params[name]
+                n = p.numel()
+                self.data[offset:offset+n].copy_(p.data.reshape(-1))
+                p.data = self.data[offset:offset+n].view_as(p)
+                if grad:
+                    p.grad = self.grad[offset:offset+n].view_as(p)
+                offset += n
+            params = nn.Parameter(self.data[start:offset])
+            if grad:
+                params.grad = self.grad[start:offset]
+            self.params.append(params)
+
+    def __deepcopy__(self, memo):
+        # deep copies of the parameters are not views of the buffers anymore
+        return None
+
+def flatten(module, groups=None, grad=True):
+    """
+    Backs the parameters of module with flat buffers, stored in module.flat (see FlatParameters).
+    """
+    module.flat = FlatParameters(module, groups, grad)
+    return module.flat
+
+def is_flat(module):
+    return getattr(module, 'flat', None) is not None
+
+def copy_network(module, device=None):
+    """
+    Deep copy of module (moved to device, if not None), flattened as module if it is flat.
+    """
+    network = copy.deepcopy(module)
+    if device is not None:
+        network.to(device)
+    if is_flat(module):
+        flatten(network, module.flat.groups, grad=False)
+    return network
+
+@torch.no_grad()
+def copy_parameters(target, source):
+    """
+    Copies parameters and buffers of source into target (same architecture), with a single
+    copy of the parameters if both networks are flat.
+    """
+    if is_flat(target) and is_flat(source):
+        target.flat.data.copy_(source.flat.data)
+        for b, b_source in zip(target.buffers(), source.buffers()):
+            b.copy_(b_source)
+    else:
+        target.load_state_dict(source.state_dict())
+
+def snapshot(module):
+    """
+    Copy on the cpu of the state_dict of module. If module is flat, its parameters are copied
+    at once and the returned parameters are views of the copy.
+    """
+    state_dict = module.state_dict()
+    if not is_flat(module):
+        return {k:v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+
+    data = module.flat.data
+    cpu_data = data.to('cpu', copy=True)
+    storage_ptr = data.untyped_storage().data_ptr()
+    state = {}
+    for k, v in state_dict.items():
+        if v.untyped_storage().data_ptr() == storage_ptr:
+            offset = (v.data_ptr() - data.data_ptr())//data.element_size()
+            state[k] = cpu_data[offset:offset+v.numel()].view(v.shape)
+        else:
+            state[k] = v.detach().to('cpu', copy=True)
+    return state
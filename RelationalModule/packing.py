@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+
+def compute_n_step_rewards(rewards, gamma, n_steps):
+    """
+    n-step discounted rewards along the last axis of rewards, so that many (zero-padded) episodes
+    can be processed at once. The sums are truncated at the end of the episode, so the last n-1 
+    rewards of an episode include less than n terms.
+    """
+    T = rewards.shape[-1]
+    G = rewards.astype(float)
+    for k in range(1, min(n_steps, T)):
+        G[...,:T-k] += gamma**k*rewards[...,k:]
+    return G
+
+class PackedTrajectories():
+    """
+    Packed layout of a batch of episodes of different lengths.
+
+    Notes
+    -----
+    * The states of all the episodes are concatenated along the first dimension, without
+      any padding, so the networks never process padded states.
+    * Per-step quantities (rewards, done and bootstrap flags) are padded, together with a
+      validity mask, inside buckets of episodes of similar length (at most bucket_width
+      steps of difference), so that n-step targets are computed with a few array operations
+      per bucket instead of a Python loop over the episodes.
+    * Transitions are returned in bucket order: step_idx indexes the concatenation of the
+      per-step quantities of all the episodes (e.g. actions or log_probs), old_idx and
+      new_idx the packed states.
+    """
+    def __init__(self, rewards, states, done, bootstrap=None, bucket_width=None, device='cpu'):
+        """
+        Parameters
+        ----------
+        rewards, done, bootstrap: lists of arrays
+            One array of shape (episode_len,) per episode
+        states: list of arrays or tensors
+            One array of shape (episode_len+1, ...) per episode
+        bucket_width: int (default None)
+            Maximum difference in length between episodes of the same bucket.
+            If None all the episodes are put in the same bucket
+        device: str in {'cpu','cuda'}
+            Device of the packed states
+        """
+        self.lengths = np.array([len(r) for r in rewards])
+        self.step_offsets = np.concatenate(([0], np.cumsum(self.lengths)[:-1]))
+        self.state_offsets = self.step_offsets + np.arange(len(self.lengths))
+
+        self.states = torch.cat([torch.as_tensor(s, device=device) for s in states])
+        self.rewards = np.concatenate(rewards).astype(float)
+        self.done = np.concatenate(done).astype(bool)
+        if bootstrap is not None:
+            self.done[np.concatenate(bootstrap).astype(bool)] = False
+
+        if bucket_width is None:
+            bucket_width = self.lengths.max()
+        keys = (self.lengths-1)//bucket_width
+        order = np.argsort(self.lengths, kind='stable')
+        self.buckets = [order[keys[order] == k] for k in np.unique(keys)]
+
+    def pad(self, episodes):
+        """
+        Returns padded rewards, done flags, validity mask and flat step indexes of shape
+        (len(episodes), max_len) for the episodes of a bucket.
+        """
+        lengths = self.lengths[episodes]
+        t = np.arange(lengths.max())
+        mask = t < lengths[:,None]
+        flat_idx = np.where(mask, self.step_offsets[episodes][:,None] + t, 0)
+        rewards = np.where(mask, self.rewards[flat_idx], 0.)
+        done = self.done[flat_idx] & mask
+        return rewards, done, mask, flat_idx
+
+    def n_step_targets(self, gamma, n_steps):
+        """
+        Computes n-step rewards, target states, discount factors and done mask of all the
+        transitions. The target state of a transition is (at most) n steps away, the last
+        state of the episode for the last n-1 transitions, that get the done flag of the last
+        transition and a discount adjusted to the actual distance.
+
+        Returns
+        -------
+        n_step_rewards, Gamma_V, done: arrays of shape (n_transitions,)
+
+        Also sets step_idx, old_idx and new_idx (same shape).
+        """
+        n_step_rewards, Gamma_V, dones = [], [], []
+        step_idx, old_idx, new_idx = [], [], []
+        for episodes in self.buckets:
+            lengths = self.lengths[episodes][:,None]
+            rewards, done, mask, flat_idx = self.pad(episodes)
+            t = np.arange(mask.shape[1])
+
+            # (at most) n-step away states, whose discount is adjusted for the last n-1 states
+            n_step_t = np.minimum(t + n_steps, lengths)
+            # the last n states take the done flag of the last transition
+            last_done = done[np.arange(len(episodes)), lengths[:,0]-1][:,None]
+            done = np.where(t + n_steps >= lengths, last_done, done)
+
+            n_step_rewards.append(compute_n_step_rewards(rewards, gamma, n_steps)[mask])
+            Gamma_V.append((gamma**(n_step_t - t))[mask])
+            dones.append(done[mask])
+            step_idx.append(flat_idx[mask])
+            state_offsets = self.state_offsets[episodes][:,None]
+            old_idx.append((state_offsets + t)[mask])
+            new_idx.append((state_offsets + n_step_t)[mask])
+
+        self.step_idx = np.concatenate(step_idx)
+        self.old_idx = np.concatenate(old_idx)
+        self.new_idx = np.concatenate(new_idx)
+        return np.concatenate(n_step_rewards), np.concatenate(Gamma_V), np.concatenate(dones)
+
+    def gather_steps(self, x):
+        """
+        Concatenates per-step quantities (list with an array or a list of tensors per episode)
+        and reorders them as the transitions returned by n_step_targets.
+        """
+        if torch.is_tensor(x[0]) or isinstance(x[0], list):
+            x = torch.cat([torch.stack(list(xi)) for xi in x])
+            return x[torch.as_tensor(self.step_idx, device=x.device)]
+        return np.concatenate(x)[self.step_idx]
@@ -0,0 +1,85 @@
+import torch
+
+from RelationalModule.flat import flatten, is_flat
+
+MODES = ['soft', 'hard', 'shared']
+
+class TargetNetwork():
+    """
+    Target of an online network (e.g. the critic), whose weights follow the online ones.
+
+    Notes
+    -----
+    * Modes:
+        soft: after every update target.params = (1-tau)*target.params + tau*online.params
+        hard: the online parameters are copied in the target every period updates
+        shared: there is no separate target network, network is the online network itself
+    * A soft target with tau=1 is an exact copy of the online network after every update,
+      so it is turned into a shared one.
+    * The parameter lists of both networks are collected once and updated with fused
+      multi-tensor operations (torch._foreach_*), that process all the tensors with a few
+      kernel launches and without allocating temporaries. Moving the networks with .to()
+      or loading a state_dict updates the parameters in place, so the lists stay valid.
+    * If the online network is flat (see flat.FlatParameters), the target is flattened in
+      the same way and the lists contain just the flat buffers.
+    """
+    def __init__(self, online, target_fn, mode='soft', tau=1., period=1):
+        """
+        Parameters
+        ----------
+        online: nn.Module
+            Online network
+        target_fn: callable
+            target_fn() returns a network with the same parameters of online, used as target
+            (not called in shared mode)
+        mode: str in {'soft','hard','shared'} (default 'soft')
+            See Notes
+        tau: float in [0,1] (default 1.)
+            Averaging factor of the soft mode
+        period: int (default 1)
+            Number of updates between two copies in the hard mode
+        """
+        assert mode in MODES, "Target mode must be one of %s"%MODES
+        if mode == 'soft' and tau == 1.:
+            mode = 'shared'
+        self.mode = mode
+        self.tau = tau
+        self.period = period
+        self.online = online
+
+        if self.shared:
+            self.network = online
+        else:
+            self.network = target_fn()
+            if is_flat(online):
+                flatten(self.network, online.flat.groups, grad=False)
+                self.online_params = [online.flat.data]
+                self.target_params = [self.network.flat.data]
+            else:
+                self.online_params = list(online.parameters())
+                self.target_params = list(self.network.parameters())
+            assert len(self.online_params) == len(self.target_params), "Target and online networks must match"
+            self.copy()
+
+    @property
+    def shared(self):
+        return self.mode == 'shared'
+
+    @torch.no_grad()
+    def copy(self):
+        """
+        Copies the online parameters into the target ones.
+        """
+        if not self.shared:
+            torch._foreach_copy_(self.target_params, self.online_params)
+
+    @torch.no_grad()
+    def update(self, step=None):
+        """
+        To be called after every update of the online network; step is the number of updates
+        done so far (needed only in hard mode).
+        """
+        if self.mode == 'soft':
+            torch._foreach_lerp_(self.target_params, self.online_params, self.tau)
+        elif self.mode == 'hard' and step % self.period == 0:
+            self.copy()
@@ -0,0 +1,184 @@
+import queue
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from Utils import test_env
+from Utils.test_env import random_start
+from Utils.train_agent_sandbox import play_episode
+from Utils.buffers import TrajectoryBuffer
+from RelationalModule.flat import copy_network, copy_parameters
+
+debug = False
+
+def worker(worker_id, agent, shared_actor, version, lock, trajectory_queue, stop_event, game_params, random_init, seed):
+    """
+    Actor process: plays Sandbox episodes (gradient-free, with train_agent_sandbox.play_episode) 
+    with the latest policy published by the learner and submits them (tagged with the version 
+    of the policy used) to trajectory_queue.
+    """
+    torch.set_num_threads(1)
+    rng = np.random.default_rng(seed)
+    game_params = dict(game_params, seed=rng.integers(2**32))
+    if random_init:
+        game_params["initial"], game_params["goal"] = random_start(game_params["x"], game_params["y"], rng,
+                                                                   game_params.get("walls"))
+    env = test_env.Sandbox(**game_params)
+
+    # the worker acts with its own copy of the actor on cpu
+    agent.actor = copy_network(shared_actor)
+    agent.device = 'cpu'
+    buffer = TrajectoryBuffer(env.max_steps, agent.device, agent.state_dtype)
+    local_version = -1
+
+    while not stop_event.is_set():
+        if version.value != local_version:
+            with lock:
+                copy_parameters(agent.actor, shared_actor)
+                local_version = version.value
+
+        if random_init:
+            initial, goal = random_start(game_params["x"], game_params["y"], rng, game_params.get("walls"))
+            env.reconfigure(initial, goal)
+        rewards, _, _, states, done, bootstrap = play_episode(agent, env, env.max_steps, buffer, grad_free=True)
+        # the buffer is reused by the next episode, while the queue pickles its items in a background thread
+        trajectory = (rewards.copy(), buffer.get_actions().copy(), states.numpy().copy(), done.copy(), bootstrap.copy())
+
+        while not stop_event.is_set():
+            try:
+                trajectory_queue.put((worker_id, local_version)+trajectory, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+def train_actor_learner(agent, game_params, n_episodes=1000, n_workers=4, max_staleness=None, return_agent=False,
+                        random_init=True, seed=None, queue_size=None, start_method='fork', join_timeout=5.):
+    """
+    Trains an A2C agent on the Sandbox environment with n_workers actor processes and a
+    central learner (the calling process).
+
+    Notes
+    -----
+    * The learner keeps the actor weights in a shared-memory copy, published after every update
+      together with an increasing policy version. Workers reload them (under a lock) before
+      every new episode, when the version has changed. With a flat actor (see flat.FlatParameters)
+      publishing and reloading are a single copy of a contiguous buffer.
+    * Every trajectory is tagged with the version of the policy that played it. Its staleness is
+      the number of updates done by the learner since then; trajectories with staleness greater
+      than max_staleness are discarded (if max_staleness is not None).
+    * Log-probabilities and distributions are recomputed by the agent's update with the current actor,
+      while the policy lag shows up in the states visited and the actions taken.
+    * The learner checks that the workers are still alive while waiting for trajectories, and
+      raises a RuntimeError if some of them died. At the end the workers are given join_timeout
+      seconds in total to exit, after which those still alive are terminated.
+    * Only the Sandbox environment is supported.
+
+    Parameters
+    ----------
+    agent: A2C agent
+        Any of the A2C agents of RelationalModule
+    game_params: dict
+        Parameters of test_env.Sandbox
+    n_episodes: int (default 1000)
+        Number of episodes used by the learner for the updates
+    n_workers: int (default 4)
+        Number of actor processes
+    max_staleness: int (default None)
+        Maximum number of policy versions a trajectory can lag behind the learner
+    queue_size: int (default None)
+        Maximum number of trajectories waiting for the learner. If None it's set to 2*n_workers
+    start_method: str in {'fork','spawn','forkserver'}
+        Start method of the worker processes
+    join_timeout: float (default 5.)
+        Seconds given to the workers to exit at the end of the training
+
+    Returns
+    -------
+    Same as train_sandbox, with losses containing also the 'staleness' of the trajectories
+    used and the number of trajectories 'dropped'.
+    """
+    ctx = mp.get_context(start_method)
+    rng = np.random.default_rng(seed)
+    if queue_size is None:
+        queue_size = 2*n_workers
+
+    shared_actor = copy_network(agent.actor, 'cpu')
+    shared_actor.share_memory()
+    version = ctx.Value('l', 0)
+    lock = ctx.Lock()
+    trajectory_queue = ctx.Queue(maxsize=queue_size)
+    stop_event = ctx.Event()
+
+    workers = []
+    for i in range(n_workers):
+        p = ctx.Process(target=worker, args=(i, agent, shared_actor, version, lock, trajectory_queue, stop_event,
+                                             game_params, random_init, rng.integers(2**32)))
+        p.start()
+        workers.append(p)
+
+    performance = []
+    steps_to_solve = []
+    time_profile = []
+    critic_losses = []
+    actor_losses = []
+    entropies = []
+    staleness = []
+    dropped = 0
+
+    try:
+        e = 0
+        while e < n_episodes:
+            t0 = time.time()
+            try:
+                worker_id, policy_version, rewards, actions, states, done, bootstrap = trajectory_queue.get(timeout=1.)
+            except queue.Empty:
+                dead = [i for i, p in enumerate(workers) if not p.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError("Worker processes %s died (exit codes %s)"%(dead, [workers[i].exitcode for i in dead]))
+                continue
+            lag = version.value - policy_version
+            if max_staleness is not None and lag > max_staleness:
+                dropped += 1
+                continue
+
+            t1 = time.time()
+            performance.append(np.sum(rewards))
+            steps_to_solve.append(len(rewards))
+            staleness.append(lag)
+            if (e+1)%10 == 0:
+                print("Episode %d - reward: %.2f - steps to solve: %.2f - staleness: %.2f"%(e+1,
+                      np.mean(performance[-10:]), np.mean(steps_to_solve[-10:]), np.mean(staleness[-10:])))
+
+            critic_loss, actor_loss, entropy = agent.update(rewards, None, None, states, done, bootstrap, actions=actions)
+            critic_losses.append(critic_loss)
+            actor_losses.append(actor_loss)
+            entropies.append(entropy)
+
+            # Publish the new policy
+            with lock:
+                copy_parameters(shared_actor, agent.actor)
+                version.value += 1
+
+            t2 = time.time()
+            time_profile.append([t1-t0, t2-t1])
+            e += 1
+    finally:
+        stop_event.set()
+        deadline = time.time() + join_timeout
+        for p in workers:
+            p.join(timeout=max(deadline - time.time(), 0.))
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+
+    performance = np.array(performance)
+    time_profile = np.array(time_profile)
+    steps_to_solve = np.array(steps_to_solve)
+    L = n_episodes // 6 # consider last sixth of episodes to compute agent's asymptotic performance
+    losses = dict(critic_losses=critic_losses, actor_losses=actor_losses, entropies=entropies,
+                  staleness=np.array(staleness), dropped=dropped)
+    if return_agent:
+        return performance, performance[-L:].mean(), performance[-L:].std(), agent, time_profile, losses, steps_to_solve
+    else:
+        return performance, performance[-L:].mean(), performance[-L:].std(), losses, steps_to_solve
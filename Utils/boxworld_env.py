@@ -0,0 +1,487 @@
+import os
+import json
+import string
+import numpy as np
+
+debug = False
+
+# Cell codes of the boards: keys and locks (boxes) of color c have codes KEY_OFFSET+c and LOCK_OFFSET+c,
+# where color c corresponds to the c-th letter of the alphabet (lowercase for keys, uppercase for locks)
+GROUND = 0
+WALL = 1
+AGENT = 2
+GEM = 3
+KEY_OFFSET = 4
+N_COLORS = len(string.ascii_lowercase)
+LOCK_OFFSET = KEY_OFFSET + N_COLORS
+N_CODES = LOCK_OFFSET + N_COLORS
+
+# Same ids of object_dict in train_agent.play_episode
+OBJECT_IDS = {'ground':0, 'wall':1, 'agent':2, 'gem':3, 'key':4, 'box':5}
+
+# Bit used in level banks to flag the locks of distractor boxes (cell codes are < 128)
+DISTRACTOR_FLAG = 128
+
+# Rewards
+REWARD_GOAL = 10.
+REWARD_STEP = 0.
+REWARD_OPEN_CORRECT = 1.
+REWARD_OPEN_WRONG = -1.
+
+MAX_NUM_STEPS = 120
+
+# Actions: 0 up, 1 down, 2 left, 3 right
+MOVEMENTS = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+
+def get_palette(seed=100):
+    """
+    Returns an array of shape (N_COLORS, 3) with the RGB colors of the letters,
+    the same ones of train_agent.get_color_dict (without touching the global random state).
+    """
+    return np.random.RandomState(seed).rand(N_COLORS, 3)
+
+def get_lookup_tables(seed=100):
+    """
+    Builds the tables mapping each cell code to its object id, RGB color and ASCII character.
+
+    Returns
+    -------
+    object_lut: array of uint8, shape (N_CODES,)
+    color_lut: array of float32, shape (N_CODES, 3)
+    char_lut: array of uint8, shape (N_CODES,)
+    """
+    palette = get_palette(seed)
+
+    object_lut = np.zeros(N_CODES, dtype=np.uint8)
+    object_lut[GROUND] = OBJECT_IDS['ground']
+    object_lut[WALL] = OBJECT_IDS['wall']
+    object_lut[AGENT] = OBJECT_IDS['agent']
+    object_lut[GEM] = OBJECT_IDS['gem']
+    object_lut[KEY_OFFSET:LOCK_OFFSET] = OBJECT_IDS['key']
+    object_lut[LOCK_OFFSET:] = OBJECT_IDS['box']
+
+    # ground and walls are black, agent is red and gem is white
+    color_lut = np.zeros((N_CODES, 3), dtype=np.float32)
+    color_lut[AGENT] = [1., 0., 0.]
+    color_lut[GEM] = [1., 1., 1.]
+    color_lut[KEY_OFFSET:LOCK_OFFSET] = palette
+    color_lut[LOCK_OFFSET:] = palette
+
+    char_lut = np.zeros(N_CODES, dtype=np.uint8)
+    char_lut[GROUND] = ord(' ')
+    char_lut[WALL] = ord('#')
+    char_lut[AGENT] = ord('.')
+    char_lut[GEM] = ord('*')
+    char_lut[KEY_OFFSET:LOCK_OFFSET] = [ord(c) for c in string.ascii_lowercase]
+    char_lut[LOCK_OFFSET:] = [ord(c) for c in string.ascii_uppercase]
+
+    return object_lut, color_lut, char_lut
+
+OBJECT_LUT, COLOR_LUT, CHAR_LUT = get_lookup_tables()
+
+def get_state(boards):
+    """
+    Vectorized version of train_agent.get_state working directly on boards of cell codes.
+
+    Parameters
+    ----------
+    boards: array of uint8
+        Shape (..., H, W)
+
+    Returns
+    -------
+    object_board: array of uint8, shape (..., H, W, 1)
+    color_board: array of float32, shape (..., H, W, 3)
+    """
+    return OBJECT_LUT[boards][...,np.newaxis], COLOR_LUT[boards]
+
+def is_terminated(rewards):
+    """
+    True for the transitions that end the episode regardless of the time limit (taking the 
+    gem or opening a distractor box), recognized from their rewards (works also for pycolab's
+    BoxWorld, that has the same rewards).
+    """
+    rewards = np.asarray(rewards)
+    return (rewards == REWARD_STEP + REWARD_GOAL) | (rewards == REWARD_STEP + REWARD_OPEN_WRONG)
+
+def generate_level(rng, grid_size, solution_length, num_forward, num_backward, branch_length):
+    """
+    Generates a BoxWorld level.
+
+    Notes
+    -----
+    * A box is made of two horizontally adjacent cells: the lock (right) and its content (left),
+      that is either a key or the gem.
+    * The solution path starts from a loose key, that opens the first box, whose content opens
+      the second box and so on, up to the box containing the gem. With a solution length of 0
+      the gem is loose.
+    * Forward distractor branches start from a box with the lock of one of the keys of the
+      solution path, containing a key of a new color that opens the next box of the branch,
+      for branch_length boxes. Backward distractors are boxes with a lock that no key can open.
+      Opening a distractor box leads to a dead end and terminates the episode.
+
+    Parameters
+    ----------
+    rng: np.random.Generator
+    grid_size: int
+        Linear size of the grid (without the border)
+    solution_length, num_forward, num_backward: int or list of int
+        If a list is given, the value is sampled from it (as in pycolab's BoxWorld)
+    branch_length: int
+        Number of boxes in each forward distractor branch
+
+    Returns
+    -------
+    board: array of uint8, shape (grid_size+2, grid_size+2)
+    distractor: array of bool, shape (grid_size+2, grid_size+2)
+        True on the locks of the distractor boxes
+    agent: array of int, shape (2,)
+    """
+    solution_length = int(rng.choice(np.atleast_1d(solution_length)))
+    num_forward = int(rng.choice(np.atleast_1d(num_forward)))
+    num_backward = int(rng.choice(np.atleast_1d(num_backward)))
+    if solution_length == 0:
+        # distractors start from (or lead to) keys of the solution path, that here are missing
+        num_forward = 0
+        num_backward = 0
+
+    n_colors = solution_length + num_forward*branch_length + num_backward
+    assert n_colors <= N_COLORS, "Not enough colors for the requested level"
+    colors = rng.permutation(N_COLORS)[:n_colors]
+    solution = colors[:solution_length]
+    distractors = list(colors[solution_length:])
+
+    # boxes as (lock color, content code, is distractor)
+    boxes = []
+    for i in range(solution_length):
+        if i < solution_length - 1:
+            content = KEY_OFFSET + solution[i+1]
+        else:
+            content = GEM
+        boxes.append((solution[i], content, False))
+    for _ in range(num_forward):
+        lock = solution[rng.integers(solution_length)]
+        for _ in range(branch_length):
+            key = distractors.pop()
+            boxes.append((lock, KEY_OFFSET + key, True))
+            lock = key
+    for _ in range(num_backward):
+        content = KEY_OFFSET + solution[rng.integers(solution_length)]
+        boxes.append((distractors.pop(), content, True))
+
+    size = grid_size + 2
+    board = np.full((size, size), GROUND, dtype=np.uint8)
+    board[0,:] = WALL
+    board[-1,:] = WALL
+    board[:,0] = WALL
+    board[:,-1] = WALL
+    distractor = np.zeros((size, size), dtype=bool)
+    # cells horizontally adjacent to the boxes are kept free of other boxes to make them distinguishable
+    padding = np.zeros((size, size), dtype=bool)
+
+    for lock, content, is_distractor in boxes:
+        free = (board == GROUND)
+        box_free = free & ~padding
+        # lock at (r,c), content at (r,c-1)
+        candidates = box_free[1:-1,2:-1] & box_free[1:-1,1:-2]
+        candidates = np.argwhere(candidates) + [1, 2]
+        assert len(candidates) > 0, "Grid too small for the requested level"
+        r, c = candidates[rng.integers(len(candidates))]
+        board[r, c] = LOCK_OFFSET + lock
+        board[r, c-1] = content
+        distractor[r, c] = is_distractor
+        padding[r, c-2] = True
+        padding[r, c+1] = True
+
+    # loose objects: agent, first key of the solution (or the gem)
+    free_cells = np.argwhere(board == GROUND)
+    n_loose = 2
+    assert len(free_cells) >= n_loose, "Grid too small for the requested level"
+    agent, loose = free_cells[rng.choice(len(free_cells), n_loose, replace=False)]
+    board[agent[0], agent[1]] = AGENT
+    if solution_length > 0:
+        board[loose[0], loose[1]] = KEY_OFFSET + solution[0]
+    else:
+        board[loose[0], loose[1]] = GEM
+
+    return board, distractor, agent
+
+class BoxWorldVecEnv():
+    """
+    Vectorized NumPy implementation of the BoxWorld environment of the paper
+    Relational Deep Reinforcement Learning, stepping n_envs levels at once.
+
+    Notes
+    -----
+    * The key held by the agent is shown in the top-left corner of the board.
+    * The agent collects a loose key walking on it (replacing the key held), opens a
+      box walking on its lock with the key of the same color, and then can collect
+      the content of the box.
+    * Collecting the gem gives REWARD_GOAL and terminates the episode. Opening a box
+      gives REWARD_OPEN_CORRECT, or REWARD_OPEN_WRONG and terminates the episode if
+      the box is a distractor. Episodes are also terminated (and flagged as truncated)
+      after max_num_steps.
+    * Terminated levels are automatically replaced by new ones (if autoreset is True); the 
+      last observation of the old episodes is stored in info['final_state'].
+    * Levels are generated on the fly, or sampled from a pregenerated LevelBank.
+    * Observations are the (object_board, color_board) pairs built by train_agent.get_state,
+      stacked along a first batch dimension.
+    """
+
+    def __init__(self, n_envs, grid_size, solution_length, num_forward, num_backward, branch_length,
+                 max_num_steps=MAX_NUM_STEPS, seed=None, level_bank=None, autoreset=True):
+        """
+        Parameters
+        ----------
+        n_envs: int
+            Number of levels stepped in parallel
+        grid_size, solution_length, num_forward, num_backward, branch_length:
+            Level generation parameters (see generate_level), same of pycolab's make_game
+        max_num_steps: int (default 120)
+            Maximum number of steps per episode
+        seed: int (default None)
+            Seed of the np.random.Generator owned by the env
+        level_bank: LevelBank (default None)
+            If provided, levels are sampled from it instead of being generated
+        autoreset: bool (default True)
+            If True, terminated levels are immediately replaced by new ones
+        """
+        self.n_envs = n_envs
+        self.game_params = dict(grid_size=grid_size, solution_length=solution_length, num_forward=num_forward,
+                                num_backward=num_backward, branch_length=branch_length)
+        self.max_num_steps = max_num_steps
+        self.rng = np.random.default_rng(seed)
+        self.n_actions = len(MOVEMENTS)
+        self.level_bank = level_bank
+        self.autoreset = autoreset
+
+        size = grid_size + 2
+        self.boards = np.zeros((n_envs, size, size), dtype=np.uint8)
+        self.distractors = np.zeros((n_envs, size, size), dtype=bool)
+        self.agents = np.zeros((n_envs, 2), dtype=int)
+        # color of the key held by the agent, -1 if none
+        self.held = np.full(n_envs, -1)
+        self.current_steps = np.zeros(n_envs, dtype=int)
+
+    def reset_envs(self, idx):
+        """
+        Generates (or samples from the level bank) new levels for the environments whose indexes are in idx.
+        """
+        if self.level_bank is not None:
+            self.boards[idx], self.distractors[idx], self.agents[idx] = self.level_bank.sample(len(idx), self.rng)
+        else:
+            for i in idx:
+                self.boards[i], self.distractors[i], self.agents[i] = generate_level(self.rng, **self.game_params)
+        self.held[idx] = -1
+        self.current_steps[idx] = 0
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self.reset_envs(np.arange(self.n_envs))
+        return get_state(self.boards)
+
+    def step(self, actions):
+        """
+        Parameters
+        ----------
+        actions: array of int
+            Shape (n_envs,)
+
+        Returns
+        -------
+        state: tuple (object_board, color_board)
+            Shapes (n_envs, H, W, 1) and (n_envs, H, W, 3)
+        rewards: array of float, shape (n_envs,)
+        terminal: array of bool, shape (n_envs,)
+        truncated: array of bool, shape (n_envs,)
+        info: dict
+            If some environment terminated, contains 'final_state' with the last states
+            of the terminated episodes and 'final_board' with their boards of cell codes
+        """
+        rows = np.arange(self.n_envs)
+        self.current_steps += 1
+
+        # the border is made of walls, so next cells are always inside the board
+        nxt = self.agents + MOVEMENTS[np.asarray(actions)]
+        target = self.boards[rows, nxt[:,0], nxt[:,1]]
+        right = self.boards[rows, nxt[:,0], np.minimum(nxt[:,1]+1, self.boards.shape[2]-1)]
+        # keys and gem are inside a box if there is a lock on their right
+        in_box = (right >= LOCK_OFFSET)
+
+        is_key = (target >= KEY_OFFSET) & (target < LOCK_OFFSET)
+        is_lock = (target >= LOCK_OFFSET)
+        pick_key = is_key & ~in_box
+        take_gem = (target == GEM) & ~in_box
+        open_lock = is_lock & (self.held == target.astype(int) - LOCK_OFFSET)
+        wrong = open_lock & self.distractors[rows, nxt[:,0], nxt[:,1]]
+        move = (target == GROUND) | pick_key | take_gem | open_lock
+
+        rewards = np.full(self.n_envs, REWARD_STEP)
+        rewards[open_lock & ~wrong] += REWARD_OPEN_CORRECT
+        rewards[wrong] += REWARD_OPEN_WRONG
+        rewards[take_gem] += REWARD_GOAL
+
+        self.held[open_lock] = -1
+        self.held[pick_key] = target[pick_key].astype(int) - KEY_OFFSET
+
+        moving = rows[move]
+        self.boards[moving, self.agents[moving,0], self.agents[moving,1]] = GROUND
+        self.boards[moving, nxt[moving,0], nxt[moving,1]] = AGENT
+        self.agents[moving] = nxt[moving]
+        self.boards[:,0,0] = np.where(self.held >= 0, KEY_OFFSET + self.held, WALL)
+
+        truncated = (self.current_steps >= self.max_num_steps)
+        terminal = take_gem | wrong | truncated
+
+        info = {}
+        if terminal.any():
+            idx = np.nonzero(terminal)[0]
+            info['final_board'] = self.boards[idx]
+            info['final_state'] = get_state(info['final_board'])
+            if self.autoreset:
+                self.reset_envs(idx)
+
+        return get_state(self.boards), rewards, terminal, truncated, info
+
+    def render(self, i=0):
+        """
+        Returns the board of the i-th environment as a list of strings.
+        """
+        return [row.tobytes().decode('ascii') for row in CHAR_LUT[self.boards[i]]]
+
+class Observation():
+    """
+    Minimal replacement of pycolab's Observation: board of ASCII codes and a boolean layer for each character.
+    """
+    def __init__(self, board):
+        self.board = CHAR_LUT[board]
+        self.layers = {chr(c):(self.board == c) for c in np.unique(self.board)}
+
+class BoxWorldGame():
+    """
+    Single level BoxWorld with the same interface of the pycolab game returned by box_world.make_game
+    (its_showtime and play), so that it can be used by train_agent.play_episode without pycolab.
+    """
+    def __init__(self, env):
+        self.env = env
+        self.game_over = False
+
+    def its_showtime(self):
+        return Observation(self.env.boards[0]), None, 1.
+
+    def play(self, action):
+        """
+        Returns observation, reward and discount (0 if the episode is over, 1 otherwise).
+        """
+        _, rewards, terminal, _, _ = self.env.step([action])
+        if terminal[0]:
+            self.game_over = True
+            return Observation(self.env.boards[0]), rewards[0], 0.
+        return Observation(self.env.boards[0]), rewards[0], 1.
+
+def make_game(grid_size, solution_length, num_forward, num_backward, branch_length, random_state=None,
+              max_num_steps=MAX_NUM_STEPS):
+    """
+    Drop-in replacement of pycolab's box_world.make_game.
+
+    Parameters
+    ----------
+    random_state: int or np.random.Generator (default None)
+        Seed or generator used to create the level
+    """
+    env = BoxWorldVecEnv(1, grid_size, solution_length, num_forward, num_backward, branch_length, max_num_steps,
+                         seed=random_state, autoreset=False)
+    env.reset()
+    return BoxWorldGame(env)
+
+### Pregenerated levels ###
+
+def create_level_bank(filename, n_levels, game_params, seed=None, verbose=True):
+    """
+    Pregenerates n_levels BoxWorld levels and stores them in a .npy file that can be 
+    memory-mapped by LevelBank. Each level takes (grid_size+2)**2 bytes: the board of cell 
+    codes, with the DISTRACTOR_FLAG bit set on the locks of the distractor boxes.
+    The game parameters are saved in filename+'.json'.
+    
+    Parameters
+    ----------
+    filename: str
+        Path of the .npy file
+    n_levels: int
+        Number of levels to generate
+    game_params: dict
+        Parameters of make_game (grid_size, solution_length, num_forward, num_backward, branch_length)
+    seed: int (default None)
+        Seed used for the generation
+    """
+    rng = np.random.default_rng(seed)
+    size = game_params['grid_size'] + 2
+    # levels are written directly on disk, so that the bank never needs to fit in memory
+    levels = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=(n_levels, size, size))
+    for i in range(n_levels):
+        board, distractor, _ = generate_level(rng, **game_params)
+        levels[i] = board | (distractor.astype(np.uint8)*DISTRACTOR_FLAG)
+        if verbose and (i+1)%10000 == 0:
+            print("Generated %d/%d levels"%(i+1, n_levels))
+    levels.flush()
+    del levels
+    
+    params = {k:(np.asarray(v).tolist()) for k, v in game_params.items()}
+    with open(filename+'.json', 'w') as f:
+        json.dump(params, f)
+        
+class LevelBank():
+    """
+    Read-only memory-mapped archive of levels created by create_level_bank.
+    Many processes can open the same bank: the levels are read from the OS page cache 
+    when sampled, without loading the whole archive in each process' memory.
+    """
+    def __init__(self, filename, seed=None):
+        self.filename = filename
+        self.levels = np.load(filename, mmap_mode='r')
+        self.rng = np.random.default_rng(seed)
+        if os.path.exists(filename+'.json'):
+            with open(filename+'.json') as f:
+                self.game_params = json.load(f)
+        else:
+            self.game_params = None
+            
+    def __len__(self):
+        return len(self.levels)
+    
+    def sample(self, n=1, rng=None):
+        """
+        Samples n levels (with replacement).
+        
+        Returns
+        -------
+        boards: array of uint8, shape (n, H, W)
+        distractors: array of bool, shape (n, H, W)
+        agents: array of int, shape (n, 2)
+        """
+        if rng is None:
+            rng = self.rng
+        # sorted indexes make the reads from the memory map more sequential
+        idx = np.sort(rng.integers(len(self.levels), size=n))
+        levels = self.levels[idx]
+        boards = levels & ~np.uint8(DISTRACTOR_FLAG)
+        distractors = (levels & DISTRACTOR_FLAG) > 0
+        agent_idx = (boards == AGENT).reshape(n, -1).argmax(axis=1)
+        agents = np.stack(np.unravel_index(agent_idx, boards.shape[1:]), axis=1)
+        return boards, distractors, agents
+    
+    def make_env(self, n_envs, max_num_steps=MAX_NUM_STEPS, seed=None, autoreset=True):
+        """
+        Returns a BoxWorldVecEnv whose levels are sampled from the bank.
+        """
+        return BoxWorldVecEnv(n_envs, max_num_steps=max_num_steps, seed=seed, level_bank=self, 
+                              autoreset=autoreset, **self.game_params)
+    
+    def make_game(self, max_num_steps=MAX_NUM_STEPS):
+        """
+        Same as make_game, but the level is sampled from the bank.
+        """
+        env = self.make_env(1, max_num_steps, seed=self.rng.integers(2**32), autoreset=False)
+        env.reset()
+        return BoxWorldGame(env)
@@ -0,0 +1,113 @@
+import numpy as np
+import torch
+
+def get_bootstrap(truncated, terminated):
+    """
+    Bootstrap flags of transitions, element-wise on arrays: the value of the last state of an 
+    episode is bootstrapped from the critic only if the episode was truncated by the time 
+    limit of the environment without reaching a terminal state (e.g. the goal) at the same step.
+    Used by all the episode collectors, so that the n-step targets don't depend on how the
+    episodes were collected.
+    """
+    return np.logical_and(truncated, np.logical_not(terminated))
+
+class TrajectoryBuffer():
+    """
+    Fixed-capacity storage for the trajectory of a single episode, reused across episodes.
+
+    Notes
+    -----
+    * States are written directly into preallocated tensors on the agent's device (one
+      tensor per array if the states are tuples of arrays, as in BoxWorld), so that the
+      agents can use them without any further conversion.
+    * Actions, rewards and flags are stored in typed NumPy arrays.
+    * The storage of the states is allocated when the first state is seen and reallocated
+      only if the shape of the states changes.
+    * get() returns views of the storage, valid until the next call of reset().
+    * log_probs and distributions are None if they were not recorded (gradient-free acting),
+      in which case the actions are needed by update_TD to recompute them.
+    """
+    def __init__(self, max_steps, device='cpu', state_dtype=torch.float32):
+        """
+        Parameters
+        ----------
+        max_steps: int
+            Maximum length of an episode
+        device: str in {'cpu','cuda'}
+            Device on which the states are stored
+        state_dtype: torch.dtype (default torch.float32)
+            Type in which the states are stored (e.g. torch.long for ControlA2C)
+        """
+        self.max_steps = max_steps
+        self.device = torch.device(device)
+        self.state_dtype = state_dtype
+
+        self.actions = np.zeros(max_steps, dtype=np.int64)
+        self.rewards = np.zeros(max_steps)
+        self.done = np.zeros(max_steps, dtype=bool)
+        self.bootstrap = np.zeros(max_steps, dtype=bool)
+        self.log_probs = []
+        self.distributions = []
+        self.states = None
+        self.is_tuple = False
+        self.t = 0
+
+    def allocate(self, state):
+        self.is_tuple = isinstance(state, tuple)
+        arrays = state if self.is_tuple else (state,)
+        self.states = [torch.empty((self.max_steps+1,)+np.shape(s), dtype=self.state_dtype, device=self.device)
+                       for s in arrays]
+
+    def write_state(self, t, state):
+        arrays = state if self.is_tuple else (state,)
+        for storage, s in zip(self.states, arrays):
+            storage[t] = torch.as_tensor(s)
+
+    def reset(self, state):
+        """
+        Starts a new episode from state.
+        """
+        arrays = state if isinstance(state, tuple) else (state,)
+        if self.states is None or (len(arrays) != len(self.states)) or \
+            any(np.shape(s) != tuple(storage.shape[1:]) for s, storage in zip(arrays, self.states)):
+            self.allocate(state)
+        self.t = 0
+        self.log_probs = []
+        self.distributions = []
+        self.write_state(0, state)
+
+    def add(self, action, reward, new_state, terminal, bootstrap=False, log_prob=None, distribution=None):
+        """
+        Stores a transition.
+        """
+        t = self.t
+        if t == self.max_steps:
+            raise IndexError("Episode longer than the capacity of the buffer (%d steps)"%self.max_steps)
+        self.actions[t] = action
+        self.rewards[t] = reward
+        self.done[t] = terminal
+        self.bootstrap[t] = bootstrap
+        if log_prob is not None:
+            self.log_probs.append(log_prob)
+        if distribution is not None:
+            self.distributions.append(distribution)
+        self.write_state(t+1, new_state)
+        self.t += 1
+
+    def get(self):
+        """
+        Returns
+        -------
+        rewards, log_probs, distributions, states, done, bootstrap
+            Same format of play_episode, with states as tensor (or tuple of tensors) of
+            shape (episode_len+1, ...)
+        """
+        T = self.t
+        states = [s[:T+1] for s in self.states]
+        states = tuple(states) if self.is_tuple else states[0]
+        log_probs = self.log_probs if len(self.log_probs) > 0 else None
+        distributions = self.distributions if len(self.distributions) > 0 else None
+        return self.rewards[:T], log_probs, distributions, states, self.done[:T], self.bootstrap[:T]
+
+    def get_actions(self):
+        return self.actions[:self.t]
@@ -0,0 +1,176 @@
+import os
+import copy
+import random
+import threading
+import numpy as np
+import torch
+
+from RelationalModule.flat import snapshot
+
+NETWORKS = ['actor', 'critic', 'critic_trg']
+OPTIMIZERS = ['actor_optim', 'critic_optim']
+
+def to_cpu_copy(obj):
+    """
+    Recursively copies obj, detaching tensors and moving them to the cpu.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k:to_cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu_copy(v) for v in obj)
+    return copy.deepcopy(obj)
+
+def get_agent_state(agent):
+    """
+    Snapshot of the networks, of the optimizers and of the scalar attributes (e.g. counters)
+    of an A2C agent. The parameters of flat networks are copied at once (see flat.snapshot).
+    """
+    state = {}
+    for name in NETWORKS:
+        if hasattr(agent, name):
+            state[name] = snapshot(getattr(agent, name))
+    for name in OPTIMIZERS:
+        if hasattr(agent, name):
+            state[name] = to_cpu_copy(getattr(agent, name).state_dict())
+    state['attributes'] = {k:v for k, v in vars(agent).items() if isinstance(v, (bool, int, float, str))}
+    return state
+
+def set_agent_state(agent, state):
+    for name in NETWORKS + OPTIMIZERS:
+        if name in state:
+            getattr(agent, name).load_state_dict(state[name])
+    for k, v in state['attributes'].items():
+        setattr(agent, k, v)
+
+def get_rng_states(rngs=None):
+    """
+    States of the global random number generators and of the np.random.Generators in rngs (dict).
+    """
+    states = dict(torch=torch.get_rng_state(), numpy=np.random.get_state(), python=random.getstate())
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    if rngs is not None:
+        states['generators'] = {k:copy.deepcopy(rng.bit_generator.state) for k, rng in rngs.items()}
+    return states
+
+def set_rng_states(states, rngs=None):
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['python'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+    if rngs is not None:
+        for k, rng in rngs.items():
+            rng.bit_generator.state = states['generators'][k]
+
+class AsyncCheckpointer():
+    """
+    Periodically saves training checkpoints from a background thread.
+
+    Notes
+    -----
+    * The snapshot (networks, optimizers, RNG states and metrics) is copied to the cpu in the
+      training thread, which is fast, while serialization and disk writes happen in the
+      background, so that training doesn't stall.
+    * If a checkpoint is requested while the previous one is still being written, only the
+      most recent one is kept pending.
+    * Files are written to a temporary file and then renamed, so a crash never leaves a
+      truncated checkpoint. The last checkpoint is always at checkpoint_dir/last.pt
+    * If writing a checkpoint fails, the background thread stops and the exception is raised
+      in the training thread by the next call of save, maybe_save or close.
+    """
+    def __init__(self, checkpoint_dir, every=100):
+        """
+        Parameters
+        ----------
+        checkpoint_dir: str
+            Directory of the checkpoints (created if needed)
+        every: int (default 100)
+            Number of episodes between checkpoints
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.every = every
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.path = os.path.join(checkpoint_dir, 'last.pt')
+
+        self.pending = None
+        self.condition = threading.Condition()
+        self.closed = False
+        self.n_saved = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                checkpoint, self.pending = self.pending, None
+            tmp_path = self.path + '.tmp'
+            try:
+                torch.save(checkpoint, tmp_path)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                self.error = e
+                return
+            self.n_saved += 1
+
+    def check_error(self):
+        """
+        Raises the exception that stopped the background thread, if any.
+        """
+        if self.error is not None:
+            raise RuntimeError("Writing the checkpoint %s failed"%self.path) from self.error
+
+    def save(self, episode, agent, rngs=None, metrics=None):
+        """
+        Snapshots the training state after episode (number of completed episodes) and
+        queues it for writing.
+        """
+        self.check_error()
+        checkpoint = dict(episode=episode, agent=get_agent_state(agent), rng_states=get_rng_states(rngs),
+                          metrics=copy.deepcopy(metrics))
+        with self.condition:
+            self.pending = checkpoint
+            self.condition.notify()
+
+    def maybe_save(self, episode, agent, rngs=None, metrics=None, force=False):
+        """
+        Calls save every self.every episodes (or always if force is True).
+        """
+        if force or episode % self.every == 0:
+            self.save(episode, agent, rngs, metrics)
+
+    def close(self):
+        """
+        Waits until the pending checkpoint has been written.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.check_error()
+
+def load_checkpoint(path, agent=None, rngs=None):
+    """
+    Loads a checkpoint written by AsyncCheckpointer (path can be its checkpoint_dir) and, if
+    provided, restores the state of the agent (built with the same hyper-parameters) and of
+    the random number generators.
+
+    Returns
+    -------
+    checkpoint: dict
+        With keys episode, agent, rng_states and metrics
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, 'last.pt')
+    checkpoint = torch.load(path, weights_only=False)
+    if agent is not None:
+        set_agent_state(agent, checkpoint['agent'])
+    set_rng_states(checkpoint['rng_states'], rngs)
+    return checkpoint
@@ -0,0 +1,121 @@
+import numpy as np
+import torch
+import time
+
+from Utils import test_env
+from Utils.train_agent_sandbox import VEC_ENV_PARAMS
+
+def get_all_pairs(x, y, walls=None):
+    """
+    Enumerates all the (initial, goal) pairs of distinct cells of a x by y Sandbox such
+    that the goal can be reached from the initial position.
+
+    Returns
+    -------
+    initial, goal: arrays of int, shape (n_pairs, 2)
+    optimal_steps: array of int, shape (n_pairs,)
+        Length of the shortest path from initial to goal
+    """
+    walls = test_env.get_layout(walls)
+    free_cells = np.flatnonzero(~test_env.get_wall_mask(x, y, walls)[1:-1,1:-1])
+    cells = np.stack((free_cells//y, free_cells%y), axis=1)
+
+    initial, goal, optimal_steps = [], [], []
+    for g in cells:
+        dist = test_env.get_distance_field(x, y, tuple(g), walls)[cells[:,0]+1, cells[:,1]+1]
+        valid = (dist > 0) & np.isfinite(dist)
+        initial.append(cells[valid])
+        goal.append(np.broadcast_to(g, (valid.sum(), 2)))
+        optimal_steps.append(dist[valid])
+    return np.concatenate(initial), np.concatenate(goal), np.concatenate(optimal_steps).astype(int)
+
+def get_policy_table(agent, states, batch_size=1024):
+    """
+    Returns the action probabilities of the actor for all the states, forwarding at most
+    batch_size states at a time.
+    """
+    probs = []
+    with torch.inference_mode():
+        for i in range(0, len(states), batch_size):
+            probs.append(torch.exp(agent.forward(states[i:i+batch_size])).cpu().numpy())
+    return np.concatenate(probs)
+
+def evaluate_agent(agent, game_params, greedy=True, max_steps=0, batch_size=1024, seed=None, verbose=True):
+    """
+    Plays in parallel one episode for every (initial, goal) pair of the Sandbox described
+    by game_params.
+    
+    Notes
+    -----
+    * The state of a Sandbox is fully determined by the positions of the agent and of the 
+      goal, so the states that can be visited are exactly the initial states of all the pairs.
+      The actor (that is not updated during the evaluation) is run once on all of them in 
+      batches, then all the episodes are rolled out in lockstep looking up its action 
+      probabilities, instead of running the actor at every time-step.
+
+    Parameters
+    ----------
+    agent: A2C agent
+        Any agent with a forward(states) method returning log-probabilities
+    game_params: dict
+        Parameters of the Sandbox (initial and goal are ignored)
+    greedy: bool (default True)
+        If True the most probable action is always taken, otherwise actions are sampled
+    max_steps: int (default 0)
+        Maximum number of steps per episode. If 0 game_params["max_steps"] or the Sandbox
+        default is used
+    batch_size: int (default 1024)
+        Maximum number of states forwarded together by the actor
+    seed: int (default None)
+        Seed used to sample the actions if greedy is False
+
+    Returns
+    -------
+    results: dict
+        success_rate: fraction of episodes in which the goal was reached
+        excess_steps: mean number of steps more than the optimal ones (over the successful episodes)
+        optimal_rate: fraction of episodes solved in the optimal number of steps
+        plus initial, goal, optimal_steps, steps and success arrays, one entry per pair
+    """
+    t0 = time.time()
+    x, y = game_params["x"], game_params["y"]
+    walls = game_params.get("walls")
+    initial, goal, optimal_steps = get_all_pairs(x, y, walls)
+    n_pairs = len(initial)
+
+    env_params = {k:v for k,v in game_params.items() if k in VEC_ENV_PARAMS and k not in ["initial", "goal"]}
+    if max_steps != 0:
+        env_params["max_steps"] = max_steps
+    env = test_env.SandboxVecEnv(n_pairs, initial=initial, goal=goal, random_init=False, **env_params)
+    rng = np.random.default_rng(seed)
+
+    # probabilities of the actions in the state with agent in cell a and goal in cell g, at row table[g, a]
+    probs = get_policy_table(agent, env.reset(), batch_size)
+    table = np.zeros((x*y, x*y), dtype=int)
+    table[goal[:,0]*y + goal[:,1], initial[:,0]*y + initial[:,1]] = np.arange(n_pairs)
+    goal_idx = goal[:,0]*y + goal[:,1]
+
+    active = np.ones(n_pairs, dtype=bool)
+    steps = np.zeros(n_pairs, dtype=int)
+    success = np.zeros(n_pairs, dtype=bool)
+    while active.any():
+        p = probs[table[goal_idx, env.state[:,0]*y + env.state[:,1]]]
+        if greedy:
+            action = p.argmax(axis=1)
+        else:
+            u = rng.random((n_pairs, 1))*p.sum(axis=1, keepdims=True)
+            action = np.minimum((np.cumsum(p, axis=1) < u).sum(axis=1), p.shape[1]-1)
+        _, reward, terminal, truncated, info = env.step(action)
+        steps[active] += 1
+        success |= active & terminal & (reward == 1)
+        active &= ~terminal
+
+    excess_steps = (steps - optimal_steps)[success]
+    results = dict(success_rate=success.mean(),
+                   excess_steps=excess_steps.mean() if success.any() else np.nan,
+                   optimal_rate=(success & (steps == optimal_steps)).mean(),
+                   initial=initial, goal=goal, optimal_steps=optimal_steps, steps=steps, success=success)
+    if verbose:
+        print("Evaluated %d pairs in %.2f s - success rate: %.3f - excess steps: %.2f - optimal: %.3f"%(n_pairs,
+              time.time()-t0, results["success_rate"], results["excess_steps"], results["optimal_rate"]))
+    return results
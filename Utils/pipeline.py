@@ -0,0 +1,113 @@
+import copy
+import queue
+import threading
+import time
+
+from Utils.buffers import TrajectoryBuffer
+from RelationalModule.flat import copy_network, copy_parameters
+
+class PipelinedCollector():
+    """
+    Collects episodes in a background thread while the learner updates the agent on the
+    previous ones.
+
+    Notes
+    -----
+    * The collector acts with a private copy of the actor, refreshed (under a lock shared
+      with update) at the start of every episode, so acting never reads weights that are
+      being updated. The refresh is a single copy if the actor is flat (see flat.FlatParameters).
+      Acting is gradient-free (agent.act) and log-probabilities are recomputed at update time.
+    * Trajectories are stored in max_policy_lag+1 TrajectoryBuffers (double buffering for the
+      default max_policy_lag=1): an episode can start only when a buffer has been released by
+      the learner, so that every episode is played with a policy that is at most max_policy_lag
+      updates behind the one used to learn from it. With max_policy_lag=0 collection and
+      update are serialized.
+    * collector_wait and learner_wait accumulate the time (in seconds) each side spent waiting
+      for the other.
+    """
+    def __init__(self, agent, play_fn, max_steps, max_policy_lag=1):
+        """
+        Parameters
+        ----------
+        agent: A2C agent
+            Agent updated by the learner
+        play_fn: callable
+            play_fn(acting_agent, buffer) plays an episode with acting_agent storing it in buffer
+        max_steps: int
+            Capacity of the trajectory buffers
+        max_policy_lag: int (default 1)
+            Maximum number of updates between the policy that played an episode and the one
+            that learns from it
+        """
+        self.agent = agent
+        self.play_fn = play_fn
+        self.max_policy_lag = max_policy_lag
+
+        # shallow copy: only the actor is private to the collector
+        self.acting_agent = copy.copy(agent)
+        self.acting_agent.actor = copy_network(agent.actor)
+
+        self.free = queue.Queue()
+        for _ in range(max_policy_lag+1):
+            self.free.put(TrajectoryBuffer(max_steps, agent.device))
+        self.ready = queue.Queue()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.collector_wait = 0.
+        self.learner_wait = 0.
+        self.stop = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                t0 = time.time()
+                buffer = self.free.get()
+                self.collector_wait += time.time() - t0
+                if self.stop:
+                    return
+                with self.lock:
+                    copy_parameters(self.acting_agent.actor, self.agent.actor)
+                    version = self.version
+                self.play_fn(self.acting_agent, buffer)
+                self.ready.put((buffer, version))
+        except Exception as e:
+            # re-raised by the learner in get()
+            self.ready.put((e, None))
+
+    def get(self):
+        """
+        Waits for the next episode.
+
+        Returns
+        -------
+        buffer: TrajectoryBuffer
+            To be passed to update once used
+        lag: int
+            Number of updates done since the policy that played the episode
+        """
+        t0 = time.time()
+        buffer, version = self.ready.get()
+        self.learner_wait += time.time() - t0
+        if isinstance(buffer, Exception):
+            raise buffer
+        return buffer, self.version - version
+
+    def update(self, buffer):
+        """
+        Updates the agent with the episode stored in buffer and releases the buffer.
+        """
+        rewards, log_probs, distributions, states, done, bootstrap = buffer.get()
+        with self.lock:
+            losses = self.agent.update(rewards, log_probs, distributions, states, done, bootstrap,
+                                       actions=buffer.get_actions())
+            self.version += 1
+        self.free.put(buffer)
+        return losses
+
+    def close(self):
+        self.stop = True
+        self.free.put(None)
+        self.thread.join()
@@ -9,6 +9,7 @@ from torch.distributions import Categorical
 from torch.utils.data import DataLoader, Dataset, SubsetRandomSampler
 
 from Utils import test_env
+from Utils.test_env import random_start
 
 def supervised_training(net, lr, n_epochs, n_samples, game_params, get_probs=False):
     env = test_env.Sandbox(**game_params)
@@ -57,26 +58,27 @@ def play_optimal(env, get_probs=False):
     else:
         return actions, states
 
-def random_start(X=10, Y=10):
-    s1, s2 = np.random.choice(X*Y, 2, replace=False)
-    initial = [s1//X, s1%X]
-    goal = [s2//X, s2%X]
-    return initial, goal
-
-def create_action_state_set(game_params, size = 10000, get_probs=False):
+def create_action_state_set(game_params, size = 10000, get_probs=False, seed=None):
     action_memory = []
     state_memory = []
     
+    # Same env reused (and reconfigured) for all the episodes
+    env = None
+    rng = np.random.default_rng(seed)
+    
     while len(action_memory) < size:
         
         # Change game params
-        initial, goal = random_start(game_params["x"], game_params["y"])
+        initial, goal = random_start(game_params["x"], game_params["y"], rng, game_params.get("walls"))
 
         # All game parameters
         game_params["initial"] = initial
         game_params["goal"] = goal
 
-        env = test_env.Sandbox(**game_params)
+        if env is None:
+            env = test_env.Sandbox(**game_params, seed=rng.integers(2**32))
+        else:
+            env.reconfigure(initial, goal)
         
         actions, states = play_optimal(env, get_probs)
         action_memory += actions
@@ -319,8 +321,7 @@ def plot_decision_map(env, net, goal, coord=True):
                 if coord:
                     enc_state = env.enc_to_coord()
                 else:
-                    grey_state = env.enc_to_grey()
-                    enc_state = env.grey_to_onehot(grey_state)
+                    enc_state = test_env.coord_to_onehot(env.state, env.goal, env.boundary, walls=env.walls)
                 enc_state = torch.tensor(enc_state).float().to(device).unsqueeze(0)
                 #print("enc_state.shape: ", enc_state.shape)
                 log_probs = net(enc_state).squeeze()
@@ -1,5 +1,6 @@
 import numpy as np
 import time
+from functools import lru_cache
 
 BACKGROUND_COLOR = 0
 AGENT_COLOR = 1
@@ -8,19 +9,312 @@ WALL_COLOR = 3
 
 debug = False
 
+# Displacements of the actions, in the same order of Sandbox.action_map
+MOVEMENTS = np.array([[0, 1], [0, -1], [1, 0], [-1, 0]])
+
+def get_layout(walls=None):
+    """
+    Returns the layout of the interior walls as a sorted tuple of (x, y) cells, 
+    that can be used as a key for the cached quantities depending on it.
+    """
+    if walls is None:
+        return ()
+    return tuple(sorted(set((int(w[0]), int(w[1])) for w in walls)))
+
+@lru_cache(maxsize=256)
+def get_wall_mask(x, y, walls=()):
+    """
+    Returns a read-only boolean mask of shape (x+2, y+2) that is True on the outer walls
+    and on the interior walls listed in the layout walls (see get_layout).
+    """
+    wall_mask = np.zeros((x+2, y+2), dtype=bool)
+    wall_mask[0,:] = True
+    wall_mask[-1,:] = True
+    wall_mask[:,0] = True
+    wall_mask[:,-1] = True
+    for w in walls:
+        wall_mask[w[0]+1, w[1]+1] = True
+    wall_mask.flags.writeable = False
+    return wall_mask
+
+def random_start(X=10, Y=10, rng=None, walls=None):
+    """
+    Samples two distinct cells of a X by Y Sandbox that are not interior walls and can 
+    reach each other, used as initial and goal positions (see sample_start). rng is a 
+    np.random.Generator (default np.random).
+    """
+    if rng is None:
+        rng = np.random
+    initial, goal = sample_start(X, Y, 1, rng, get_layout(walls))
+    return list(initial[0]), list(goal[0])
+
+@lru_cache(maxsize=256)
+def get_components(x, y, walls=()):
+    """
+    Groups the free cells of a x by y Sandbox with interior walls (see get_layout) in 
+    connected components, i.e. sets of cells with finite distance from each other 
+    (see get_distance_field).
+    
+    Returns
+    -------
+    cells: array of int, read-only
+        Flat indexes of the free cells, sorted by component
+    start: array of int, read-only
+        Position in cells of the first cell of the component of each cell
+    size: array of int, read-only
+        Size of the component of each cell
+    """
+    free_cells = np.flatnonzero(~get_wall_mask(x, y, walls)[1:-1,1:-1])
+    labelled = np.zeros(x*y, dtype=bool)
+    cells, start, size = [], [], []
+    for c in free_cells:
+        if not labelled[c]:
+            component = np.flatnonzero(np.isfinite(get_distance_field(x, y, (c//y, c%y), walls)[1:-1,1:-1]))
+            labelled[component] = True
+            start += [len(cells)]*len(component)
+            size += [len(component)]*len(component)
+            cells += list(component)
+    cells, start, size = np.array(cells, dtype=int), np.array(start, dtype=int), np.array(size, dtype=int)
+    for a in [cells, start, size]:
+        a.flags.writeable = False
+    return cells, start, size
+
+def sample_start(x, y, n, rng, walls=(), goal=None):
+    """
+    Samples n (initial, goal) pairs of distinct cells of a x by y Sandbox with interior 
+    walls (see get_layout), uniformly among the pairs whose goal can be reached from the 
+    initial position. If goal is given, only the initial positions are sampled, among the 
+    cells from which goal can be reached. rng is a np.random.Generator or np.random.
+    
+    Returns
+    -------
+    initial, goal: arrays of int
+        Shape (n, 2)
+    """
+    cells, start, size = get_components(x, y, walls)
+    if goal is None:
+        # each cell is the initial position of as many pairs as the other cells of its component
+        weights = size - 1
+        assert weights.sum() > 0, "No two free cells can reach each other"
+        i = rng.choice(len(cells), n, p=weights/weights.sum())
+    else:
+        i = np.flatnonzero(cells == goal[0]*y + goal[1])
+        assert len(i) == 1 and size[i[0]] > 1, "No free cell can reach the goal"
+        i = np.repeat(i, n)
+    # sampling among the other size-1 cells of the component is sampling without replacement
+    j = (rng.random(n)*(size[i]-1)).astype(int)
+    j = j + (j >= i - start[i])
+    s1, s2 = cells[i], cells[start[i] + j]
+    if goal is not None:
+        s1, s2 = s2, s1
+    return np.stack((s1//y, s1%y), axis=1), np.stack((s2//y, s2%y), axis=1)
+
+@lru_cache(maxsize=1024)
+def get_distance_field(x, y, goal, walls=()):
+    """
+    Computes with a breadth-first search the length of the shortest path from every cell 
+    of a x by y Sandbox with interior walls to the goal. Results are cached, so that the 
+    search is done only once per (x, y, goal, walls).
+    
+    Returns
+    -------
+    dist: array of float, read-only
+        Shape (x+2, y+2), padded like the greyscale image. Walls and cells from which 
+        the goal can't be reached have distance np.inf
+    """
+    wall_mask = get_wall_mask(x, y, walls)
+    assert not wall_mask[goal[0]+1, goal[1]+1], "The goal can't be placed on a wall"
+    dist = np.full(wall_mask.shape, np.inf)
+    frontier = np.zeros(wall_mask.shape, dtype=bool)
+    frontier[goal[0]+1, goal[1]+1] = True
+    dist[frontier] = 0
+    d = 0
+    while frontier.any():
+        d += 1
+        # expand the frontier of one step in all directions (the outer walls prevent wrapping)
+        neighbours = np.zeros(wall_mask.shape, dtype=bool)
+        neighbours[1:,:] |= frontier[:-1,:]
+        neighbours[:-1,:] |= frontier[1:,:]
+        neighbours[:,1:] |= frontier[:,:-1]
+        neighbours[:,:-1] |= frontier[:,1:]
+        frontier = neighbours & ~wall_mask & np.isinf(dist)
+        dist[frontier] = d
+    dist.flags.writeable = False
+    return dist
+
+@lru_cache(maxsize=1024)
+def get_optimal_policy(x, y, goal, walls=()):
+    """
+    Computes the optimal policy with maximum entropy (equal probability to all the actions
+    that reduce the distance from the goal) for every cell of a x by y Sandbox.
+    The distance is the one of get_distance_field, that reduces to the Manhattan distance
+    without interior walls. Results are cached, so that the table is computed only once 
+    per (x, y, goal, walls).
+    
+    Parameters
+    ----------
+    x, y: int
+        Size of the grid
+    goal: tuple of int
+        Goal position
+    walls: tuple (default ())
+        Layout of the interior walls (see get_layout)
+        
+    Returns
+    -------
+    probs: array of float, read-only
+        Shape (x, y, n_actions). The rows of the goal cell, of the walls and of the cells
+        that can't reach the goal are all zeros, since no action is optimal there
+    """
+    dist = get_distance_field(x, y, goal, walls)
+    d0 = dist[1:-1,1:-1]
+    optimal = np.zeros((x, y, len(MOVEMENTS)))
+    for action, movement in enumerate(MOVEMENTS):
+        # distance of the cell reached with the action (walls have infinite distance)
+        d = dist[1+movement[0]:x+1+movement[0], 1+movement[1]:y+1+movement[1]]
+        optimal[:,:,action] = (d < d0)
+    # walls and unreachable cells have infinite distance, larger than the one of their neighbours
+    optimal[np.isinf(d0)] = 0
+    n_optimal = optimal.sum(axis=-1, keepdims=True)
+    probs = np.divide(optimal, n_optimal, out=np.zeros_like(optimal), where=(n_optimal > 0))
+    # the same table is shared by all the environments with the same goal and layout
+    probs.flags.writeable = False
+    return probs
+
+def get_optimal_probs(x, y, states, goals, walls=()):
+    """
+    Bulk version of Sandbox.get_optimal_action(show_all=True)[1] for a batch of states 
+    of x by y Sandboxes with the same layout, each with its own goal.
+    
+    Parameters
+    ----------
+    states, goals: array of int
+        Shape (batch_size, 2)
+    walls: tuple (default ())
+        Layout of the interior walls (see get_layout)
+        
+    Returns
+    -------
+    probs: array of float
+        Shape (batch_size, n_actions)
+    """
+    states = np.asarray(states)
+    goals = np.asarray(goals)
+    probs = np.empty((len(states), len(MOVEMENTS)))
+    unique_goals, inverse = np.unique(goals, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for i, goal in enumerate(unique_goals):
+        mask = (inverse == i)
+        table = get_optimal_policy(int(x), int(y), (int(goal[0]), int(goal[1])), walls)
+        probs[mask] = table[states[mask,0], states[mask,1]]
+    return probs
+
+def coord_to_onehot(state, goal, boundary, out=None, walls=()):
+    """
+    Writes the one-hot encoding of a Sandbox (agent, goal and wall planes) directly 
+    from the coordinates of agent and goal, without building the greyscale image.
+    Equivalent to Sandbox.grey_to_onehot(Sandbox.enc_to_grey()), but in float32.
+    
+    Parameters
+    ----------
+    state, goal: array of int
+        Shape (2,)
+    boundary: array of int
+        Size (x, y) of the grid
+    out: array of float32 (optional)
+        Preallocated buffer of shape (3, x+2, y+2) in which the encoding is written
+    walls: tuple (default ())
+        Layout of the interior walls (see get_layout)
+        
+    Returns
+    -------
+    out: array of float32
+        Shape (3, x+2, y+2)
+    """
+    out = batch_coord_to_onehot(np.asarray(state)[np.newaxis], np.asarray(goal)[np.newaxis], boundary,
+                                None if out is None else out[np.newaxis], walls)
+    return out[0]
+
+def batch_coord_to_onehot(states, goals, boundary, out=None, walls=()):
+    """
+    Batched version of coord_to_onehot.
+    
+    Parameters
+    ----------
+    states, goals: array of int
+        Shape (batch_size, 2)
+    boundary: array of int
+        Size (x, y) of the grid
+    out: array of float32 (optional)
+        Preallocated buffer of shape (batch_size, 3, x+2, y+2)
+    walls: tuple (default ())
+        Layout of the interior walls (see get_layout)
+        
+    Returns
+    -------
+    out: array of float32
+        Shape (batch_size, 3, x+2, y+2)
+    """
+    states = np.asarray(states)
+    goals = np.asarray(goals)
+    n = len(states)
+    if out is None:
+        out = np.empty((n, 3, boundary[0]+2, boundary[1]+2), dtype=np.float32)
+    rows = np.arange(n)
+    out[:,:2] = 0.
+    out[:,2] = get_wall_plane(int(boundary[0]), int(boundary[1]), walls)
+    out[rows, 0, states[:,0]+1, states[:,1]+1] = 1.
+    out[rows, 1, goals[:,0]+1, goals[:,1]+1] = 1.
+    # the agent hides the goal when it's on top of it, as in the greyscale image
+    out[rows, 1, states[:,0]+1, states[:,1]+1] = 0.
+    return out
+
+@lru_cache(maxsize=256)
+def get_wall_plane(x, y, walls=()):
+    """
+    Returns the (read-only) wall plane of the one-hot encoding of a x by y Sandbox.
+    """
+    wall_plane = get_wall_mask(x, y, walls).astype(np.float32)
+    wall_plane.flags.writeable = False
+    return wall_plane
+
+def sample_actions(probs, rng=None):
+    """
+    Samples one action for each row of probs (shape (batch_size, n_actions)).
+    If rng (a np.random.Generator) is None, the global NumPy random state is used.
+    """
+    if rng is None:
+        u = np.random.rand(len(probs), 1)
+    else:
+        u = rng.random((len(probs), 1))
+    return np.argmax(np.cumsum(probs, axis=1) > u, axis=1)
+
 class Sandbox():
     
-    def __init__(self, x, y, initial, goal, R0=0, max_steps=0, greyscale_state=True, return_coord=False, return_ohe=False):
+    def __init__(self, x, y, initial, goal, R0=0, max_steps=0, greyscale_state=True, return_coord=False, return_ohe=False,
+                 persistent_board=False, copy_state=True, seed=None, walls=None):
         
         self.greyscale = greyscale_state
         self.return_coord = return_coord
         self.return_ohe = return_ohe
+        # If persistent_board is True, the greyscale image (or the one-hot encoding if return_ohe is True) 
+        # is kept in a buffer painted once per episode and only the previous and current agent cells 
+        # are updated at each step.
+        # With copy_state=False the buffer is returned as a read-only view, that changes as the env steps.
+        self.persistent_board = persistent_board
+        self.copy_state = copy_state
+        self.board = None
+        # Random number generator owned by the env (random initialization and optimal actions)
+        self.rng = np.random.default_rng(seed)
         
         self.boundary = np.asarray([x, y])
         self.initial = np.asarray(initial)
         self.state = np.asarray(initial)
         self.goal = goal
         self.R0 = R0
+        # Interior walls (list of [x,y] cells, None for an empty rectangle), painted with WALL_COLOR
+        self.walls = get_layout(walls)
+        self.wall_mask = get_wall_mask(x, y, self.walls)
         # top-left corner is [0,0], bottom-right is [x,y]
         # vertical direction is x (first coordinate)
         # horizontal direction is y (second coordinate)
@@ -54,6 +348,7 @@ class Sandbox():
         movement = self.action_map[action]
         
         # Compute next vectorial state
+        old_state = self.state
         next_state = self.state + np.asarray(movement)
         
         if not (self.check_boundaries(next_state)):
@@ -75,15 +370,10 @@ class Sandbox():
         if self.current_steps == self.max_steps:
             terminal = True
             info['TimeLimit.truncated'] = True
-          
-        if self.return_coord:
-            enc_state = self.enc_to_coord()
-        elif self.greyscale:
-            enc_state = self.enc_to_grey()
-            if self.return_ohe:
-                enc_state = self.grey_to_onehot(enc_state)
-        else:
-            enc_state = self.encode_state()
+        
+        if self.persistent_board:
+            self.update_board(old_state)
+        enc_state = self.get_enc_state()
             
         return enc_state, reward, terminal, info
 
@@ -92,7 +382,8 @@ class Sandbox():
         y_ok = (state[1] >= 0) and (state[1] < self.boundary[1])
         
         if x_ok and y_ok:
-            return True
+            # interior walls can't be crossed either
+            return not self.wall_mask[state[0]+1, state[1]+1]
         else:
             return False
         
@@ -106,12 +397,74 @@ class Sandbox():
         grey_img = np.full((self.boundary[0]+2, self.boundary[1]+2), BACKGROUND_COLOR).astype(int)
         grey_img[self.goal[0]+1,self.goal[1]+1] = GOAL_COLOR
         grey_img[self.state[0]+1,self.state[1]+1] = AGENT_COLOR
-        grey_img[0,:] = WALL_COLOR
-        grey_img[-1,:] = WALL_COLOR
-        grey_img[:,0] = WALL_COLOR
-        grey_img[:,-1] = WALL_COLOR
+        grey_img[self.wall_mask] = WALL_COLOR
         return np.array([grey_img])
     
+    def paint_board(self):
+        """
+        Paints walls, goal and agent on the persistent board, allocating it only the first time.
+        """
+        if self.return_ohe:
+            shape = (3, self.boundary[0]+2, self.boundary[1]+2)
+            if self.board is None or self.board.shape != shape:
+                self.board = np.empty(shape, dtype=np.float32)
+            coord_to_onehot(self.state, self.goal, self.boundary, out=self.board, walls=self.walls)
+            return
+        
+        shape = (1, self.boundary[0]+2, self.boundary[1]+2)
+        if self.board is None or self.board.shape != shape:
+            self.board = np.empty(shape, dtype=int)
+        grey_img = self.board[0]
+        grey_img[...] = BACKGROUND_COLOR
+        grey_img[self.goal[0]+1,self.goal[1]+1] = GOAL_COLOR
+        grey_img[self.state[0]+1,self.state[1]+1] = AGENT_COLOR
+        grey_img[self.wall_mask] = WALL_COLOR
+        
+    def update_board(self, old_state):
+        """
+        Moves the agent on the persistent board from old_state to the current state.
+        """
+        if self.return_ohe:
+            agent_plane, goal_plane = self.board[0], self.board[1]
+            agent_plane[old_state[0]+1,old_state[1]+1] = 0.
+            if (old_state == self.goal).all():
+                goal_plane[old_state[0]+1,old_state[1]+1] = 1.
+            agent_plane[self.state[0]+1,self.state[1]+1] = 1.
+            goal_plane[self.state[0]+1,self.state[1]+1] = 0.
+            return
+        
+        grey_img = self.board[0]
+        if (old_state == self.goal).all():
+            grey_img[old_state[0]+1,old_state[1]+1] = GOAL_COLOR
+        else:
+            grey_img[old_state[0]+1,old_state[1]+1] = BACKGROUND_COLOR
+        grey_img[self.state[0]+1,self.state[1]+1] = AGENT_COLOR
+        
+    def get_board(self):
+        """
+        Returns a copy of the persistent board or, if copy_state is False, a read-only view of it.
+        """
+        if self.copy_state:
+            return self.board.copy()
+        else:
+            board_view = self.board.view()
+            board_view.flags.writeable = False
+            return board_view
+    
+    def get_enc_state(self):
+        if self.return_coord:
+            enc_state = self.enc_to_coord()
+        elif self.greyscale:
+            if self.persistent_board:
+                enc_state = self.get_board()
+            elif self.return_ohe:
+                enc_state = coord_to_onehot(self.state, self.goal, self.boundary, walls=self.walls)
+            else:
+                enc_state = self.enc_to_grey()
+        else:
+            enc_state = self.encode_state()
+        return enc_state
+    
     def enc_to_coord(self):
         x_agent = self.state[0]/self.boundary[0]
         y_agent = self.state[1]/self.boundary[1]
@@ -133,61 +486,72 @@ class Sandbox():
             ohe_state[i][mask] = 1.
         return ohe_state
         
-    def reset(self, random_init=False):
+    def reconfigure(self, initial, goal):
+        """
+        Changes initial and goal positions reusing the same env (and its buffers). 
+        Call reset to start the new episode.
+        """
+        self.initial = np.array(initial)
+        self.state = self.initial
+        self.goal = np.array(goal)
+        
+    def reset(self, random_init=False, seed=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
         if random_init:
-            self.initial[0] = np.random.choice(self.boundary[0]-1)
-            self.initial[1] = np.random.choice(self.boundary[1]-1)
+            initial, _ = sample_start(int(self.boundary[0]), int(self.boundary[1]), 1, self.rng, self.walls, 
+                                      goal=self.goal)
+            self.initial = initial[0]
         self.state = self.initial
         self.current_steps = 0
         
-        if self.return_coord:
-            enc_state = self.enc_to_coord()
-        elif self.greyscale:
-            enc_state = self.enc_to_grey()
-            if self.return_ohe:
-                enc_state = self.grey_to_onehot(enc_state)
-        else:
-            enc_state = self.encode_state()
-        return enc_state
+        if self.persistent_board:
+            self.paint_board()
+        return self.get_enc_state()
     
     def dist_to_goal(self, state):
+        if self.walls:
+            # length of the shortest path avoiding the walls
+            dist = get_distance_field(int(self.boundary[0]), int(self.boundary[1]), 
+                                      (int(self.goal[0]), int(self.goal[1])), self.walls)
+            return dist[state[0]+1, state[1]+1]
         dx = np.abs(state[0] - self.goal[0])
         dy = np.abs(state[1] - self.goal[1])
         return dx + dy
     
+    def get_optimal_policy(self):
+        """
+        Returns the cached (x, y, n_actions) table of optimal action probabilities for the current goal and layout.
+        """
+        return get_optimal_policy(int(self.boundary[0]), int(self.boundary[1]), (int(self.goal[0]), int(self.goal[1])), 
+                                  self.walls)
+    
     def get_optimal_action(self, show_all=False):
         if debug:
             print("self.state: ", self.state)
-        optimal = np.zeros(self.n_actions)
-        d0 = self.dist_to_goal(self.state)
-        # consider all actions
-        for action in range(self.n_actions):
-            # compute for each the resulting state)
-            movement = self.action_map[action]
-            next_state = self.state + np.asarray(movement)
-            if(self.check_boundaries(next_state)):
-                # if the state is admitted -> compute the distance to the goal 
-                d = self.dist_to_goal(next_state)
-                # if the new distance is smaller than the old one, is an optimal action (optimal = 1.)
-                if d < d0:
-                    optimal[action] = 1.
-                else:
-                    optimal[action] = 0.
-            else:
-                # oterwise is not (optimal = 0)
-                optimal[action] = 0.
-        # once we have the vector of optimal, divide them by the sum
-        probs = optimal/optimal.sum()
+        # probability of each action is 1/(number of optimal actions) if optimal, 0 otherwise
+        probs = self.get_optimal_policy()[self.state[0], self.state[1]]
         if debug: 
-            print("optimal: ", optimal)
             print("probs: ", probs)
         # finally sample the action and return it together with the log of the probability
-        opt_action = np.random.choice(self.n_actions, p=probs)
+        opt_action = self.rng.choice(self.n_actions, p=probs)
         if show_all:
             return opt_action, probs
         else:
             return opt_action
     
+    def get_optimal_actions(self, states, show_all=False):
+        """
+        Samples optimal actions for a batch of states (shape (batch_size, 2)) with the current goal.
+        """
+        states = np.asarray(states)
+        probs = self.get_optimal_policy()[states[:,0], states[:,1]]
+        opt_actions = sample_actions(probs, self.rng)
+        if show_all:
+            return opt_actions, probs
+        else:
+            return opt_actions
+    
     def __str__(self):
         print("Use greyscale state: ", self.greyscale)
         print("Use coordinate state: ", self.return_coord)
@@ -196,11 +560,214 @@ class Sandbox():
         print("Initial position: ", self.initial)
         print("Current position: ", self.state)
         print("Goal position: ", self.goal)
+        print("Interior walls: ", self.walls)
         
         opt_action, optimal = self.get_optimal_action(show_all=True)
         print("Optimal actions: ")
         for i in range(self.n_actions):
-            if optimal[i] == 1:
+            if optimal[i] > 0:
                 print('\t'+self.action_dict[i])
         print("Greyscale representation: \n", self.enc_to_grey())
         return ''
+
+
+class SandboxVecEnv():
+    """
+    Batched version of Sandbox that holds the agent and goal positions of n_envs
+    independent grids as arrays and steps all of them with a single NumPy call.
+    
+    Notes
+    -----
+    * Each sub-environment follows exactly the semantics of Sandbox.step: invalid
+      movements leave the agent in place, reaching the goal gives reward 1 and 
+      terminates the episode, otherwise the reward is R0; the episode is also
+      terminated (and flagged as truncated) when max_steps is reached.
+    * Sub-environments that terminate are automatically reset. The observation
+      returned for them is the first one of the new episode, while the last 
+      observation of the old episode is stored in info['final_state'].
+    """
+    
+    def __init__(self, n_envs, x, y, initial=None, goal=None, R0=0, max_steps=0, greyscale_state=True, 
+                 return_coord=False, return_ohe=False, random_init=True, seed=None, walls=None):
+        """
+        Parameters
+        ----------
+        n_envs: int
+            Number of Sandbox environments stepped in parallel
+        x, y: int
+            Vertical and horizontal size of each grid
+        initial, goal: list or array (default None)
+            Initial and goal positions, either shape (2,) (same for all environments) or 
+            (n_envs, 2). Required only if random_init is False
+        R0: float (default 0)
+            Baseline reward given at every step
+        max_steps: int (default 0)
+            Maximum number of steps per episode. If 0 it's set to 5 times the greatest 
+            linear dimension, as in Sandbox
+        greyscale_state, return_coord, return_ohe: bool
+            Same state encoding options of Sandbox
+        random_init: bool (default True)
+            If True, initial and goal positions are sampled (without replacement) at every 
+            reset, as done by random_start
+        seed: int (default None)
+            Seed of the np.random.Generator owned by the env
+        walls: list of [x,y] cells (default None)
+            Layout of the interior walls, shared by all the environments
+        """
+        self.n_envs = n_envs
+        self.greyscale = greyscale_state
+        self.return_coord = return_coord
+        self.return_ohe = return_ohe
+        self.random_init = random_init
+        self.rng = np.random.default_rng(seed)
+        
+        self.boundary = np.asarray([x, y])
+        self.R0 = R0
+        self.action_map = {
+                            0: [0, 1],
+                            1: [0, -1],
+                            2: [1, 0],
+                            3: [-1, 0],
+                          }
+        self.action_dict = {
+                            0: 'Right',
+                            1: 'Left',
+                            2: 'Down',
+                            3: 'Up',
+                          }
+        self.n_actions = len(self.action_map.keys())
+        # movements[a] is the displacement of action a
+        self.movements = np.array([self.action_map[a] for a in range(self.n_actions)])
+        if max_steps == 0:
+            self.max_steps = 5*int(np.max([x,y]))
+        else:
+            self.max_steps = max_steps
+            
+        if not random_init:
+            assert (initial is not None) and (goal is not None), \
+                "Provide initial and goal positions if random_init is False"
+            self.initial = np.array(np.broadcast_to(initial, (n_envs, 2)))
+            self.goal = np.array(np.broadcast_to(goal, (n_envs, 2)))
+        else:
+            self.initial = np.zeros((n_envs, 2), dtype=int)
+            self.goal = np.zeros((n_envs, 2), dtype=int)
+        self.state = self.initial.copy()
+        self.current_steps = np.zeros(n_envs, dtype=int)
+        
+        self.walls = get_layout(walls)
+        self.wall_mask = get_wall_mask(x, y, self.walls)
+        
+        # Board with walls only, copied at every greyscale encoding
+        self.background = np.full((x+2, y+2), BACKGROUND_COLOR).astype(int)
+        self.background[self.wall_mask] = WALL_COLOR
+        
+    def random_start(self, n):
+        """
+        Samples n pairs of distinct (initial, goal) positions that can reach each other.
+        """
+        return sample_start(int(self.boundary[0]), int(self.boundary[1]), n, self.rng, self.walls)
+    
+    def reset_envs(self, idx):
+        """
+        Resets only the sub-environments whose indexes are in idx.
+        """
+        if self.random_init:
+            self.initial[idx], self.goal[idx] = self.random_start(len(idx))
+        self.state[idx] = self.initial[idx]
+        self.current_steps[idx] = 0
+        
+    def reset(self, seed=None):
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self.reset_envs(np.arange(self.n_envs))
+        return self.encode()
+    
+    def step(self, actions):
+        """
+        Parameters
+        ----------
+        actions: array of int
+            Shape (n_envs,)
+            
+        Returns
+        -------
+        enc_states: array
+            Encoded states of all the environments (after the autoreset)
+        rewards: array of float, shape (n_envs,)
+        terminal: array of bool, shape (n_envs,)
+            True if the goal was reached or the maximum number of steps was hit
+        truncated: array of bool, shape (n_envs,)
+            True if the maximum number of steps was hit
+        info: dict
+            If some environment terminated, contains 'final_state' with the last encoded 
+            states of the terminated episodes (in the order given by np.nonzero(terminal))
+        """
+        self.current_steps += 1
+        
+        # Compute next vectorial states and update only the valid ones
+        next_state = self.state + self.movements[np.asarray(actions)]
+        # the padded wall mask covers both the outer and the interior walls
+        valid = ~self.wall_mask[next_state[:,0]+1, next_state[:,1]+1]
+        self.state[valid] = next_state[valid]
+        
+        at_goal = np.all(self.state == self.goal, axis=1)
+        rewards = np.where(at_goal, 1., float(self.R0))
+        truncated = (self.current_steps == self.max_steps)
+        terminal = at_goal | truncated
+        
+        info = {}
+        if terminal.any():
+            idx = np.nonzero(terminal)[0]
+            info['final_state'] = self.encode(idx)
+            self.reset_envs(idx)
+            
+        return self.encode(), rewards, terminal, truncated, info
+    
+    def get_optimal_action(self, show_all=False):
+        """
+        Samples an optimal action for every environment.
+        """
+        probs = get_optimal_probs(self.boundary[0], self.boundary[1], self.state, self.goal, self.walls)
+        opt_actions = sample_actions(probs, self.rng)
+        if show_all:
+            return opt_actions, probs
+        else:
+            return opt_actions
+        
+    def encode(self, idx=None):
+        if idx is None:
+            idx = np.arange(self.n_envs)
+        if self.return_coord:
+            enc_state = self.enc_to_coord(idx)
+        elif self.greyscale:
+            if self.return_ohe:
+                enc_state = batch_coord_to_onehot(self.state[idx], self.goal[idx], self.boundary, walls=self.walls)
+            else:
+                enc_state = self.enc_to_grey(idx)
+        else:
+            enc_state = self.encode_state(idx)
+        return enc_state
+    
+    def encode_state(self, idx):
+        return self.boundary[0]*self.state[idx,1] + self.state[idx,0]
+    
+    def enc_to_grey(self, idx):
+        """
+        Returns an array of shape (len(idx), 1, x+2, y+2)
+        """
+        n = len(idx)
+        grey_img = np.repeat(self.background[np.newaxis, np.newaxis], n, axis=0)
+        rows = np.arange(n)
+        grey_img[rows, 0, self.goal[idx,0]+1, self.goal[idx,1]+1] = GOAL_COLOR
+        grey_img[rows, 0, self.state[idx,0]+1, self.state[idx,1]+1] = AGENT_COLOR
+        return grey_img
+    
+    def enc_to_coord(self, idx):
+        """
+        Returns an array of shape (len(idx), 5)
+        """
+        state = self.state[idx]
+        goal = self.goal[idx]
+        near_boundary = np.any((state == 0) | (state == self.boundary-1), axis=1)
+        return np.concatenate((state/self.boundary, goal/self.boundary, 
+                               near_boundary.astype(float)[:,np.newaxis]), axis=1)
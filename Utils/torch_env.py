@@ -0,0 +1,227 @@
+import numpy as np
+import torch
+
+from Utils.test_env import BACKGROUND_COLOR, AGENT_COLOR, GOAL_COLOR, WALL_COLOR, MOVEMENTS, get_layout, get_wall_mask, \
+                           get_components
+
+debug = False
+
+class TorchSandboxVecEnv():
+    """
+    Torch backend of SandboxVecEnv: agent and goal positions of n_envs Sandboxes live
+    in torch tensors on the agent's device, so that batched observations come out as
+    ready-to-use tensors and can be fed to the actor without any NumPy conversion.
+
+    Notes
+    -----
+    * Same semantics of Sandbox.step and SandboxVecEnv.step (including the autoreset
+      of terminated environments, whose last observation is stored in info['final_state']).
+    * All the returned quantities are tensors on the selected device.
+    """
+
+    def __init__(self, n_envs, x, y, initial=None, goal=None, R0=0, max_steps=0, greyscale_state=True,
+                 return_coord=False, return_ohe=False, random_init=True, seed=None, device='cpu',
+                 dtype=torch.float32, walls=None):
+        """
+        Parameters
+        ----------
+        n_envs: int
+            Number of Sandbox environments stepped in parallel
+        x, y: int
+            Vertical and horizontal size of each grid
+        initial, goal: list or array (default None)
+            Initial and goal positions, either shape (2,) (same for all environments) or
+            (n_envs, 2). Required only if random_init is False
+        R0: float (default 0)
+            Baseline reward given at every step
+        max_steps: int (default 0)
+            Maximum number of steps per episode. If 0 it's set to 5 times the greatest
+            linear dimension, as in Sandbox
+        greyscale_state, return_coord, return_ohe: bool
+            Same state encoding options of Sandbox
+        random_init: bool (default True)
+            If True, initial and goal positions are sampled (without replacement) at every reset
+        seed: int (default None)
+            Seed of the torch.Generator owned by the env
+        device: str in {'cpu','cuda'}
+            Device on which the state of the envs and the observations are stored
+        dtype: torch.dtype (default torch.float32)
+            Type of greyscale and one-hot observations (e.g. torch.float32 or torch.uint8)
+        walls: list of [x,y] cells (default None)
+            Layout of the interior walls, shared by all the environments
+        """
+        self.n_envs = n_envs
+        self.greyscale = greyscale_state
+        self.return_coord = return_coord
+        self.return_ohe = return_ohe
+        self.random_init = random_init
+        self.device = torch.device(device)
+        self.dtype = dtype
+
+        self.rng = torch.Generator(device=self.device)
+        if seed is None:
+            self.rng.seed()
+        else:
+            self.rng.manual_seed(seed)
+
+        self.boundary = torch.tensor([x, y], device=self.device)
+        self.R0 = R0
+        self.action_dict = {
+                            0: 'Right',
+                            1: 'Left',
+                            2: 'Down',
+                            3: 'Up',
+                          }
+        self.n_actions = len(self.action_dict.keys())
+        self.movements = torch.as_tensor(MOVEMENTS, device=self.device)
+        if max_steps == 0:
+            self.max_steps = 5*int(np.max([x,y]))
+        else:
+            self.max_steps = max_steps
+
+        if not random_init:
+            assert (initial is not None) and (goal is not None), \
+                "Provide initial and goal positions if random_init is False"
+            self.initial = torch.as_tensor(initial, device=self.device).long().expand(n_envs, 2).clone()
+            self.goal = torch.as_tensor(goal, device=self.device).long().expand(n_envs, 2).clone()
+        else:
+            self.initial = torch.zeros((n_envs, 2), dtype=torch.long, device=self.device)
+            self.goal = torch.zeros((n_envs, 2), dtype=torch.long, device=self.device)
+        self.state = self.initial.clone()
+        self.current_steps = torch.zeros(n_envs, dtype=torch.long, device=self.device)
+
+        self.walls = get_layout(walls)
+        walls = torch.tensor(get_wall_mask(x, y, self.walls), device=self.device)
+        self.wall_mask = walls
+        # free cells grouped by connected component (see test_env.get_components)
+        self.cells, self.start, self.size = [torch.tensor(a, device=self.device) 
+                                             for a in get_components(x, y, self.walls)]
+        # each cell is the initial position of as many pairs as the other cells of its component
+        self.start_weights = (self.size - 1).float()
+        assert self.start_weights.sum() > 0, "No two free cells can reach each other"
+        
+        # Greyscale board and wall plane with walls only, copied at every encoding
+        self.wall_plane = walls.to(dtype)
+        self.background = torch.where(walls, WALL_COLOR, BACKGROUND_COLOR).to(dtype)
+
+    def random_start(self, n):
+        """
+        Samples n pairs of distinct (initial, goal) positions that can reach each other, 
+        as test_env.sample_start.
+        """
+        i = torch.multinomial(self.start_weights, n, replacement=True, generator=self.rng)
+        # sampling among the other size-1 cells of the component is sampling without replacement
+        j = (torch.rand(n, generator=self.rng, device=self.device)*(self.size[i]-1)).long()
+        j = j + (j >= i - self.start[i]).long()
+        s1 = self.cells[i]
+        s2 = self.cells[self.start[i] + j]
+        y = self.boundary[1]
+        initial = torch.stack((s1 // y, s1 % y), dim=1)
+        goal = torch.stack((s2 // y, s2 % y), dim=1)
+        return initial, goal
+
+    def reset_envs(self, idx):
+        """
+        Resets only the sub-environments whose indexes are in idx (tensor of long).
+        """
+        if self.random_init:
+            self.initial[idx], self.goal[idx] = self.random_start(len(idx))
+        self.state[idx] = self.initial[idx]
+        self.current_steps[idx] = 0
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.rng.manual_seed(seed)
+        self.reset_envs(torch.arange(self.n_envs, device=self.device))
+        return self.encode()
+
+    def step(self, actions):
+        """
+        Parameters
+        ----------
+        actions: tensor or array of int
+            Shape (n_envs,)
+
+        Returns
+        -------
+        enc_states: tensor
+            Encoded states of all the environments (after the autoreset)
+        rewards: tensor of float32, shape (n_envs,)
+        terminal: tensor of bool, shape (n_envs,)
+        truncated: tensor of bool, shape (n_envs,)
+        info: dict
+            If some environment terminated, contains 'final_state' with the last encoded
+            states of the terminated episodes
+        """
+        actions = torch.as_tensor(actions, device=self.device).long()
+        self.current_steps += 1
+
+        next_state = self.state + self.movements[actions]
+        # the padded wall mask covers both the outer and the interior walls
+        valid = ~self.wall_mask[next_state[:,0]+1, next_state[:,1]+1]
+        self.state = torch.where(valid.unsqueeze(1), next_state, self.state)
+
+        at_goal = (self.state == self.goal).all(dim=1)
+        rewards = torch.where(at_goal, 1., float(self.R0))
+        truncated = (self.current_steps == self.max_steps)
+        terminal = at_goal | truncated
+
+        info = {}
+        idx = terminal.nonzero().squeeze(1)
+        if len(idx) > 0:
+            info['final_state'] = self.encode(idx)
+            self.reset_envs(idx)
+
+        return self.encode(), rewards, terminal, truncated, info
+
+    def encode(self, idx=None):
+        if idx is None:
+            idx = torch.arange(self.n_envs, device=self.device)
+        if self.return_coord:
+            enc_state = self.enc_to_coord(idx)
+        elif self.greyscale:
+            if self.return_ohe:
+                enc_state = self.enc_to_onehot(idx)
+            else:
+                enc_state = self.enc_to_grey(idx)
+        else:
+            enc_state = self.encode_state(idx)
+        return enc_state
+
+    def encode_state(self, idx):
+        return self.boundary[0]*self.state[idx,1] + self.state[idx,0]
+
+    def enc_to_grey(self, idx):
+        """
+        Returns a tensor of shape (len(idx), 1, x+2, y+2)
+        """
+        n = len(idx)
+        grey_img = self.background.expand(n, 1, -1, -1).clone()
+        rows = torch.arange(n, device=self.device)
+        grey_img[rows, 0, self.goal[idx,0]+1, self.goal[idx,1]+1] = GOAL_COLOR
+        grey_img[rows, 0, self.state[idx,0]+1, self.state[idx,1]+1] = AGENT_COLOR
+        return grey_img
+
+    def enc_to_onehot(self, idx):
+        """
+        Returns a tensor of shape (len(idx), 3, x+2, y+2)
+        """
+        n = len(idx)
+        ohe_state = torch.zeros((n, 3)+self.wall_plane.shape, dtype=self.dtype, device=self.device)
+        ohe_state[:,2] = self.wall_plane
+        rows = torch.arange(n, device=self.device)
+        ohe_state[rows, 1, self.goal[idx,0]+1, self.goal[idx,1]+1] = 1
+        # the agent hides the goal when it's on top of it
+        ohe_state[rows, 1, self.state[idx,0]+1, self.state[idx,1]+1] = 0
+        ohe_state[rows, 0, self.state[idx,0]+1, self.state[idx,1]+1] = 1
+        return ohe_state
+
+    def enc_to_coord(self, idx):
+        """
+        Returns a tensor of float32 of shape (len(idx), 5)
+        """
+        state = self.state[idx]
+        goal = self.goal[idx]
+        near_boundary = ((state == 0) | (state == self.boundary-1)).any(dim=1)
+        return torch.cat((state/self.boundary, goal/self.boundary,
+                          near_boundary.float().unsqueeze(1)), dim=1).float()
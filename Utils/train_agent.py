@@ -3,15 +3,23 @@ import sys
 sys.path.insert(0, "RelationalDeepRL/pycolab/pycolab/examples/research/box_world")
 sys.path.insert(0, "pycolab/pycolab/examples/research/box_world")
 
-import box_world as bw
+try:
+    import box_world as bw
+except ImportError:
+    # pycolab submodule not checked out: use the in-repo implementation of BoxWorld
+    from Utils import boxworld_env as bw
+from Utils import boxworld_env
 
 import numpy as np
-import torch
 from RelationalModule import ActorCritic
+from Utils.buffers import TrajectoryBuffer, get_bootstrap
+from Utils.pipeline import PipelinedCollector
+from Utils.checkpoint import AsyncCheckpointer, load_checkpoint
+from Utils.train_agent_sandbox import get_batched_actions
 import time
 from importlib import reload
 reload(ActorCritic)
-import copy
+import os
 
 MAX_PIXEL = 116
 show = False
@@ -23,12 +31,11 @@ def show_game_state(observation):
 def get_color_dict(seed=100):
     import string
     alphabet = string.ascii_lowercase
-    np.random.seed(seed)
-    RGB_list = np.random.rand(len(alphabet),3)
+    # local random state, so that the global one is not reseeded
+    RGB_list = np.random.RandomState(seed).rand(len(alphabet),3)
     color_dict = {}
     for l, c in zip(alphabet,RGB_list):
         color_dict[l] = c
-    np.random.seed(None)
     
     # add colors for 'agent' and  'gem'
     color_dict['agent'] = np.array([1.,0.,0.])
@@ -36,129 +43,404 @@ def get_color_dict(seed=100):
     
     return color_dict
 
-def get_state(observation, state_dictionaries):
-    
-    color_dict, object_dict, symbol_dict = state_dictionaries 
-    b = observation.board
-    l = observation.layers  
-    color_board = np.zeros(b.shape+(3,)).astype(float)
-    object_board = np.zeros(b.shape+(1,)).astype(int)
-
-    for symbol in l.keys():
-
-        # If alphabetic character
-        if symbol.isalpha():
-            # Paint the color board cells occupied accordingly
-            color_board[l[symbol]] = color_dict[symbol.lower()]
+def get_state_dictionaries():
+    # Define dictionaries to represent state from observation
+    color_dict = get_color_dict()
+    object_dict = {'ground':0, 'wall':1, 'agent':2, 'gem':3, 'key':4, 'box':5}
+    symbol_dict = {' ':'ground', '#':'wall', '.':'agent', '*':'gem'} # keys and boxes can have any possible letter
+    return [color_dict, object_dict, symbol_dict]
 
-            # Upper = box, lower = key
-            if symbol.isupper():
-                object_board[l[symbol]] = object_dict['box']
-            else:
-                object_board[l[symbol]] = object_dict['key']
+def get_lookup_tables(state_dictionaries):
+    """
+    Builds the tables mapping each ASCII character of the board to its object id and RGB color.
+    
+    Returns
+    -------
+    object_lut: array of uint8, shape (256,)
+    color_lut: array of float32, shape (256, 3)
+    """
+    import string
+    color_dict, object_dict, symbol_dict = state_dictionaries
+    object_lut = np.zeros(256, dtype=np.uint8)
+    color_lut = np.zeros((256, 3), dtype=np.float32)
+    
+    # Upper = box, lower = key
+    for l in string.ascii_lowercase:
+        object_lut[ord(l)] = object_dict['key']
+        object_lut[ord(l.upper())] = object_dict['box']
+        color_lut[ord(l)] = color_dict[l]
+        color_lut[ord(l.upper())] = color_dict[l]
+        
+    # Color assigned is [0,0,0] for ground and walls since it's not really a property of those objects
+    # Only agent and gem have colors mainly for plotting reasons
+    for symbol, object_name in symbol_dict.items():
+        object_lut[ord(symbol)] = object_dict[object_name]
+        if object_name in ['agent', 'gem']:
+            color_lut[ord(symbol)] = color_dict[object_name]
+            
+    return object_lut, color_lut
 
-        else:
-            object_name = symbol_dict[symbol]
-
-            # Color assigned is [0,0,0] since it's not really a property of those objects
-            # Only agent and gem have colors mainly for plotting reasons
-            if object_name == 'agent':
-                color_board[l[symbol]] = color_dict['agent']
-            elif object_name == 'gem':
-                color_board[l[symbol]] = color_dict['gem']
-            else:
-                pass
+# Built once per process
+OBJECT_LUT, COLOR_LUT = get_lookup_tables(get_state_dictionaries())
 
-            object_board[l[symbol]] = object_dict[object_name]
+def get_state(observation, state_dictionaries=None, out=None):
+    """
+    Encodes the board of a BoxWorld observation with a single lookup per table.
+    
+    Parameters
+    ----------
+    observation: pycolab Observation
+        Only observation.board (array of ASCII codes, shape (H, W)) is used
+    state_dictionaries: list (optional)
+        [color_dict, object_dict, symbol_dict]; if None the tables built at import are used
+    out: tuple of arrays (optional)
+        Preallocated (object_board, color_board) buffers of shapes (H, W, 1) and (H, W, 3)
+        
+    Returns
+    -------
+    object_board: array of uint8, shape (H, W, 1)
+    color_board: array of float32, shape (H, W, 3)
+    """
+    if state_dictionaries is None:
+        object_lut, color_lut = OBJECT_LUT, COLOR_LUT
+    else:
+        object_lut, color_lut = get_lookup_tables(state_dictionaries)
+        
+    b = observation.board
+    if out is None:
+        object_board = np.empty(b.shape+(1,), dtype=np.uint8)
+        color_board = np.empty(b.shape+(3,), dtype=np.float32)
+    else:
+        object_board, color_board = out
+    # ASCII codes are always in [0,255], so clipping never happens and avoids buffering
+    np.take(object_lut, b, axis=0, out=object_board[...,0], mode='clip')
+    np.take(color_lut, b, axis=0, out=color_board, mode='clip')
             
     return (object_board, color_board)
-        
 
-def play_episode(agent, game, max_steps):
+def get_network_state(state):
+    """
+    Input of the BoxWorld networks (in_channels=3) from a state of get_state: the color board
+    with the channels first.
     
-    # Define dictionaries to represent state from observation
-    color_dict = get_color_dict()
-    object_dict = {'ground':0, 'wall':1, 'agent':2, 'gem':3, 'key':4, 'box':5}
-    symbol_dict = {' ':'ground', '#':'wall', '.':'agent', '*':'gem'} # keys and boxes can have any possible letter
-    state_dictionaries = [color_dict, object_dict, symbol_dict]
+    Parameters
+    ----------
+    state: tuple (object_board, color_board)
+        As returned by get_state (or boxworld_env.get_state for a batch of boards)
+        
+    Returns
+    -------
+    array of float32, shape (..., 3, H, W)
+    """
+    return np.ascontiguousarray(np.moveaxis(state[1], -1, -3))
+        
+
+def get_time_limit(game_params):
+    """
+    Maximum number of steps of the BoxWorld games made with game_params (120 is the default
+    of box_world.make_game).
+    """
+    return game_params.get('max_num_steps', boxworld_env.MAX_NUM_STEPS)
+
+def play_episode(agent, game, max_steps, buffer=None, grad_free=False):
+    """
+    Plays an episode storing the trajectory in buffer (a buffers.TrajectoryBuffer), that is
+    allocated for max_steps steps if not provided. max_steps is the time limit of the game
+    (see get_time_limit): episodes truncated by it are bootstrapped (see buffers.get_bootstrap).
+    If grad_free is True, the agent acts with agent.act and only the actions are recorded
+    (log_probs and distributions are returned as None).
+    """
+    if buffer is None:
+        buffer = TrajectoryBuffer(max_steps, agent.device)
     
     # Start the episode
     observation, _, _ = game.its_showtime()
-    state = get_state(observation, state_dictionaries)
-    
-    rewards = []
-    log_probs = []
-    distributions = []
-    states = [state]
-    not_done = []
-    bootstrap = []
+    state = get_network_state(get_state(observation))
+    buffer.reset(state)
 
     steps = 0
     while True:
      
-        action, log_prob, distrib = agent.get_action(state, return_log = True)
+        if grad_free:
+            action, log_prob, distrib = agent.act(state), None, None
+        else:
+            action, log_prob, distrib = agent.get_action(state, return_log = True)
         new_obs, reward, not_terminal = game.play(action)
         not_terminal = bool(not_terminal)
 
         if show:
             show_game_state(new_obs)
-        new_state = get_state(new_obs, state_dictionaries)
+        new_state = get_network_state(get_state(new_obs))
         
-        rewards.append(reward)
-        log_probs.append(log_prob)
-        distributions.append(distrib)
-        states.append(new_state)
-        not_done.append(not_terminal)
-        
-        # Still unclear how to retrieve max steps from the game itself
-        if not_terminal is False and steps == max_steps:
-            bootstrap.append(True)
-        else:
-            bootstrap.append(False) 
+        steps += 1
+        truncated = (not_terminal is False and steps == max_steps)
+        bootstrap = get_bootstrap(truncated, boxworld_env.is_terminated(reward))
+        buffer.add(action, reward, new_state, not not_terminal, bootstrap, log_prob, distrib)
         
         if not_terminal is False:
-            #print("steps: ", steps)
-            #print("Bootstrap needed: ", bootstrap[-1])
+            #print("Bootstrap needed: ", bootstrap)
             break
             
         state = new_state
+
+    return buffer.get()
+
+def play_episode_online(agent, game, max_steps, update_every, buffer=None, grad_free=False):
+    """
+    Plays an episode updating the agent every update_every steps (and at the end of the episode)
+    on the last window of transitions. At the edge of a window the episode is not done, so
+    update_TD bootstraps the n-step targets from the critic target. Only the current window is 
+    stored, so memory and update granularity don't depend on the length of the episode.
+    max_steps is the time limit of the game, as in play_episode.
+    
+    Returns
+    -------
+    total_reward: float
+    episode_len: int
+    losses: list of (critic_loss, actor_loss, entropy), one per window
+    """
+    if buffer is None:
+        buffer = TrajectoryBuffer(update_every, agent.device)
+    
+    observation, _, _ = game.its_showtime()
+    state = get_network_state(get_state(observation))
+    buffer.reset(state)
+    total_reward = 0
+    losses = []
+
+    steps = 0
+    while True:
+     
+        if grad_free:
+            action, log_prob, distrib = agent.act(state), None, None
+        else:
+            action, log_prob, distrib = agent.get_action(state, return_log = True)
+        new_obs, reward, not_terminal = game.play(action)
+        not_terminal = bool(not_terminal)
+
+        if show:
+            show_game_state(new_obs)
+        new_state = get_network_state(get_state(new_obs))
+        
         steps += 1
+        truncated = (not_terminal is False and steps == max_steps)
+        bootstrap = get_bootstrap(truncated, boxworld_env.is_terminated(reward))
+        buffer.add(action, reward, new_state, not not_terminal, bootstrap, log_prob, distrib)
+        total_reward += reward
+        
+        if not_terminal is False or buffer.t == update_every:
+            if grad_free:
+                losses.append(agent.update(*buffer.get(), actions=buffer.get_actions()))
+            else:
+                losses.append(agent.update(*buffer.get()))
+            if not_terminal is False:
+                break
+            # next window starts from the last state of this one
+            buffer.reset(new_state)
+            
+        state = new_state
+
+    return total_reward, steps, losses
+
+def play_episodes(agent, env):
+    """
+    Plays in lockstep one episode in each of the n_envs levels of env (a boxworld_env.BoxWorldVecEnv),
+    using a single batched forward of the actor per time-step for all the episodes that are still 
+    running. States are encoded once per step for the whole batch, without building pycolab-like
+    observations.
+    
+    Returns
+    -------
+    trajectories: list of n_envs tuples (rewards, actions, states, done, bootstrap)
+        With states arrays of shape (episode_len+1, 3, H, W) (see get_network_state).
+        The agent recomputes log-probabilities and distributions when updated with 
+        agent.update(rewards, None, None, states, done, bootstrap, actions=actions)
+    """
+    state = get_network_state(env.reset())
+    n_envs = env.n_envs
+    states = [state]
+    actions = []
+    rewards = []
+    done = []
+    bootstrap = []
+    
+    ep_len = np.zeros(n_envs, dtype=int)
+    active = np.ones(n_envs, dtype=bool)
+    while active.any():
+        action = np.zeros(n_envs, dtype=int)
+        action[active] = get_batched_actions(agent, state[active])
+        new_state, reward, terminal, truncated, info = env.step(action)
+        new_state = get_network_state(new_state)
+        
+        # finished levels have been replaced by the env: store their last state instead
+        states_t = new_state.copy()
+        if terminal.any():
+            idx = np.nonzero(terminal)[0]
+            states_t[idx] = get_network_state(info['final_state'])
+        states.append(states_t)
+        actions.append(action)
+        rewards.append(reward)
+        done.append(terminal)
+        bootstrap.append(get_bootstrap(truncated, boxworld_env.is_terminated(reward)))
+        
+        ep_len[active] += 1
+        active &= ~terminal
+        state = new_state
         
+    states = np.array(states)
+    actions = np.array(actions)
     rewards = np.array(rewards)
-    done = ~np.array(not_done)
+    done = np.array(done)
     bootstrap = np.array(bootstrap)
+    
+    trajectories = []
+    for i in range(n_envs):
+        T = ep_len[i]
+        trajectories.append((rewards[:T,i], actions[:T,i], states[:T+1,i], done[:T,i], 
+                             bootstrap[:T,i]))
+    return trajectories
 
-    return rewards, log_probs, distributions, states, done, bootstrap
+VEC_ENV_PARAMS = ['grid_size', 'solution_length', 'num_forward', 'num_backward', 'branch_length']
 
-def train_boxworld(agent, game_params, n_episodes = 1000, max_steps=120, return_agent=False):
+def train_boxworld(agent, game_params, n_episodes = 1000, max_steps=120, return_agent=False, level_bank=None,
+                   grad_free=False, pipelined=False, max_policy_lag=1, update_every=None, checkpoint_dir=None, 
+                   checkpoint_every=100, resume=False, n_envs=1, return_losses=False):
+    """
+    If level_bank (a boxworld_env.LevelBank) is provided, levels are sampled from it instead 
+    of being generated with game_params at every episode.
+    If grad_free is True, the agent acts without autograd and recomputes the log-probabilities
+    of the whole episode at update time.
+    If pipelined is True, episodes are collected (gradient-free) in a background thread while 
+    the agent is updated on the previous ones, with at most max_policy_lag updates between the 
+    policy that plays an episode and the one that learns from it.
+    If update_every is not None, the agent is updated every update_every steps while playing
+    (see play_episode_online) and the playing time in time_profile includes the updates. Not 
+    supported with pipelined.
+    If n_envs > 1, episodes are collected n_envs at a time with play_episodes on a 
+    boxworld_env.BoxWorldVecEnv (levels generated by boxworld_env, or sampled from level_bank) 
+    and then used one by one to update the agent, that acts gradient-free. Not supported 
+    together with pipelined or update_every.
+    If checkpoint_dir is not None, a checkpoint (agent, optimizers, RNG states and metrics) is 
+    written there every checkpoint_every episodes by a background thread. If resume is True 
+    and a checkpoint exists, training continues from it up to n_episodes.
+    Episodes are bootstrapped when truncated by the time limit of the games (max_num_steps
+    in game_params, default 120), max_steps is not used and kept for compatibility.
+    The critic and actor losses and the entropies of every episode (averaged over the windows
+    if update_every is not None) are recorded in the checkpoints and, if return_losses is True,
+    returned in a losses dict after the other results.
+    """
+    if n_envs > 1 and (pipelined or update_every is not None):
+        raise ValueError("n_envs > 1 is not supported together with pipelined or update_every")
+    if pipelined and update_every is not None:
+        raise ValueError("update_every is not supported with pipelined")
     performance = []
     time_profile = []
+    critic_losses = [] 
+    actor_losses = []
+    entropies = []
+    time_limit = get_time_limit(game_params)
+    
+    start_episode = 0
+    checkpointer = None
+    if checkpoint_dir is not None:
+        if resume and os.path.exists(os.path.join(checkpoint_dir, 'last.pt')):
+            checkpoint = load_checkpoint(checkpoint_dir, agent)
+            start_episode = checkpoint['episode']
+            metrics = checkpoint['metrics']
+            performance, time_profile = metrics['performance'], metrics['time_profile']
+            critic_losses, actor_losses, entropies = metrics['critic_losses'], metrics['actor_losses'], metrics['entropies']
+            print("Resuming from episode %d"%start_episode)
+        checkpointer = AsyncCheckpointer(checkpoint_dir, checkpoint_every)
+    online = update_every is not None
+    # episodes can't be longer than the time limit of the games
+    buffer = TrajectoryBuffer(update_every if online else time_limit, agent.device)
+    
+    def make_game():
+        if level_bank is not None:
+            return level_bank.make_game(time_limit)
+        else:
+            return bw.make_game(**game_params)
+    
+    if pipelined:
+        def play_fn(acting_agent, buffer):
+            play_episode(acting_agent, make_game(), time_limit, buffer, grad_free=True)
+        collector = PipelinedCollector(agent, play_fn, time_limit, max_policy_lag)
+        
+    if n_envs > 1:
+        seed = np.random.randint(2**31)
+        if level_bank is not None:
+            vec_env = level_bank.make_env(n_envs, time_limit, seed)
+        else:
+            vec_params = {k:v for k,v in game_params.items() if k in VEC_ENV_PARAMS}
+            vec_env = boxworld_env.BoxWorldVecEnv(n_envs, max_num_steps=time_limit, seed=seed, **vec_params)
+        trajectories = []
     
-    for e in range(n_episodes):
+    for e in range(start_episode, n_episodes):
         
         #print("Playing episode %d... "%(e+1))
         t0 = time.time()
-        game = bw.make_game(**game_params)
-        rewards, log_probs, distributions, states, done, bootstrap = play_episode(agent, game, max_steps)
+        if n_envs > 1:
+            if len(trajectories) == 0:
+                trajectories = play_episodes(agent, vec_env)
+            rewards, actions, states, done, bootstrap = trajectories.pop(0)
+            log_probs, distributions = None, None
+        elif pipelined:
+            buffer, lag = collector.get()
+            rewards, log_probs, distributions, states, done, bootstrap = buffer.get()
+        elif online:
+            total_reward, _, window_losses = play_episode_online(agent, make_game(), time_limit, update_every, buffer, grad_free)
+        else:
+            rewards, log_probs, distributions, states, done, bootstrap = play_episode(agent, make_game(), time_limit, 
+                                                                                      buffer, grad_free)
         t1 = time.time()
         #print("Time playing the episode: %.2f s"%(t1-t0))
-        performance.append(np.sum(rewards))
+        performance.append(total_reward if online else np.sum(rewards))
         if (e+1)%100 == 0:
             print("Episode %d - reward: %.2f"%(e+1, np.mean(performance[-100:])))
         #print("Episode %d - reward: %.0f"%(e+1, performance[-1]))
 
-        agent.update(rewards, log_probs, distributions, states, done, bootstrap)
+        if online:
+            critic_loss, actor_loss, entropy = np.mean(window_losses, axis=0)
+        elif pipelined:
+            critic_loss, actor_loss, entropy = collector.update(buffer)
+        elif n_envs > 1:
+            critic_loss, actor_loss, entropy = agent.update(rewards, log_probs, distributions, states, done, bootstrap, 
+                                                            actions=actions)
+        elif grad_free:
+            critic_loss, actor_loss, entropy = agent.update(rewards, log_probs, distributions, states, done, bootstrap, 
+                                                            actions=buffer.get_actions())
+        else:
+            critic_loss, actor_loss, entropy = agent.update(rewards, log_probs, distributions, states, done, bootstrap)
+        critic_losses.append(critic_loss)
+        actor_losses.append(actor_loss)
+        entropies.append(entropy)
         t2 = time.time()
         #print("Time updating the agent: %.2f s"%(t2-t1))
             
         time_profile.append([t1-t0, t2-t1])
         
+        if checkpointer is not None:
+            metrics = dict(performance=performance, time_profile=time_profile, critic_losses=critic_losses, 
+                           actor_losses=actor_losses, entropies=entropies)
+            checkpointer.maybe_save(e+1, agent, metrics=metrics, force=(e+1) == n_episodes)
+        
+    if checkpointer is not None:
+        checkpointer.close()
+    if pipelined:
+        collector.close()
+        print("Learner waited %.2f s - collector waited %.2f s"%(collector.learner_wait, collector.collector_wait))
     performance = np.array(performance)
     time_profile = np.array(time_profile)
     L = n_episodes // 6 # consider last sixth of episodes to compute agent's asymptotic performance
+    losses = dict(critic_losses=critic_losses, actor_losses=actor_losses, entropies=entropies)
+    if pipelined:
+        losses.update(learner_wait=collector.learner_wait, collector_wait=collector.collector_wait)
     
     if return_agent:
-        return performance, performance[-L:].mean(), performance[-L:].std(), agent, time_profile
+        results = (performance, performance[-L:].mean(), performance[-L:].std(), agent, time_profile)
     else:
-        return performance, performance[-L:].mean(), performance[-L:].std()
+        results = (performance, performance[-L:].mean(), performance[-L:].std())
+    if return_losses:
+        results += (losses,)
+    return results
 
@@ -1,64 +1,206 @@
 import numpy as np
 import torch
+from torch.distributions import Categorical
 from RelationalModule import ActorCritic
 from Utils import test_env
+from Utils.test_env import random_start
+from Utils.torch_env import TorchSandboxVecEnv
+from Utils.buffers import TrajectoryBuffer, get_bootstrap
+from Utils.pipeline import PipelinedCollector
+from Utils.checkpoint import AsyncCheckpointer, load_checkpoint
 import time
+import os
 
 debug = False
 
-def play_episode(agent, env, max_steps):
-
+def play_episode(agent, env, max_steps, buffer=None, grad_free=False):
+    """
+    Plays an episode storing the trajectory in buffer (a buffers.TrajectoryBuffer), that is
+    allocated for env.max_steps steps if not provided.
+    If grad_free is True, the agent acts with agent.act and only the actions are recorded
+    (log_probs and distributions are returned as None).
+    Episodes are bootstrapped when truncated by env.max_steps (see buffers.get_bootstrap), 
+    max_steps is not used and kept for compatibility.
+    """
+    if buffer is None:
+        buffer = TrajectoryBuffer(env.max_steps, agent.device)
+        
     # Start the episode
     state = env.reset()
     if debug: print("state.shape: ", state.shape)
-    rewards = []
-    log_probs = []
-    distributions = []
-    states = [state]
-    done = []
-    bootstrap = []
+    buffer.reset(state)
         
-    steps = 0
     while True:
      
-        action, log_prob, distrib = agent.get_action(state, return_log = True)
+        if grad_free:
+            action, log_prob, distrib = agent.act(state), None, None
+        else:
+            action, log_prob, distrib = agent.get_action(state, return_log = True)
         new_state, reward, terminal, info = env.step(action)
         if debug: print("state.shape: ", new_state.shape)
-        rewards.append(reward)
-        log_probs.append(log_prob)
-        distributions.append(distrib)
-        states.append(new_state)
-        done.append(terminal)
         
-        # Still unclear how to retrieve max steps from the game itself
-        if terminal is True and steps == max_steps:
-            bootstrap.append(True)
-        else:
-            bootstrap.append(False) 
+        bootstrap = get_bootstrap(info.get('TimeLimit.truncated', False), reward == 1)
+        buffer.add(action, reward, new_state, terminal, bootstrap, log_prob, distrib)
         
         if terminal is True:
-            #print("steps: ", steps)
-            #print("Bootstrap needed: ", bootstrap[-1])
+            #print("Bootstrap needed: ", bootstrap)
             break
             
         state = new_state
+
+    return buffer.get()
+
+def play_episode_online(agent, env, max_steps, update_every, buffer=None, grad_free=False):
+    """
+    Plays an episode updating the agent every update_every steps (and at the end of the episode)
+    on the last window of transitions. At the edge of a window the episode is not done, so
+    update_TD bootstraps the n-step targets from the critic target. Only the current window is 
+    stored, so memory and update granularity don't depend on the length of the episode.
+    As in play_episode, max_steps is not used.
+    
+    Returns
+    -------
+    total_reward: float
+    episode_len: int
+    losses: list of (critic_loss, actor_loss, entropy), one per window
+    """
+    if buffer is None:
+        buffer = TrajectoryBuffer(update_every, agent.device)
+        
+    state = env.reset()
+    buffer.reset(state)
+    total_reward = 0
+    losses = []
+    
+    steps = 0
+    while True:
+        
+        if grad_free:
+            action, log_prob, distrib = agent.act(state), None, None
+        else:
+            action, log_prob, distrib = agent.get_action(state, return_log = True)
+        new_state, reward, terminal, info = env.step(action)
+        
+        bootstrap = get_bootstrap(info.get('TimeLimit.truncated', False), reward == 1)
+        buffer.add(action, reward, new_state, terminal, bootstrap, log_prob, distrib)
+        total_reward += reward
         steps += 1
         
+        if terminal is True or buffer.t == update_every:
+            if grad_free:
+                losses.append(agent.update(*buffer.get(), actions=buffer.get_actions()))
+            else:
+                losses.append(agent.update(*buffer.get()))
+            if terminal is True:
+                break
+            # next window starts from the last state of this one
+            buffer.reset(new_state)
+            
+        state = new_state
+        
+    return total_reward, steps, losses
+
+def get_batched_actions(agent, states):
+    """
+    Samples an action for each state of the batch with a single forward of the actor.
+    No graph is recorded: log-probabilities are recomputed by the agent at update time.
+    """
+    with torch.inference_mode():
+        log_probs = agent.forward(states)
+    return Categorical(logits=log_probs).sample().cpu().numpy()
+
+def play_episodes(agent, env):
+    """
+    Plays in lockstep one episode in each of the n_envs sub-environments of env 
+    (a test_env.SandboxVecEnv or a torch_env.TorchSandboxVecEnv), using a single batched 
+    forward of the actor per time-step for all the episodes that are still running.
+    With a TorchSandboxVecEnv the states never leave the env's device, only actions, rewards
+    and flags are moved to NumPy.
+    
+    Returns
+    -------
+    trajectories: list of n_envs tuples (rewards, actions, states, done, bootstrap)
+        With states of shape (episode_len+1, ...), tensors for a TorchSandboxVecEnv. The agent 
+        recomputes log-probabilities and distributions when updated with 
+        agent.update(rewards, None, None, states, done, bootstrap, actions=actions)
+    """
+    state = env.reset()
+    on_device = torch.is_tensor(state)
+    n_envs = env.n_envs
+    states = [state]
+    actions = []
+    rewards = []
+    done = []
+    bootstrap = []
+    
+    ep_len = np.zeros(n_envs, dtype=int)
+    active = np.ones(n_envs, dtype=bool)
+    while active.any():
+        action = np.zeros(n_envs, dtype=int)
+        if on_device:
+            action[active] = get_batched_actions(agent, state[torch.as_tensor(active, device=state.device)])
+        else:
+            action[active] = get_batched_actions(agent, state[active])
+        new_state, reward, terminal, truncated, info = env.step(action)
+        if on_device:
+            reward, terminal, truncated = [x.cpu().numpy() for x in (reward, terminal, truncated)]
+        
+        # finished envs have been reset by the env: store their last state instead
+        states_t = new_state.clone() if on_device else new_state.copy()
+        if terminal.any():
+            states_t[np.nonzero(terminal)[0]] = info['final_state']
+        states.append(states_t)
+        actions.append(action)
+        rewards.append(reward)
+        done.append(terminal)
+        bootstrap.append(get_bootstrap(truncated, reward == 1))
+        
+        ep_len[active] += 1
+        active &= ~terminal
+        state = new_state
+        
+    states = torch.stack(states) if on_device else np.array(states)
+    actions = np.array(actions)
     rewards = np.array(rewards)
-    states = np.array(states)
-    if debug: print("states.shape: ", states.shape)
     done = np.array(done)
     bootstrap = np.array(bootstrap)
+    
+    trajectories = []
+    for i in range(n_envs):
+        T = ep_len[i]
+        trajectories.append((rewards[:T,i], actions[:T,i], states[:T+1,i], done[:T,i], bootstrap[:T,i]))
+    return trajectories
 
-    return rewards, log_probs, distributions, np.array(states), done, bootstrap
-
-def random_start(X=10, Y=10):
-    s1, s2 = np.random.choice(X*Y, 2, replace=False)
-    initial = [s1//X, s1%X]
-    goal = [s2//X, s2%X]
-    return initial, goal
+VEC_ENV_PARAMS = ['x', 'y', 'initial', 'goal', 'R0', 'max_steps', 'greyscale_state', 'return_coord', 'return_ohe', 'walls']
 
-def train_sandbox(agent, game_params, n_episodes = 1000, max_steps=120, return_agent=False, random_init=True):
+def train_sandbox(agent, game_params, n_episodes = 1000, max_steps=120, return_agent=False, random_init=True, seed=None,
+                  n_envs=1, grad_free=False, pipelined=False, max_policy_lag=1, update_every=None, batch_update=False,
+                  bucket_width=None, checkpoint_dir=None, checkpoint_every=100, resume=False, torch_env=False):
+    """
+    If n_envs > 1, episodes are collected n_envs at a time with play_episodes (one batched
+    actor forward per time-step) and then used one by one to update the agent, or all together
+    with a single agent.update_batch if batch_update is True (the losses of the batch are then 
+    reported for each of its episodes), packing together episodes whose lengths differ by at most 
+    bucket_width steps. If torch_env is True, the n_envs environments are simulated by a
+    torch_env.TorchSandboxVecEnv on the agent's device instead of a test_env.SandboxVecEnv.
+    If grad_free is True, the agent acts without autograd and recomputes the log-probabilities
+    of the whole episode at update time (always the case if n_envs > 1).
+    If pipelined is True, episodes are collected (gradient-free) in a background thread while 
+    the agent is updated on the previous ones, with at most max_policy_lag updates between the 
+    policy that plays an episode and the one that learns from it. The time spent waiting by the 
+    learner and by the collector is added to losses. Not supported with n_envs > 1.
+    If update_every is not None, the agent is updated every update_every steps while playing 
+    (see play_episode_online); losses are averaged over the windows of each episode and the 
+    playing time in time_profile includes the updates. Not supported with n_envs > 1 or pipelined.
+    If checkpoint_dir is not None, a checkpoint (agent, optimizers, RNG states and metrics) is 
+    written there every checkpoint_every episodes by a background thread. If resume is True 
+    and a checkpoint exists, training continues from it up to n_episodes (exactly as the 
+    original run for the default single env, non-pipelined loop).
+    """
+    if n_envs > 1 and pipelined:
+        raise ValueError("pipelined is not supported with n_envs > 1")
+    if update_every is not None and (n_envs > 1 or pipelined):
+        raise ValueError("update_every is not supported with n_envs > 1 or pipelined")
     performance = []
     steps_to_solve = []
     time_profile = []
@@ -66,29 +208,113 @@ def train_sandbox(agent, game_params, n_episodes = 1000, max_steps=120, return_a
     actor_losses = []
     entropies = []
     
-    for e in range(n_episodes):
+    # Same env reused (and reconfigured) in all the episodes
+    env = None
+    buffer = None
+    rng = np.random.default_rng(seed)
+    
+    start_episode = 0
+    checkpointer = None
+    if checkpoint_dir is not None:
+        if resume and os.path.exists(os.path.join(checkpoint_dir, 'last.pt')):
+            checkpoint = load_checkpoint(checkpoint_dir, agent, dict(train=rng))
+            start_episode = checkpoint['episode']
+            metrics = checkpoint['metrics']
+            performance, steps_to_solve, time_profile = metrics['performance'], metrics['steps_to_solve'], metrics['time_profile']
+            critic_losses, actor_losses, entropies = metrics['critic_losses'], metrics['actor_losses'], metrics['entropies']
+            print("Resuming from episode %d"%start_episode)
+        checkpointer = AsyncCheckpointer(checkpoint_dir, checkpoint_every)
+    online = update_every is not None
+    
+    if n_envs > 1:
+        vec_params = {k:v for k,v in game_params.items() if k in VEC_ENV_PARAMS}
+        if torch_env:
+            vec_env = TorchSandboxVecEnv(n_envs, random_init=random_init, seed=int(rng.integers(2**32)), 
+                                         device=agent.device, dtype=agent.state_dtype, **vec_params)
+        else:
+            vec_env = test_env.SandboxVecEnv(n_envs, random_init=random_init, seed=rng.integers(2**32), **vec_params)
+        trajectories = []
         
+    if pipelined:
         if random_init:
+            initial, goal = random_start(game_params["x"], game_params["y"], rng, game_params.get("walls"))
+            env = test_env.Sandbox(**dict(game_params, initial=initial, goal=goal))
+        else:
+            env = test_env.Sandbox(**game_params)
+        def play_fn(acting_agent, buffer):
+            if random_init:
+                initial, goal = random_start(game_params["x"], game_params["y"], rng, game_params.get("walls"))
+                env.reconfigure(initial, goal)
+            play_episode(acting_agent, env, max_steps, buffer, grad_free=True)
+        collector = PipelinedCollector(agent, play_fn, env.max_steps, max_policy_lag)
+        policy_lags = []
+    
+    for e in range(start_episode, n_episodes):
+        
+        if pipelined:
+            t0 = time.time()
+            buffer, lag = collector.get()
+            policy_lags.append(lag)
+            rewards, log_probs, distributions, states, done, bootstrap = buffer.get()
+        
+        elif n_envs > 1:
+            t0 = time.time()
+            if len(trajectories) == 0:
+                trajectories = play_episodes(agent, vec_env)
+                if batch_update:
+                    rewards, actions, states, done, bootstrap = [list(x) for x in zip(*trajectories)]
+                    batch_losses = agent.update_batch(rewards, None, None, states, done, bootstrap, actions=actions,
+                                                      bucket_width=bucket_width)
+            rewards, actions, states, done, bootstrap = trajectories.pop(0)
+            log_probs, distributions = None, None
+        
+        elif random_init:
             # Change game params
-            initial, goal = random_start(game_params["x"], game_params["y"])
+            initial, goal = random_start(game_params["x"], game_params["y"], rng, game_params.get("walls"))
 
             # All game parameters
             game_params["initial"] = initial
             game_params["goal"] = goal
 
-        #print("Playing episode %d... "%(e+1))
-        t0 = time.time()
-        env = test_env.Sandbox(**game_params)
-        rewards, log_probs, distributions, states, done, bootstrap = play_episode(agent, env, max_steps)
+        if n_envs == 1 and not pipelined:
+            #print("Playing episode %d... "%(e+1))
+            t0 = time.time()
+            if env is None:
+                env = test_env.Sandbox(**game_params)
+                buffer = TrajectoryBuffer(update_every if online else env.max_steps, agent.device)
+            else:
+                env.reconfigure(game_params["initial"], game_params["goal"])
+            if online:
+                total_reward, ep_len, window_losses = play_episode_online(agent, env, max_steps, update_every, 
+                                                                          buffer, grad_free)
+            else:
+                rewards, log_probs, distributions, states, done, bootstrap = play_episode(agent, env, max_steps, 
+                                                                                          buffer, grad_free)
+                if grad_free:
+                    actions = buffer.get_actions()
         t1 = time.time()
         #print("Time playing the episode: %.2f s"%(t1-t0))
-        performance.append(np.sum(rewards))
-        steps_to_solve.append(len(rewards))
+        if online:
+            performance.append(total_reward)
+            steps_to_solve.append(ep_len)
+        else:
+            performance.append(np.sum(rewards))
+            steps_to_solve.append(len(rewards))
         if (e+1)%10 == 0:
             print("Episode %d - reward: %.2f - steps to solve: %.2f"%(e+1, np.mean(performance[-10:]), np.mean(steps_to_solve[-10:])))
         #print("Episode %d - reward: %.2f - steps to solve: %d"%(e+1, performance[-1], len(rewards)))
 
-        critic_loss, actor_loss, entropy = agent.update(rewards, log_probs, distributions, states, done, bootstrap)
+        if online:
+            critic_loss, actor_loss, entropy = np.mean(window_losses, axis=0)
+        elif n_envs > 1 and batch_update:
+            critic_loss, actor_loss, entropy = batch_losses
+        elif pipelined:
+            critic_loss, actor_loss, entropy = collector.update(buffer)
+        elif log_probs is None:
+            critic_loss, actor_loss, entropy = agent.update(rewards, log_probs, distributions, states, done, bootstrap,
+                                                            actions=actions)
+        else:
+            critic_loss, actor_loss, entropy = agent.update(rewards, log_probs, distributions, states, done, bootstrap)
         critic_losses.append(critic_loss)
         actor_losses.append(actor_loss)
         entropies.append(entropy)
@@ -98,11 +324,23 @@ def train_sandbox(agent, game_params, n_episodes = 1000, max_steps=120, return_a
             
         time_profile.append([t1-t0, t2-t1])
         
+        if checkpointer is not None:
+            metrics = dict(performance=performance, steps_to_solve=steps_to_solve, time_profile=time_profile,
+                           critic_losses=critic_losses, actor_losses=actor_losses, entropies=entropies)
+            checkpointer.maybe_save(e+1, agent, dict(train=rng), metrics, force=(e+1) == n_episodes)
+        
+    if checkpointer is not None:
+        checkpointer.close()
     performance = np.array(performance)
     time_profile = np.array(time_profile)
     steps_to_solve = np.array(steps_to_solve)
     L = n_episodes // 6 # consider last sixth of episodes to compute agent's asymptotic performance
     losses = dict(critic_losses=critic_losses, actor_losses=actor_losses, entropies=entropies)
+    if pipelined:
+        collector.close()
+        print("Learner waited %.2f s - collector waited %.2f s"%(collector.learner_wait, collector.collector_wait))
+        losses.update(learner_wait=collector.learner_wait, collector_wait=collector.collector_wait, 
+                      policy_lag=np.array(policy_lags))
     if return_agent:
         return performance, performance[-L:].mean(), performance[-L:].std(), agent, time_profile, losses, steps_to_solve
     else:
@@ -5,7 +5,11 @@ import numpy as np
 import sys
 sys.path.insert(0, "RelationalDeepRL/pycolab/pycolab/examples/research/box_world")
 sys.path.insert(0, "pycolab/pycolab/examples/research/box_world")
-import box_world as bw
+try:
+    import box_world as bw
+except ImportError:
+    # pycolab submodule not checked out: use the in-repo implementation of BoxWorld
+    from Utils import boxworld_env as bw
 from Utils import test_env
 import matplotlib.pyplot as plt
 import time
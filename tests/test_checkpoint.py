@@ -0,0 +1,79 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from RelationalModule.OheActorCritic import OheA2C
+from Utils import train_agent_sandbox
+from Utils.checkpoint import AsyncCheckpointer, load_checkpoint
+
+GAME_PARAMS = dict(x=5, y=5, initial=[0,0], goal=[4,4], return_ohe=True)
+
+def make_agent():
+    torch.manual_seed(0)
+    return OheA2C(4, 5, lr=1e-3, gamma=0.9, n_steps=3, tau=0.1)
+
+def train(agent, n_episodes, checkpoint_dir, resume=False):
+    return train_agent_sandbox.train_sandbox(agent, dict(GAME_PARAMS), n_episodes=n_episodes, seed=3,
+                                             checkpoint_dir=checkpoint_dir, checkpoint_every=5, resume=resume)
+
+def test_resume_continues_the_original_run(tmp_path):
+    full_agent = make_agent()
+    full = train(full_agent, 20, str(tmp_path/'full'))
+
+    train(make_agent(), 10, str(tmp_path/'part'))
+    resumed_agent = make_agent()
+    # the global RNGs are restored from the checkpoint
+    torch.manual_seed(123)
+    np.random.seed(123)
+    resumed = train(resumed_agent, 20, str(tmp_path/'part'), resume=True)
+
+    np.testing.assert_array_equal(resumed[0], full[0])
+    np.testing.assert_allclose(resumed[3]['critic_losses'], full[3]['critic_losses'])
+    for name in ['actor', 'critic', 'critic_trg']:
+        for p, p_full in zip(getattr(resumed_agent, name).parameters(), getattr(full_agent, name).parameters()):
+            assert torch.equal(p, p_full)
+
+def test_load_restores_agent_and_generators(tmp_path):
+    agent = make_agent()
+    rng = np.random.default_rng(0)
+    checkpointer = AsyncCheckpointer(str(tmp_path), every=2)
+    checkpointer.maybe_save(1, agent, dict(train=rng), metrics=dict(performance=[0.]))
+    assert not os.path.exists(checkpointer.path)
+    checkpointer.maybe_save(2, agent, dict(train=rng), metrics=dict(performance=[0., 1.]))
+    checkpointer.close()
+    expected = (torch.rand(3), rng.random(3))
+
+    other = OheA2C(4, 5, lr=1e-3, gamma=0.9, n_steps=3, tau=0.1)
+    other_rng = np.random.default_rng(1)
+    checkpoint = load_checkpoint(str(tmp_path), other, dict(train=other_rng))
+    assert checkpoint['episode'] == 2 and checkpoint['metrics']['performance'] == [0., 1.]
+    for p, p_saved in zip(other.critic.parameters(), agent.critic.parameters()):
+        assert torch.equal(p, p_saved)
+    assert torch.equal(torch.rand(3), expected[0])
+    np.testing.assert_array_equal(other_rng.random(3), expected[1])
+
+def test_write_errors_are_raised(tmp_path):
+    checkpointer = AsyncCheckpointer(str(tmp_path))
+    # a checkpoint can't replace a non-empty directory
+    os.makedirs(os.path.join(checkpointer.path, 'blocker'))
+    checkpointer.save(1, make_agent())
+    with pytest.raises(RuntimeError):
+        checkpointer.close()
+
+def test_agents_pickled_before_the_presets_load():
+    agent = OheA2C(4, 5, lr=1e-3, gamma=0.9, n_steps=3, tau=0.1, twin=True)
+    with torch.no_grad():
+        next(agent.critic_trg.parameters()).add_(1.)
+    for name in ['state_dtype', 'mask_zero_probs', 'use_target', 'update_every', 'n_updates', 'shared', 'flat', 'target']:
+        delattr(agent, name)
+    old = pickle.loads(pickle.dumps(agent))
+    assert old.state_dtype == torch.float32 and not old.mask_zero_probs and not old.shared
+    assert old.target.network is old.critic_trg
+    for p, p_trg in zip(agent.critic_trg.parameters(), old.critic_trg.parameters()):
+        assert torch.equal(p, p_trg)
+    state = np.random.rand(3, 7, 7)
+    old.get_action(state)
+    old.target.update()
@@ -0,0 +1,101 @@
+from collections import deque
+
+import numpy as np
+import pytest
+import torch
+
+from Utils import supervised
+from Utils.test_env import MOVEMENTS, get_layout, get_wall_mask, get_distance_field, get_optimal_policy, random_start, \
+                           Sandbox, SandboxVecEnv
+from Utils.torch_env import TorchSandboxVecEnv
+
+CLOSED_WALL = [(1,0), (1,1), (1,2), (1,3)]
+
+def reference_distances(x, y, goal, walls):
+    """
+    Queue-based breadth-first search on the x by y grid, without padding.
+    """
+    dist = np.full((x, y), np.inf)
+    dist[goal] = 0
+    queue = deque([goal])
+    while queue:
+        i, j = queue.popleft()
+        for di, dj in [(-1,0), (1,0), (0,-1), (0,1)]:
+            n = (i+di, j+dj)
+            if 0 <= n[0] < x and 0 <= n[1] < y and n not in walls and np.isinf(dist[n]):
+                dist[n] = dist[i, j] + 1
+                queue.append(n)
+    return dist
+
+def test_without_walls_is_manhattan_distance():
+    x, y, goal = 4, 6, (1, 4)
+    dist = get_distance_field(x, y, goal)
+    i, j = np.meshgrid(np.arange(x), np.arange(y), indexing='ij')
+    np.testing.assert_array_equal(dist[1:-1,1:-1], np.abs(i-goal[0]) + np.abs(j-goal[1]))
+    assert np.isinf(dist[0]).all() and np.isinf(dist[:,-1]).all()
+
+@pytest.mark.parametrize("walls", [CLOSED_WALL, # closed wall: the top row is unreachable
+                                   [(0,2), (1,2), (2,2), (4,2), (3,4), (3,3)],
+                                   [(2,1), (1,1), (1,1)]])
+def test_walls_match_reference_bfs(walls):
+    x, y, goal = 5, 4, (4, 0)
+    layout = get_layout(walls)
+    dist = get_distance_field(x, y, goal, layout)
+    np.testing.assert_array_equal(dist[1:-1,1:-1], reference_distances(x, y, goal, set(layout)))
+    assert np.isinf(dist[get_wall_mask(x, y, layout)]).all()
+    assert get_distance_field(x, y, goal, layout) is dist
+    assert not dist.flags.writeable
+
+def test_goal_on_a_wall():
+    with pytest.raises(AssertionError):
+        get_distance_field(3, 3, (1, 1), ((1, 1),))
+
+def test_optimal_policy_reduces_the_distance():
+    x, y, goal = 5, 5, (0, 4)
+    layout = get_layout([(0,3), (1,3), (2,3), (3,1)])
+    dist = get_distance_field(x, y, goal, layout)[1:-1,1:-1]
+    probs = get_optimal_policy(x, y, goal, layout)
+    np.testing.assert_allclose(probs.sum(axis=-1)[np.isfinite(dist) & (dist > 0)], 1.)
+    for i, j, a in zip(*np.nonzero(probs)):
+        assert dist[i+MOVEMENTS[a][0], j+MOVEMENTS[a][1]] == dist[i, j] - 1
+
+def test_random_start_avoids_walls(rng):
+    x, y = 3, 7
+    walls = [(0,0), (1,5), (2,6)]
+    for _ in range(200):
+        initial, goal = random_start(x, y, rng, walls)
+        assert initial != goal
+        for cell in [initial, goal]:
+            assert 0 <= cell[0] < x and 0 <= cell[1] < y
+            assert tuple(cell) not in walls
+
+def assert_reachable(x, y, initial, goal, walls):
+    for i, g in zip(np.asarray(initial).reshape(-1, 2), np.asarray(goal).reshape(-1, 2)):
+        assert (i != g).any()
+        assert np.isfinite(get_distance_field(x, y, tuple(int(c) for c in g), get_layout(walls))[i[0]+1, i[1]+1])
+
+def test_start_is_reachable_across_a_closed_wall(rng):
+    x, y = 4, 4
+    starts = [random_start(x, y, rng, CLOSED_WALL) for _ in range(100)]
+    assert_reachable(x, y, [s[0] for s in starts], [s[1] for s in starts], CLOSED_WALL)
+    # both sides of the wall are sampled
+    assert {s[0][0] == 0 for s in starts} == {True, False}
+
+    env = SandboxVecEnv(100, x, y, seed=0, walls=CLOSED_WALL)
+    env.reset()
+    assert_reachable(x, y, env.initial, env.goal, CLOSED_WALL)
+    torch_env = TorchSandboxVecEnv(100, x, y, seed=0, walls=CLOSED_WALL)
+    torch_env.reset()
+    assert_reachable(x, y, torch_env.initial.numpy(), torch_env.goal.numpy(), CLOSED_WALL)
+
+    sandbox = Sandbox(x, y, [2,0], [3,3], seed=0, walls=CLOSED_WALL)
+    initials = set()
+    for _ in range(100):
+        sandbox.reset(random_init=True)
+        assert_reachable(x, y, sandbox.initial, sandbox.goal, CLOSED_WALL)
+        initials.add(tuple(sandbox.initial))
+    # the last row and column can be sampled too
+    assert (3,0) in initials and (2,3) in initials
+
+    states, actions = supervised.create_action_state_set(dict(x=x, y=y, walls=CLOSED_WALL), size=50, seed=0)
+    assert len(states) == len(actions) == 50
@@ -0,0 +1,67 @@
+import copy
+
+import pytest
+import torch
+
+from RelationalModule.flat import FlatParameters, flatten, is_flat, copy_network, copy_parameters, snapshot
+
+def test_parameters_are_views_of_the_buffers(small_net):
+    params = {k:p.detach().clone() for k, p in small_net.named_parameters()}
+    flat = flatten(small_net)
+    assert is_flat(small_net)
+    assert flat.data.numel() == sum(p.numel() for p in params.values())
+    for k, p in small_net.named_parameters():
+        assert torch.equal(p, params[k])
+        assert p.untyped_storage().data_ptr() == flat.data.untyped_storage().data_ptr()
+        assert p.grad.untyped_storage().data_ptr() == flat.grad.untyped_storage().data_ptr()
+    flat.data.zero_()
+    assert all((p == 0).all() for p in small_net.parameters())
+
+def test_groups_are_contiguous(small_net):
+    names = [k for k, _ in small_net.named_parameters()]
+    groups = [names[2:], names[:2]]
+    flat = FlatParameters(small_net, groups)
+    assert [p.numel() for p in flat.params] == [sum(dict(small_net.named_parameters())[k].numel() for k in g)
+                                                for g in groups]
+    assert flat.params[0].data_ptr() == flat.data.data_ptr()
+    with pytest.raises(AssertionError):
+        FlatParameters(small_net, [names[1:]])
+
+def test_optimizer_step_matches_unflattened(small_net):
+    reference = copy.deepcopy(small_net)
+    names = [k for k, _ in small_net.named_parameters()]
+    flat = flatten(small_net, [names[:4], names[4:]])
+    optim = torch.optim.Adam([{'params':flat.params[0]}, {'params':flat.params[1], 'lr':1e-2}], lr=1e-3)
+    ref_params = dict(reference.named_parameters())
+    ref_optim = torch.optim.Adam([{'params':[ref_params[k] for k in names[:4]]},
+                                  {'params':[ref_params[k] for k in names[4:]], 'lr':1e-2}], lr=1e-3)
+    x = torch.randn(16, 4)
+    for _ in range(3):
+        for net, opt in [(small_net, optim), (reference, ref_optim)]:
+            opt.zero_grad(set_to_none=not is_flat(net))
+            net(x).pow(2).sum().backward()
+            opt.step()
+    for (k, p), p_ref in zip(small_net.named_parameters(), reference.parameters()):
+        torch.testing.assert_close(p, p_ref)
+        # in place zeroing keeps the gradients as views of the flat buffer
+        assert p.grad.untyped_storage().data_ptr() == flat.grad.untyped_storage().data_ptr()
+
+def test_copies_and_snapshots(small_net):
+    small_net(torch.randn(8, 4)) # updates the BatchNorm buffers
+    flatten(small_net)
+    target = copy_network(small_net)
+    assert is_flat(target) and target.flat.grad is None
+    assert target.flat.data.data_ptr() != small_net.flat.data.data_ptr()
+
+    with torch.no_grad():
+        small_net.flat.data.add_(1.)
+    small_net(torch.randn(8, 4))
+    copy_parameters(target, small_net)
+    for (k, v), v_target in zip(small_net.state_dict().items(), target.state_dict().values()):
+        assert torch.equal(v, v_target), k
+
+    state = snapshot(small_net)
+    assert state.keys() == small_net.state_dict().keys()
+    with torch.no_grad():
+        small_net.flat.data.zero_()
+    assert all(torch.equal(state[k], target.state_dict()[k]) for k in state)
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import torch
+
+from RelationalModule.packing import PackedTrajectories, compute_n_step_rewards
+
+def reference_n_step_targets(rewards, done, bootstrap, gamma, n_steps):
+    """
+    Per-episode loop over the transitions: (at most) n-step reward, distance of the target
+    state and done flag of every transition, in the order of the steps.
+    """
+    G, dist, dones = [], [], []
+    for r, d, b in zip(rewards, done, bootstrap):
+        d = d & ~b
+        T = len(r)
+        for t in range(T):
+            n = min(n_steps, T-t)
+            G.append(sum(gamma**k*r[t+k] for k in range(n)))
+            dist.append(n)
+            dones.append(d[-1] if t + n_steps >= T else d[t])
+    return np.array(G), np.array(dist), np.array(dones)
+
+def make_episodes(rng, lengths):
+    rewards = [rng.normal(size=T) for T in lengths]
+    states = [rng.normal(size=(T+1, 3)).astype(np.float32) for T in lengths]
+    done = [np.arange(T) == T-1 for T in lengths]
+    # some episodes are truncated by the time limit and bootstrapped
+    bootstrap = [(np.arange(T) == T-1) & (rng.random() < 0.5) for T in lengths]
+    return rewards, states, done, bootstrap
+
+@pytest.mark.parametrize("n_steps", [1, 3, 20])
+@pytest.mark.parametrize("bucket_width", [None, 1, 4])
+def test_n_step_targets_match_reference(rng, n_steps, bucket_width):
+    gamma = 0.9
+    lengths = [1, 2, 5, 7, 12, 3, 5]
+    rewards, states, done, bootstrap = make_episodes(rng, lengths)
+    packed = PackedTrajectories(rewards, states, done, bootstrap, bucket_width=bucket_width)
+    n_step_rewards, Gamma_V, dones = packed.n_step_targets(gamma, n_steps)
+
+    G, dist, ref_dones = reference_n_step_targets(rewards, done, bootstrap, gamma, n_steps)
+    idx = packed.step_idx
+    assert sorted(idx) == list(range(sum(lengths)))
+    np.testing.assert_allclose(n_step_rewards, G[idx])
+    np.testing.assert_allclose(Gamma_V, gamma**dist[idx])
+    np.testing.assert_array_equal(dones, ref_dones[idx])
+
+    # old and new states are the ones of the same episode, dist steps apart
+    episode = np.repeat(np.arange(len(lengths)), lengths)[idx]
+    t = idx - packed.step_offsets[episode]
+    np.testing.assert_array_equal(packed.old_idx, packed.state_offsets[episode] + t)
+    np.testing.assert_array_equal(packed.new_idx - packed.old_idx, dist[idx])
+    all_states = torch.as_tensor(np.concatenate(states))
+    assert torch.equal(packed.states, all_states)
+
+def test_gather_steps_follows_transitions(rng):
+    lengths = [4, 1, 6]
+    rewards, states, done, bootstrap = make_episodes(rng, lengths)
+    packed = PackedTrajectories(rewards, states, done, bootstrap, bucket_width=2)
+    packed.n_step_targets(0.99, 2)
+    np.testing.assert_array_equal(packed.gather_steps(rewards), np.concatenate(rewards)[packed.step_idx])
+    log_probs = [list(torch.as_tensor(r)) for r in rewards]
+    assert torch.equal(packed.gather_steps(log_probs), torch.as_tensor(np.concatenate(rewards)[packed.step_idx]))
+
+def test_n_step_rewards_truncated_at_episode_end():
+    rewards = np.array([[1., 2., 3., 0.]])
+    G = compute_n_step_rewards(rewards, 0.5, 2)
+    np.testing.assert_allclose(G, [[1+0.5*2, 2+0.5*3, 3., 0.]])
@@ -0,0 +1,51 @@
+import copy
+
+import pytest
+import torch
+
+from RelationalModule.flat import flatten
+from RelationalModule.targets import TargetNetwork
+
+def perturb(net):
+    with torch.no_grad():
+        for p in net.parameters():
+            p.add_(torch.randn_like(p))
+
+def target_of(online, **kwargs):
+    return TargetNetwork(online, lambda: copy.deepcopy(online), **kwargs)
+
+def assert_params_equal(net1, net2):
+    for p1, p2 in zip(net1.parameters(), net2.parameters()):
+        torch.testing.assert_close(p1, p2)
+
+@pytest.mark.parametrize("flat", [False, True])
+def test_soft_update_is_polyak_average(small_net, flat):
+    if flat:
+        flatten(small_net)
+    target = target_of(small_net, mode='soft', tau=0.25)
+    assert target.network is not small_net
+    old = [p.detach().clone() for p in target.network.parameters()]
+    perturb(small_net)
+    target.update()
+    for p_trg, p_old, p in zip(target.network.parameters(), old, small_net.parameters()):
+        torch.testing.assert_close(p_trg, 0.75*p_old + 0.25*p)
+
+def test_hard_update_copies_every_period(small_net):
+    target = target_of(small_net, mode='hard', period=3)
+    initial = copy.deepcopy(target.network)
+    for step in range(1, 3):
+        perturb(small_net)
+        target.update(step)
+        assert_params_equal(target.network, initial)
+    target.update(3)
+    assert_params_equal(target.network, small_net)
+
+def test_soft_target_with_tau_one_is_shared(small_net):
+    target = target_of(small_net, mode='soft', tau=1.)
+    assert target.shared and target.network is small_net
+    target.update()
+    assert target_of(small_net, mode='shared').network is small_net
+
+def test_invalid_mode(small_net):
+    with pytest.raises(AssertionError):
+        target_of(small_net, mode='delayed')
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from RelationalModule.ActorCritic import BoxWorldA2C
+from Utils import boxworld_env, train_agent
+
+GAME_PARAMS = dict(grid_size=5, solution_length=[1], num_forward=[0], num_backward=[0], branch_length=1,
+                   max_num_steps=10)
+
+def make_agent(twin=True):
+    return BoxWorldA2C(4, lr=1e-3, gamma=0.9, twin=twin, tau=0.5, n_steps=3, n_kernels=8, n_features=16,
+                       n_heads=2, n_attn_modules=1, feature_n_residuals=1)
+
+def test_network_state_is_channels_first():
+    env = boxworld_env.BoxWorldVecEnv(3, seed=0, **{k:GAME_PARAMS[k] for k in train_agent.VEC_ENV_PARAMS})
+    object_board, color_board = env.reset()
+    state = train_agent.get_network_state((object_board, color_board))
+    assert state.shape == (3, 3) + color_board.shape[1:3] and state.flags.c_contiguous
+    np.testing.assert_array_equal(state[1].transpose(1, 2, 0), color_board[1])
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(grad_free=True), dict(n_envs=4), dict(update_every=4)])
+def test_train_boxworld_runs(kwargs):
+    n_episodes = 6
+    score, mean, std, losses = train_agent.train_boxworld(make_agent(), dict(GAME_PARAMS), n_episodes=n_episodes,
+                                                          return_losses=True, **kwargs)
+    assert score.shape == (n_episodes,)
+    assert all(len(v) == n_episodes for v in losses.values())
+    assert np.isfinite(losses['critic_losses']).all()
@@ -0,0 +1,47 @@
+import copy
+
+import pytest
+import torch
+
+from RelationalModule.AC_networks import OheCritic, twin_forward
+from RelationalModule.MLP_AC_networks import Critic
+from RelationalModule.OheActorCritic import OheA2C
+
+def forward_backward(critic, state, vectorize):
+    critic.vectorize = vectorize
+    critic.zero_grad()
+    v1, v2 = critic(state)
+    (v1.sum() + 2*v2.sum()).backward()
+    return (v1.detach(), v2.detach()), [p.grad.clone() for p in critic.parameters()]
+
+@pytest.mark.parametrize("critic_fn, state_shape", [(lambda: Critic(4, twin=True), (16, 4)),
+                                                    (lambda: OheCritic(3, twin=True), (16, 3, 5, 5))])
+def test_vectorized_matches_sequential(critic_fn, state_shape):
+    critic = critic_fn().eval()
+    state = torch.rand(state_shape)
+    (v1, v2), grads = forward_backward(critic, state, False)
+    (v1_vec, v2_vec), grads_vec = forward_backward(critic, state, True)
+    torch.testing.assert_close(v1_vec, v1)
+    torch.testing.assert_close(v2_vec, v2)
+    assert not torch.equal(v1, v2)
+    for g, g_vec in zip(grads, grads_vec):
+        torch.testing.assert_close(g_vec, g, rtol=1e-4, atol=1e-5)
+
+def test_buffers_are_vectorized(small_net):
+    net1, net2 = small_net.eval(), copy.deepcopy(small_net).eval()
+    with torch.no_grad():
+        net2[1].running_mean.fill_(1.)
+    state = torch.randn(8, 4)
+    v1, v2 = twin_forward(net1, net2, state, vectorize=True)
+    torch.testing.assert_close(v1, net1(state))
+    torch.testing.assert_close(v2, net2(state))
+
+def test_state_dict_keeps_twin_keys():
+    keys = list(Critic(4, twin=True).state_dict())
+    assert any(k.startswith('net1.') for k in keys) and any(k.startswith('net2.') for k in keys)
+    assert all(k.startswith(('net1.', 'net2.')) for k in keys)
+
+def test_vectorize_flag_reaches_critics():
+    agent = OheA2C(4, 3, lr=1e-3, gamma=0.9, twin=True, tau=0.5, vectorize_twin=True)
+    assert agent.critic.vectorize and agent.critic_trg.vectorize
+    assert OheA2C(4, 3, lr=1e-3, gamma=0.9, twin=True).critic.vectorize is None